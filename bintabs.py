@@ -0,0 +1,217 @@
+'''
+Indexed access to the slit tables of a DEIMOS mask.
+
+The <mask>.bintabs.fits file of a reduced mask holds the target table (HDU 1),
+the mask table (HDU 2), the slit table (HDU 3) and the table mapping slits to
+targets (HDU 4), while the redshifts of the slits are in the zspec file. Rather
+than resolving slit -> DSLITID -> OBJECTID -> OBJECT -> zspec row with a
+boolean scan of every table for each slit, the tables are joined once into a
+single per-slit table, with a dictionary from slit name to row. The joined
+table is cached next to the bintabs file (<mask>.bintabs.fits.joined.npy, or
+<mask>.bintabs.fits.<zspec file>.joined.npy when joined with a zspec file) and
+reused as long as the bintabs and zspec files are unchanged. Slits without a
+target or zspec row have -99 in the numeric columns of the missing table, and
+the HAS_TARGET and HAS_ZSPEC columns flag the slits that have them.
+
+Usage:
+    bt = bintabs.readBintabs(path+maskname+'.bintabs.fits',zspecfile)
+    record = bintabs.slitRecord(bt,slit)
+    record['OBJECT'], record['SLITRA'], record['Z'], bt['mask']['PA_PNT']
+'''
+import os
+import json
+import numpy
+import pyfits
+
+# Tables returned by readBintabs, keyed by (binfile, zspecfile)
+_bintabs_cache = {}
+# version of the joined table layout, cached tables of another version are
+# rebuilt
+_joined_version = 3
+
+def slitName(slit):
+    '''
+    Returns the three digit slit name (e.g. '007') of a slit number, slit names
+    given as strings are returned as is.
+    '''
+    if isinstance(slit,basestring):
+        return slit
+    return '{0:03d}'.format(int(slit))
+
+def _sourceStamp(filenames):
+    # size and mtime of each source file of the joined table
+    stamp = []
+    for filename in filenames:
+        if filename == None:
+            stamp.append(None)
+        else:
+            st = os.stat(filename)
+            stamp.append([os.path.abspath(filename),st.st_size,st.st_mtime])
+    return stamp
+
+def _lookup(keys,values):
+    # returns the row of the first occurrence of each value in keys, -1 for
+    # values that are not found, using a stable sort of keys
+    order = numpy.argsort(keys,kind='mergesort')
+    sorted_keys = numpy.asarray(keys)[order]
+    pos = numpy.searchsorted(sorted_keys,values,side='left')
+    pos = numpy.minimum(pos,numpy.size(sorted_keys)-1)
+    if numpy.size(sorted_keys) == 0:
+        return -numpy.ones(numpy.size(values),dtype=int)
+    found = sorted_keys[pos] == values
+    return numpy.where(found,order[pos],-1)
+
+def _columns(table,rows,columns,names):
+    # appends the columns of table (at rows) to names and columns, skipping
+    # names already present. Where rows is -1 numeric columns are -99 and
+    # other columns zero (empty strings). String columns are stripped of the
+    # fits blank padding, as pyfits does when reading a field
+    for name in table.names:
+        if name in names:
+            continue
+        field = numpy.asarray(table.field(name))
+        if field.dtype.kind == 'S':
+            field = numpy.char.rstrip(field)
+        values = field[numpy.maximum(rows,0)]
+        if field.dtype.kind in 'if':
+            values[rows < 0] = -99
+        else:
+            values[rows < 0] = numpy.zeros(1,dtype=field.dtype)[0]
+        names.append(name)
+        columns.append(values)
+
+def joinTables(hdubin,tb_zspec=None):
+    '''
+    Joins the slit, map and target tables of a bintabs file, and optionally
+    a zspec table, into a single table with one row per slit.
+    Input:
+    hdubin = [HDUList] the opened bintabs file
+    tb_zspec = [table or None] the zspec table (HDU 1 of the zspec file)
+    Output:
+    joined = [structured array] the slit table columns, followed by the
+        OBJECTID of the map table, the target table columns and the zspec
+        columns, and the boolean HAS_TARGET and HAS_ZSPEC columns. Slits
+        without a target or zspec row have -99 in the numeric columns (empty
+        strings in the others) of those tables, HAS_ZSPEC is False for every
+        slit when tb_zspec is None.
+    '''
+    tb_targets = hdubin[1].data
+    tb_slits = hdubin[3].data
+    tb_map = hdubin[4].data
+    N = numpy.size(tb_slits)
+    names = []
+    columns = []
+    _columns(tb_slits,numpy.arange(N),columns,names)
+    map_rows = _lookup(tb_map.field('DSLITID'),tb_slits.field('DSLITID'))
+    _columns(tb_map,map_rows,columns,names)
+    objectid = numpy.where(map_rows >= 0,columns[names.index('OBJECTID')],-1)
+    target_rows = _lookup(tb_targets.field('OBJECTID'),objectid)
+    target_rows[map_rows < 0] = -1
+    _columns(tb_targets,target_rows,columns,names)
+    zspec_rows = -numpy.ones(N,dtype=int)
+    if tb_zspec is not None:
+        # the zspec slit names drop the leading zeros, '007' is '7'
+        zspec_slits = numpy.array([name.strip().lstrip('0') or '0' for name in tb_zspec.field('SLITNAME')])
+        slits = numpy.array([slitName(name).lstrip('0') or '0' for name in tb_slits.field('SLITNAME')])
+        zspec_rows = _lookup(zspec_slits,slits)
+        _columns(tb_zspec,zspec_rows,columns,names)
+    names.extend(['HAS_TARGET','HAS_ZSPEC'])
+    columns.extend([target_rows >= 0,zspec_rows >= 0])
+    dtype = [(name,column.dtype,column.shape[1:]) for name,column in zip(names,columns)]
+    joined = numpy.zeros(N,dtype=dtype)
+    for name,column in zip(names,columns):
+        joined[name] = column
+    return joined
+
+def _maskRow(hdubin):
+    # the first row of the mask table as a dictionary of python values
+    tb_mask = hdubin[2].data
+    row = {}
+    for name in tb_mask.names:
+        value = numpy.asarray(tb_mask.field(name))[0]
+        if isinstance(value,numpy.string_):
+            value = value.rstrip()
+        row[name] = value.tolist() if hasattr(value,'tolist') else value
+    return row
+
+def _buildIndex(bt):
+    bt['index'] = dict((slitName(name),i) for i,name in enumerate(bt['slits']['SLITNAME']))
+    objects = {}
+    if 'OBJECT' in bt['slits'].dtype.names:
+        for i,name in enumerate(bt['slits']['OBJECT']):
+            objects.setdefault(name,[]).append(i)
+    bt['object_index'] = objects
+    return bt
+
+def readBintabs(binfile,zspecfile=None,cache=True):
+    '''
+    Reads the joined slit table of a mask, see joinTables. The table is kept
+    in memory for the session and, with cache True, on disk next to binfile.
+    Input:
+    binfile = ['string'] the mask's bintabs.fits file
+    zspecfile = ['string' or None] the mask's zspec file
+    cache = [boolean] reuse (and write) the joined table cached on disk
+    Output:
+    bt = [dictionary] 'slits' the joined table, 'index' maps slit names to
+        rows of the joined table, 'object_index' maps target object names to
+        the list of their rows and 'mask' the mask table (first row) as a
+        dictionary
+    '''
+    key = (os.path.abspath(binfile),None if zspecfile == None else os.path.abspath(zspecfile))
+    stamp = _sourceStamp([binfile,zspecfile])
+    cached = _bintabs_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    # the joins with and without (and with different) zspec files are cached
+    # separately
+    if zspecfile == None:
+        cachefile = binfile+'.joined.npy'
+    else:
+        cachefile = binfile+'.'+os.path.basename(zspecfile)+'.joined.npy'
+    metafile = cachefile[:-len('npy')]+'json'
+    bt = None
+    if cache and os.path.exists(cachefile) and os.path.exists(metafile):
+        try:
+            F = open(metafile)
+            meta = json.load(F)
+            F.close()
+        except (IOError,ValueError):
+            meta = None
+        if (meta != None and meta.get('version') == _joined_version and
+            meta['sources'] == json.loads(json.dumps(stamp))):
+            bt = {'slits':numpy.load(cachefile),'mask':meta['mask']}
+    if bt is None:
+        hdubin = pyfits.open(binfile)
+        tb_zspec = None
+        if zspecfile != None:
+            hduzspec = pyfits.open(zspecfile)
+            tb_zspec = hduzspec[1].data
+        bt = {'slits':joinTables(hdubin,tb_zspec),'mask':_maskRow(hdubin)}
+        if cache:
+            try:
+                # write to temporary files then rename, so that an
+                # interrupted save never leaves a partial cache
+                F = open(cachefile+'.tmp','wb')
+                numpy.save(F,bt['slits'])
+                F.close()
+                os.rename(cachefile+'.tmp',cachefile)
+                F = open(metafile+'.tmp','w')
+                json.dump({'version':_joined_version,'sources':stamp,'mask':bt['mask']},F)
+                F.close()
+                os.rename(metafile+'.tmp',metafile)
+            except (IOError,OSError):
+                print 'bintabs: warning, unable to write the cache {0}'.format(cachefile)
+    _buildIndex(bt)
+    _bintabs_cache[key] = (stamp,bt)
+    return bt
+
+def slitRecord(bt,slit):
+    '''
+    Returns the joined table row of a slit (slit name or number), e.g.
+    slitRecord(bt,7)['OBJECT']. Raises KeyError if the mask has no such slit,
+    rather than exiting, so that it can be called from process pool workers.
+    '''
+    try:
+        return bt['slits'][bt['index'][slitName(slit)]]
+    except KeyError:
+        raise KeyError('bintabs.slitRecord: there is no slit {0} in the bintabs file'.format(slit))
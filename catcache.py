@@ -0,0 +1,200 @@
+'''
+Binary cache for ttype indexed, white space delimited text catalogs.
+
+The first time a catalog is loaded it is parsed as usual and saved next to the
+text file in a <catalog>.npcache directory: the full catalog as a single
+column-major (Fortran ordered) .npy array and any columns read on their own
+(e.g. the objid column of an exclusion list) as one .npy per column. Later
+loads memory-map these files instead of re-parsing the text. The cache is
+tied to the source file through its size, mtime and md5 hash, and is rebuilt
+whenever the source changes. The array files are named after the md5 hash of
+the catalog they were built from, and meta.json (replaced atomically) names the
+current one, so a rebuild never overwrites or truncates a file that another
+process may be reading or memory-mapping; the files of older versions are
+removed once the new metadata is in place.
+
+Usage, as a drop in replacement for tools.readcatalog/tools.readheader:
+    cat, key = catcache.loadcatalog(catalog)
+'''
+import os
+import json
+import hashlib
+import tempfile
+import numpy
+import tools
+
+def fileHash(filename,blocksize=2**20):
+    '''
+    Returns the md5 hex digest of a file, read in blocks of blocksize bytes.
+    '''
+    md5 = hashlib.md5()
+    F = open(filename,'rb')
+    block = F.read(blocksize)
+    while block:
+        md5.update(block)
+        block = F.read(blocksize)
+    F.close()
+    return md5.hexdigest()
+
+def cacheDir(catalog,cachedir=None):
+    '''
+    Returns the cache directory of a catalog. By default the cache sits next
+    to the catalog, otherwise it is placed in cachedir.
+    '''
+    if cachedir == None:
+        return catalog+'.npcache'
+    return os.path.join(cachedir,os.path.basename(catalog)+'.npcache')
+
+def _readMeta(cdir):
+    try:
+        F = open(os.path.join(cdir,'meta.json'))
+        meta = json.load(F)
+        F.close()
+    except (IOError,ValueError):
+        return None
+    return meta
+
+def _writeMeta(cdir,meta):
+    fd,tmp = tempfile.mkstemp(suffix='.tmp',dir=cdir)
+    F = os.fdopen(fd,'w')
+    json.dump(meta,F)
+    F.close()
+    os.rename(tmp,os.path.join(cdir,'meta.json'))
+
+def _cacheFile(cdir,meta,name):
+    # array files are versioned by the md5 hash of the catalog
+    return os.path.join(cdir,'{0}.{1}'.format(meta['md5'][:16],name))
+
+def _saveArray(cdir,name,array):
+    # write to a temporary file (unique to this process) then rename, so that
+    # an interrupted or concurrent save never leaves a truncated array
+    fd,tmp = tempfile.mkstemp(suffix='.tmp',dir=cdir)
+    F = os.fdopen(fd,'wb')
+    numpy.save(F,array)
+    F.close()
+    os.rename(tmp,os.path.join(cdir,name))
+
+def _removeStale(cdir,meta):
+    # removes the array files of older versions of the catalog, readers that
+    # already opened or memory-mapped them keep their data (POSIX unlink)
+    prefix = meta['md5'][:16]+'.'
+    for name in os.listdir(cdir):
+        if name != 'meta.json' and not name.startswith(prefix) and not name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(cdir,name))
+            except OSError:
+                pass
+
+def _loadArray(catalog,cachedir,verify_hash,name,build):
+    '''
+    Memory-maps (copy-on-write) the cache file name of a catalog, building it
+    with build() if it does not exist. Returns (array, meta), or (None, None)
+    if the cache can not be written.
+    '''
+    for attempt in range(2):
+        cdir, meta = _openCache(catalog,cachedir,verify_hash)
+        if cdir == None:
+            return None, None
+        filename = _cacheFile(cdir,meta,name)
+        if not os.path.exists(filename):
+            _saveArray(cdir,os.path.basename(filename),build())
+        try:
+            return numpy.load(filename,mmap_mode='c'), meta
+        except (IOError,OSError):
+            # another process rebuilt the cache in the meantime, reopen it
+            if attempt == 1:
+                raise
+
+def _openCache(catalog,cachedir=None,verify_hash=False):
+    '''
+    Returns the cache directory and its metadata, (re)initializing the cache if
+    it is missing or out of date with respect to the catalog. Returns
+    (None, None) if the cache can not be written.
+    '''
+    cdir = cacheDir(catalog,cachedir)
+    st = os.stat(catalog)
+    meta = _readMeta(cdir)
+    if meta != None and meta['size'] == st.st_size:
+        if meta['mtime'] == st.st_mtime and not verify_hash:
+            return cdir, meta
+        # the catalog was touched (or a hash check was requested), the cache
+        # is still valid if the contents have not changed
+        if meta['md5'] == fileHash(catalog):
+            if meta['mtime'] == st.st_mtime:
+                return cdir, meta
+            meta['mtime'] = st.st_mtime
+            try:
+                _writeMeta(cdir,meta)
+            except (IOError,OSError):
+                print 'catcache: warning, unable to write the cache {0}, reading the text catalog'.format(cdir)
+                return None, None
+            return cdir, meta
+    try:
+        if not os.path.isdir(cdir):
+            try:
+                os.makedirs(cdir)
+            except OSError:
+                # created by a concurrent process
+                if not os.path.isdir(cdir):
+                    raise
+        meta = {'source':os.path.abspath(catalog),'size':st.st_size,
+                'mtime':st.st_mtime,'md5':fileHash(catalog),
+                'key':tools.readheader(catalog)}
+        _writeMeta(cdir,meta)
+        _removeStale(cdir,meta)
+    except (IOError,OSError):
+        print 'catcache: warning, unable to write the cache {0}, reading the text catalog'.format(cdir)
+        return None, None
+    return cdir, meta
+
+def loadcatalog(catalog,cachedir=None,verify_hash=False):
+    '''
+    Loads a ttype catalog through the binary cache.
+    Input:
+    catalog = ['string'] ttype indexed, white space delimited text catalog
+    cachedir = ['string' or None] directory in which to keep the cache, if None
+        the cache is kept next to the catalog
+    verify_hash = [boolean] if True the md5 hash of the catalog is checked on
+        every load, otherwise only when the catalog's mtime has changed
+    Output:
+    cat = [2D array] the catalog, memory-mapped copy-on-write from the cache so
+        that changes made to it are never written back
+    key = [dictionary] the ttype key of the catalog
+    '''
+    def build():
+        print 'catcache: building binary cache of {0}'.format(catalog)
+        # column-major order so that each catalog column is contiguous
+        return numpy.asfortranarray(tools.readcatalog(catalog))
+    cat, meta = _loadArray(catalog,cachedir,verify_hash,'catalog.npy',build)
+    if meta == None:
+        return tools.readcatalog(catalog), tools.readheader(catalog)
+    return cat, meta['key']
+
+def loadcolumn(catalog,ttype,cachedir=None,verify_hash=False):
+    '''
+    Loads a single column of a ttype catalog through the binary cache. Unlike
+    loadcatalog only this column needs to be numeric, so it can be used on
+    files such as dsim catalogs with sexagesimal coordinates.
+    Input:
+    catalog = ['string'] ttype indexed, white space delimited text catalog
+    ttype = ['string'] ttype name of the column
+    Output:
+    column = [1D array] the column values
+    '''
+    cdir, meta = _openCache(catalog,cachedir,verify_hash)
+    if cdir == None:
+        key = tools.readheader(catalog)
+        return numpy.loadtxt(catalog,usecols=(key[ttype],),ndmin=1)
+    index = meta['key'][ttype]
+    datafile = _cacheFile(cdir,meta,'catalog.npy')
+    if os.path.exists(datafile):
+        try:
+            return numpy.atleast_2d(numpy.load(datafile,mmap_mode='c'))[:,index]
+        except (IOError,OSError):
+            # removed by a concurrent rebuild, fall back to the column file
+            pass
+    column, meta = _loadArray(catalog,cachedir,verify_hash,'column{0}.npy'.format(index),
+                              lambda: numpy.loadtxt(catalog,usecols=(index,),ndmin=1))
+    if meta == None:
+        return numpy.loadtxt(catalog,usecols=(index,),ndmin=1)
+    return column
@@ -1,16 +1,16 @@
 import numpy
 def objectPA(H,delta,phi):
-    from math import atan, tan, cos, sin, pi
+    # H, delta and phi may be arrays, they are broadcast against each other
+    from numpy import arctan, tan, cos, sin, pi
     d2r = pi/180.
-    phi *= d2r    
-    H = H*15*d2r
-    delta *= d2r
+    phi = numpy.asarray(phi,dtype=float)*d2r
+    H = numpy.asarray(H,dtype=float)*15*d2r
+    delta = numpy.asarray(delta,dtype=float)*d2r
     
     denom = tan(phi)*cos(delta)-sin(delta)*cos(H)
-    q = atan(sin(H)/denom)
+    q = arctan(sin(H)/denom)
     q = q/d2r
-    if denom < 0:
-        q += 180
+    q = numpy.where(denom < 0,q+180,q)
     return q
 
 def optimalPA(H,delta,phi):
@@ -20,40 +20,32 @@ def optimalPA(H,delta,phi):
     
     Input:
     phi = [float; units=degrees] observers latitude
-    H = [float; units=hours] object's hour angle (H is + if west of the meridian)
-    delta = [float; units=degrees] object's declination
+    H = [float or array; units=hours] object's hour angle (H is + if west of the meridian)
+    delta = [float or array; units=degrees] object's declination
     '''
-    from math import pi,sin,cos,asin
+    from numpy import pi,sin,cos,arcsin
     pa_obj = objectPA(H,delta,phi)
     d2r = pi/180.
-    phi *= d2r
-    if H < 0:
-        sign = -1
-        H = -H
-    else:
-        sign = 1
+    phi = numpy.asarray(phi,dtype=float)*d2r
+    H = numpy.asarray(H,dtype=float)
+    sign = numpy.where(H < 0,-1,1)
+    H = numpy.where(H < 0,-H,H)
     H = H*15*d2r
-    delta *= d2r
-    eta_rad = sign*asin(sin(H)*cos(phi) / 
-                        (1-(sin(phi)*sin(delta) +
-                            cos(phi)*cos(delta)*cos(H))**2)**(0.5))
+    delta = numpy.asarray(delta,dtype=float)*d2r
+    eta_rad = sign*arcsin(sin(H)*cos(phi) / 
+                          (1-(sin(phi)*sin(delta) +
+                              cos(phi)*cos(delta)*cos(H))**2)**(0.5))
     eta_deg = eta_rad/d2r
     
-    if sign*pa_obj < 0:
-        eta_deg = sign*(180-sign*eta_deg)
+    eta_deg = numpy.where(sign*pa_obj < 0,sign*(180-sign*eta_deg),eta_deg)
     return eta_deg
 
 
 dec = numpy.arange(-35,90,5)
 HA = numpy.arange(0,8.5,0.5)
-N_dec = numpy.size(dec)
-N_HA = numpy.size(HA)
-result = numpy.zeros((N_dec,N_HA))
-pa = numpy.zeros((N_dec,N_HA))
-for i in numpy.arange(N_dec):
-    for j in numpy.arange(N_HA):
-        result[i,j]=optimalPA(HA[j],dec[i],33.35)
-        pa[i,j] = objectPA(HA[j],dec[i],33.35)
+# evaluate the whole Dec x HA grid at once
+result = optimalPA(HA[numpy.newaxis,:],dec[:,numpy.newaxis],33.35)
+pa = objectPA(HA[numpy.newaxis,:],dec[:,numpy.newaxis],33.35)
 numpy.savetxt('palomar.txt',result,fmt='%1.1f',delimiter='\t')
 numpy.savetxt('palomar_pa.txt',pa,fmt='%1.1f',delimiter='\t')
 print result
\ No newline at end of file
@@ -0,0 +1,185 @@
+'''
+Batch conversion of finding charts (e.g. the SDSS color charts of
+http://skyserver.sdss3.org/dr9/en/tools/chart/chart.asp) to color fits images
+with a TAN WCS, see fitsmaker.
+
+The charts are listed either in a manifest, a text file with one chart per
+line:
+    #image  ra  dec  scale  [fitsfile]
+    /sandbox/A1612/field.ppm  191.93  -2.79222  0.79224
+    /sandbox/A1612/gs1.jpg  191.87  -2.80110  0.2  /sandbox/A1612/gs1.fits
+(ra, dec in degrees, scale in arcsec/pixel, '#' lines are comments), or they
+are derived from the ds9 region files of the masks (see
+obsplan.readMaskRegions), the chart of mask n being centered on its box. JPEG
+charts are converted to PPM with jpegtopnm first. The charts are converted in
+a process pool, and charts whose fits file is newer than the chart and already
+has the requested center and scale are skipped.
+'''
+import os
+import sys
+import tempfile
+import multiprocessing
+import numpy
+import pyfits
+import obsplan
+import fitsmaker
+
+###########################
+### USER INPUTS
+###########################
+# manifest of the charts, None to derive the charts from regfiles
+manifest = '/sandbox/deimos/A1612/charts.txt'
+# ds9 region file(s) of the masks, used when manifest is None
+regfiles = ['/sandbox/deimos/A1612/A1612_masks.reg']
+# chart of mask n (counting the boxes of regfiles from 1) and its pixel scale
+# (arcsec/pixel)
+image_pattern = '/sandbox/deimos/A1612/A1612_m{0}.ppm'
+scale = 0.79224
+# directory of the fits files of the charts without a fitsfile in the
+# manifest, None for the directory of each chart
+outdir = None
+# BITPIX of the fits images, None for the type of the charts (see fitsmaker)
+bitpix = None
+# Number of processes converting charts in parallel
+processes = 4
+
+###########################
+### PROGRAM
+###########################
+
+def readManifest(manifest):
+    '''
+    Reads a manifest of charts, see the module documentation.
+    Output:
+    charts = [list of tuples] (image, ra, dec, scale, fitsfile) of each chart,
+        fitsfile None if the manifest does not give one
+    '''
+    charts = []
+    for n,line in enumerate(open(manifest)):
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        if len(fields) not in (4,5):
+            print 'findingcharts.readManifest: error, line {0} of {1} is not "image ra dec scale [fitsfile]", exiting'.format(n+1,manifest)
+            sys.exit()
+        fitsfile = fields[4] if len(fields) == 5 else None
+        charts.append((fields[0],float(fields[1]),float(fields[2]),float(fields[3]),fitsfile))
+    return charts
+
+def regionCharts(regfiles,image_pattern,scale):
+    '''
+    Derives the charts of the masks of ds9 region files.
+    Input:
+    regfiles = [string or list of strings] ds9 region file(s), each box is a
+        mask
+    image_pattern = [string] chart of mask n, formatted with n (counting the
+        boxes from 1 in the order of obsplan.readMaskRegions)
+    scale = [float; units:arcsec/pixel] pixel scale of the charts
+    Output:
+    charts = [list of tuples] see readManifest
+    '''
+    boxes = obsplan.readMaskRegions(regfiles)
+    return [(image_pattern.format(i+1),float(box['xc']),float(box['yc']),scale,None)
+            for i,box in enumerate(boxes)]
+
+def chartFilename(image,outdir=None):
+    '''
+    Returns the default fits file of a chart, the chart name with a .fits
+    extension, in outdir (None for the directory of the chart).
+    '''
+    fitsfile = os.path.splitext(image)[0]+'.fits'
+    if outdir != None:
+        fitsfile = os.path.join(outdir,os.path.basename(fitsfile))
+    return fitsfile
+
+def _isCurrent(image,fitsfile,ra,dec,scale,bitpix):
+    # True if fitsfile is newer than image and has the requested WCS and type
+    if not os.path.exists(fitsfile) or os.path.getmtime(fitsfile) < os.path.getmtime(image):
+        return False
+    try:
+        header = pyfits.getheader(fitsfile)
+    except (IOError,IndexError):
+        return False
+    if bitpix != None and header.get('BITPIX') != bitpix:
+        return False
+    wcs = [header.get(key) for key in ('CRVAL1','CRVAL2','CD2_2')]
+    if None in wcs:
+        return False
+    return numpy.allclose(wcs,[ra,dec,scale/3600],rtol=0,atol=1e-9)
+
+def _chartWorker(task):
+    '''
+    Process pool worker of makeCharts, converts one chart.
+    '''
+    image,ra,dec,scale,fitsfile,bitpix = task
+    if os.path.splitext(image)[1].lower() not in ('.jpg','.jpeg'):
+        return _convertChart(image,image,ra,dec,scale,fitsfile,bitpix)
+    fd,ppm = tempfile.mkstemp(suffix='.ppm',dir=os.path.dirname(os.path.abspath(fitsfile)))
+    os.close(fd)
+    try:
+        if os.system('jpegtopnm "{0}" > "{1}"'.format(image,ppm)):
+            print 'findingcharts: error, jpegtopnm failed on {0}'.format(image)
+            return None
+        return _convertChart(image,ppm,ra,dec,scale,fitsfile,bitpix)
+    finally:
+        os.remove(ppm)
+
+def _convertChart(image,ppm,ra,dec,scale,fitsfile,bitpix):
+    # converts one chart, a chart that can not be converted (e.g. the PGM
+    # that jpegtopnm writes for a grayscale JPEG) is reported and skipped
+    try:
+        fitsmaker.ppm2fits(ppm,fitsfile,ra,dec,scale,bitpix)
+    except ValueError as e:
+        print 'findingcharts: error, {0} not converted: {1}'.format(image,e)
+        if os.path.exists(fitsfile+'.tmp'):
+            os.remove(fitsfile+'.tmp')
+        return None
+    return fitsfile
+
+def makeCharts(charts,outdir=None,bitpix=None,processes=1):
+    '''
+    Converts the charts that are missing or out of date to fits images with
+    WCS, see the module documentation.
+    Input:
+    charts = [list of tuples] (image, ra, dec, scale, fitsfile) of each chart,
+        see readManifest and regionCharts
+    outdir = [string or None] directory of the fits files of the charts
+        without fitsfile, None for the directory of each chart
+    bitpix = [int or None] BITPIX of the fits images, see fitsmaker.ppm2fits
+    processes = [int] number of worker processes
+    Output:
+    converted = [list of strings] the fits files (re)written, charts that
+        can not be converted are reported and left out
+    '''
+    missing = [chart[0] for chart in charts if not os.path.exists(chart[0])]
+    if len(missing) > 0:
+        print 'findingcharts.makeCharts: error, charts not found: {0}, exiting'.format(', '.join(missing))
+        sys.exit()
+    if outdir != None and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tasks = []
+    for image,ra,dec,scale,fitsfile in charts:
+        if fitsfile == None:
+            fitsfile = chartFilename(image,outdir)
+        if not _isCurrent(image,fitsfile,ra,dec,scale,bitpix):
+            tasks.append((image,ra,dec,scale,fitsfile,bitpix))
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes,len(tasks)))
+        try:
+            converted = pool.map(_chartWorker,tasks,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        converted = [_chartWorker(task) for task in tasks]
+    failed = converted.count(None)
+    converted = [fitsfile for fitsfile in converted if fitsfile != None]
+    print 'findingcharts: {0} of {1} charts converted, {2} up to date, {3} failed'.format(len(converted),len(charts),len(charts)-len(tasks),failed)
+    return converted
+
+if __name__ == '__main__':
+    if manifest != None:
+        charts = readManifest(manifest)
+    else:
+        charts = regionCharts(regfiles,image_pattern,scale)
+    makeCharts(charts,outdir,bitpix,processes)
@@ -5,6 +5,13 @@ and provided the center (RA,Dec) and image pixel scale, it creates a color fits
 for use with programs like ds9, including WCS.
 
 The original version of this of program was written by Dave Wittman.
+
+The conversion streams the image rather than loading it: the PPM pixels are
+memory-mapped after its header, the FITS header is written and the data
+section of the FITS file is memory-mapped, and the red, green and blue planes
+are copied (flipped in y) a block of rows at a time. Memory use is therefore
+bounded by the block size rather than the image size, and the planes keep the
+8 bit type of the chart (BITPIX 8) unless another BITPIX is asked for.
 '''
 import numpy
 import pyfits
@@ -27,49 +34,125 @@ outname = '/Users/dawson/SkyDrive/Observing/Keck2014a/A1612/sdss079224.fits'
 ra = 191.93
 dec = -2.79222
 scale = 0.79224
+# BITPIX of the fits image, None for the type of the PPM (8 for 8 bit charts)
+bitpix = None
+# number of image rows copied at a time
+blockrows = 1024
 
 #if os.system("jpegtopnm %s>tmp.ppm" % (inname)):
 #    sys.stderr.write("jpegtopnm failed, exiting\n")
 #    sys.exit(1)
 
-# scan the header
-nchars = 0
-infile = open(inname)
-line = infile.readline()
-nchars+=len(line)
-if line[:2] != 'P6':
-    sys.stderr.write("ppm header failed, exiting\n")
-    sys.exit(1)
-line = infile.readline()
-nchars+=len(line)
-matches = re.match('(\d+) (\d+)',line)
-xs = int(matches.group(1))
-ys = int(matches.group(2))
-line = infile.readline()
-nchars+=len(line)
-# done with hdr, now that we know the number of bytes to skip
+# numpy type of the fits data of each BITPIX (fits data are big endian)
+bitpix_dtypes = {8:'u1',16:'>i2',32:'>i4',-32:'>f4',-64:'>f8'}
+# next header token, after whitespace and # comments
+_ppm_token = re.compile(r'(?:\s|#[^\n]*\n?)*(\S+)')
+
+def readPPMHeader(inname):
+    '''
+    Parses the header of a binary (P6) PPM file.
+    Output:
+    width, height = [ints; units:pixels] size of the image
+    maxval = [int] maximum pixel value, above 255 the samples are 16 bit
+    offset = [int; units:bytes] start of the pixels in the file
+    Raises ValueError if the file is not a binary PPM.
+    '''
+    infile = open(inname,'rb')
+    # the header is at most a few lines, possibly with # comments
+    head = infile.read(4096)
+    infile.close()
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        m = _ppm_token.match(head,pos)
+        if m == None:
+            break
+        tokens.append(m.group(1))
+        pos = m.end()
+    if len(tokens) < 4 or tokens[0] != 'P6' or not all(token.isdigit() for token in tokens[1:]):
+        raise ValueError('fitsmaker.readPPMHeader: {0} is not a binary (P6) PPM file'.format(inname))
+    width,height,maxval = [int(token) for token in tokens[1:]]
+    # a single whitespace character separates the header from the pixels
+    return width,height,maxval,pos+1
+
+def readPPM(inname):
+    '''
+    Memory-maps the pixels of a binary (P6) PPM file.
+    Output:
+    ppm = [3D memmap array] the image as (row, column, red/green/blue), the
+        first row being the top of the image
+    '''
+    width,height,maxval,offset = readPPMHeader(inname)
+    dtype = 'u1' if maxval < 256 else '>u2'
+    return numpy.memmap(inname,dtype=dtype,mode='r',offset=offset,shape=(height,width,3))
+
+def wcsHeader(width,height,bitpix,ra,dec,scale):
+    '''
+    Returns the primary header of a 3 plane (red, green, blue) image of the
+    given size, with a TAN projection centered on (ra, dec).
+    Input:
+    ra, dec = [floats; units:degrees] image center
+    scale = [float; units:arcsec/pixel] pixel scale
+    '''
+    cards = [('SIMPLE',True),('BITPIX',bitpix),('NAXIS',3),('NAXIS1',width),
+             ('NAXIS2',height),('NAXIS3',3),('EXTEND',True),
+             ('CTYPE1','RA---TAN'),('CTYPE2','DEC--TAN'),
+             ('CRPIX1',width/2),('CRPIX2',height/2),
+             ('CRVAL1',ra),('CRVAL2',dec),
+             ('CD1_1',-scale/3600),('CD2_2',scale/3600),
+             ('CD1_2',0.0),('CD2_1',0.0)]
+    return pyfits.Header([pyfits.Card(key,value) for key,value in cards])
+
+def ppm2fits(inname,outname,ra,dec,scale,bitpix=None,blockrows=1024):
+    '''
+    Converts a PPM color image to a 3 plane fits image with WCS, see the module
+    documentation.
+    Input:
+    inname = ['string'] the binary (P6) PPM file, e.g. from jpegtopnm
+    outname = ['string'] the fits file, written to outname+'.tmp' then renamed
+    ra, dec = [floats; units:degrees] image center
+    scale = [float; units:arcsec/pixel] pixel scale
+    bitpix = [int or None] BITPIX of the fits image, None for 8 (16 bit PPMs
+        32)
+    blockrows = [int] number of image rows copied at a time
+    Raises ValueError if inname is not a binary PPM or bitpix can not hold its
+    pixels, rather than exiting, so that it can be called from process pool
+    workers.
+    '''
+    ppm = readPPM(inname)
+    height,width = ppm.shape[:2]
+    if bitpix == None:
+        bitpix = 8 if ppm.dtype.itemsize == 1 else 32
+    if bitpix not in bitpix_dtypes:
+        raise ValueError('fitsmaker.ppm2fits: BITPIX must be one of {0}'.format(sorted(bitpix_dtypes)))
+    dtype = numpy.dtype(bitpix_dtypes[bitpix])
+    if dtype.kind != 'f' and numpy.iinfo(dtype).max < numpy.iinfo(ppm.dtype).max:
+        raise ValueError('fitsmaker.ppm2fits: BITPIX {0} cannot hold the {1} bit PPM pixels'.format(bitpix,8*ppm.dtype.itemsize))
+
+    # write the header and size the file to the padded data section
+    header = wcsHeader(width,height,bitpix,ra,dec,scale).tostring()
+    ndata = 3*height*width*dtype.itemsize
+    tmpname = outname+'.tmp'
+    F = open(tmpname,'wb')
+    F.write(header)
+    F.truncate(len(header)+-(-ndata//2880)*2880)
+    F.close()
 
-# reshape it the way FITS wants it
-data = numpy.fromfile(inname,dtype=numpy.uint8)
-reddata = data[nchars::3].reshape([xs,ys])
-grndata = data[nchars+1::3].reshape([xs,ys])
-bluedata = data[nchars+2::3].reshape([xs,ys])
-newdata = numpy.empty([3,xs,ys])
-newdata[0,:,:] = reddata[::-1,:] # flip it in y
-newdata[1,:,:] = grndata[::-1,:]
-newdata[2,:,:] = bluedata[::-1,:]
+    # copy the planes a block of rows at a time, flipped in y
+    data = numpy.memmap(tmpname,dtype=dtype,mode='r+',offset=len(header),shape=(3,height,width))
+    for start in range(0,height,blockrows):
+        stop = min(start+blockrows,height)
+        block = ppm[height-stop:height-start][::-1]
+        for plane in range(3):
+            data[plane,start:stop,:] = block[:,:,plane]
+        data.flush()
+    del data
+    del ppm
+    os.rename(tmpname,outname)
 
-# write the new file
-newhdu=pyfits.PrimaryHDU(newdata)
-newhdu.header.update('CTYPE1','RA---TAN')
-newhdu.header.update('CTYPE2','DEC--TAN')
-newhdu.header.update('CRPIX1',xs/2)
-newhdu.header.update('CRPIX2',ys/2)
-newhdu.header.update('CRVAL1',ra)
-newhdu.header.update('CRVAL2',dec)
-newhdu.header.update('CD1_1',-scale/3600)
-newhdu.header.update('CD2_2',scale/3600)
-newhdu.header.update('CD1_2',0.0)
-newhdu.header.update('CD2_1',0.0)
-newhdu.writeto(outname)
-sys.exit(0)
+if __name__ == '__main__':
+    try:
+        ppm2fits(inname,outname,ra,dec,scale,bitpix,blockrows)
+    except ValueError as e:
+        sys.stderr.write('{0}, exiting\n'.format(e))
+        sys.exit(1)
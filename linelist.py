@@ -0,0 +1,137 @@
+'''
+Spectral line lists and the line markers of the DEIMOS plots.
+
+A line list is a structured array with one row per line:
+    lines['name'] = ['string'] short name, e.g. 'Ha' or 'OIII_2'
+    lines['label'] = ['string'] label drawn next to the marker
+    lines['lambda'] = [float; units:angstrom] rest wavelength
+    lines['stagger'] = [int] -1, 0 or 1, shifts the label down or up so that
+        the labels of close lines (e.g. [NII] and Ha) do not overlap
+common_lines are the lines marked by obsplan.plotcoverage, plotSpecCoverage and
+plot1Dspec (spectrum_lines), and readLineList reads the DEEP line list of the
+spec1d pipeline (idl/spec1d/etc/DEEPlinelist.dat).
+
+drawLines redshifts a whole list at once, keeps the lines within the plotted
+wavelength range and draws all their markers as a single LineCollection, so
+that the cost of marking a spectrum does not grow with a plot call per line.
+
+Usage:
+    linelist.drawLines(ax,linelist.common_lines,redshift,label_y=0.5)
+'''
+import os
+import numpy
+from matplotlib.collections import LineCollection
+
+line_dtype = [('name','S16'),('label','S16'),('lambda',float),('stagger',int)]
+
+# name, label, rest wavelength (angstrom) and label stagger of the common lines
+common_lines = numpy.array([
+    ('Lyb','Ly-beta',1025.7,0),
+    ('Lya','Ly-alpha',1215.7,0),
+    ('CIV','C IV',1549.1,0),
+    ('AlIII','Al III',1858.7,0),
+    ('FeII','Fe II',2600,0),
+    ('MgII','Mg II',2799.8,0),
+    ('MgI','Mg I',2852,0),
+    ('OII','[O II]',3727.61,0),
+    ('CalK','Cal K',3933.667,0),
+    ('CalH','Cal H',3968.472,0),
+    ('Hd','Hd',4101.74,0),
+    ('Gband','G-band',4305,0),
+    ('Hg','Hg',4340.47,0),
+    ('Hb','Hb',4861.33,0),
+    ('OIII_1','[OIII]',4960.3,0),
+    ('OIII_2','[OIII]',5008.24,0),
+    ('Mgb','Mg I(b)',5176,0),
+    ('FeI','Fe I',5269,0),
+    ('NaD','Na I (D)',5893,0),
+    ('NII_1','[NII]',6548.06,-1),
+    ('Ha','Ha',6562.799,0),
+    ('NII_2','[NII]',6585.2,1),
+    ('SII','[SII]',6725.5,0)],dtype=line_dtype)
+
+# names of the lines marked on the reduced 1D spectra (plot1Dspec)
+spectrum_lines = ['Hb','OIII_1','OIII_2','Mgb','FeI','NaD','NII_1','Ha','NII_2']
+
+# the DEEP line list of the spec1d pipeline
+deep_linelist = os.path.join(os.path.dirname(os.path.abspath(__file__)),'idl','spec1d','etc','DEEPlinelist.dat')
+
+def selectLines(lines,names):
+    '''
+    Returns the rows of a line list with the given names, in the order of
+    names.
+    '''
+    index = dict((name,i) for i,name in enumerate(lines['name']))
+    return lines[[index[name] for name in names]]
+
+def readLineList(filename=deep_linelist):
+    '''
+    Reads a line list in the format of DEEPlinelist.dat: name, rest wavelength
+    (angstrom), rest width and f value columns, '#' lines are comments.
+    Output:
+    lines = [structured array] see the module documentation, labelled with the
+        names (underscores replaced by spaces)
+    '''
+    table = numpy.genfromtxt(filename,comments='#',usecols=(0,1),
+                             dtype=[('name','S16'),('lambda',float)])
+    table = numpy.atleast_1d(table)
+    lines = numpy.zeros(numpy.size(table),dtype=line_dtype)
+    lines['name'] = table['name']
+    lines['label'] = numpy.char.replace(table['name'],'_',' ')
+    lines['lambda'] = table['lambda']
+    return lines
+
+def observedLines(lines,redshift,xlim=None):
+    '''
+    Redshifts a line list.
+    Input:
+    lines = [structured array] the line list
+    redshift = [float or 1D array] redshift(s) of the lines
+    xlim = [(float,float) or None] only keep the lines strictly within this
+        observed wavelength range
+    Output:
+    x = [1D array; units:angstrom] observed wavelength of each kept line (for
+        each redshift, redshift major)
+    keep = [1D array of ints] line list row of each element of x
+    '''
+    x = numpy.outer(1+numpy.atleast_1d(redshift),lines['lambda']).ravel()
+    keep = numpy.tile(numpy.arange(numpy.size(lines)),numpy.size(redshift))
+    if xlim != None:
+        visible = (x > xlim[0]) & (x < xlim[1])
+        x = x[visible]
+        keep = keep[visible]
+    return x,keep
+
+def drawLines(ax,lines,redshift,xlim=None,ylim=None,label_y=0.5,stagger=0.1,labels=True,color='k',linestyle='dashed'):
+    '''
+    Marks the lines of a line list at redshift on the matplotlib axes ax, with
+    a single LineCollection for all the markers.
+    Input:
+    lines = [structured array] the line list
+    redshift = [float or 1D array] redshift(s) of the lines
+    xlim, ylim = [(float,float) or None] wavelength range of the drawn lines
+        and extent of the markers, None for the current limits of ax
+    label_y = [float] height of the labels, label_y*(ylim[0]+ylim[1])
+    stagger = [float] height shift of the staggered labels, in the units of
+        label_y
+    labels = [boolean] label the lines
+    Output:
+    markers = [LineCollection] the line markers
+    '''
+    if xlim == None:
+        xlim = ax.get_xlim()
+    if ylim == None:
+        ylim = ax.get_ylim()
+    x,keep = observedLines(lines,redshift,xlim)
+    segments = numpy.empty((numpy.size(x),2,2))
+    segments[:,:,0] = x[:,numpy.newaxis]
+    segments[:,0,1] = ylim[0]
+    segments[:,1,1] = ylim[1]
+    markers = LineCollection(segments,colors=color,linestyles=linestyle)
+    ax.add_collection(markers,autolim=False)
+    if labels:
+        y = (label_y+stagger*lines['stagger'][keep])*(ylim[0]+ylim[1])
+        for x_i,y_i,label in zip(x,y,lines['label'][keep]):
+            ax.text(x_i,y_i,label,horizontalalignment='right',
+                    verticalalignment='center',rotation='vertical')
+    return markers
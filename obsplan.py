@@ -2,31 +2,82 @@ from __future__ import division
 import numpy
 import pylab
 import tools
+import catcache
+import skyindex
 import sys
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+import bisect
+import linelist
+
+# ds9 box region: box(ra,dec,width",height",angle) in degrees and arcsec
+_box_regex = r"box\(([0-9]*\.?[0-9]+),(-?[0-9]*\.?[0-9]+),([0-9]*\.?[0-9]+)\",([0-9]*\.?[0-9]+)\",([0-9]*\.?[0-9]+)"
+_box_dtype = [('xc',numpy.float),('yc',numpy.float),('width',numpy.float),('height',numpy.float),('angle',numpy.float)]
+
+def readMaskRegions(regfiles):
+    '''
+    Reads every box region of one or more ds9 region files, e.g. all the masks
+    of a multi-mask campaign.
+    Input:
+    regfiles = [string or list of strings] name(s) of the ds9 region file(s),
+        see createSlitmaskMask for how the regions should be defined
+    Output:
+    boxes = [1D structured array] (xc,yc,width,height,angle) of each box, in
+        the order they appear in the region files
+    '''
+    if isinstance(regfiles,basestring):
+        regfiles = [regfiles]
+    boxes = [numpy.fromregex(regfile,_box_regex,_box_dtype) for regfile in regfiles]
+    boxes = numpy.concatenate(boxes)
+    if numpy.size(boxes) == 0:
+        print 'obsplan.readMaskRegions: error, no box regions found in {0}, exiting'.format(', '.join(regfiles))
+        sys.exit()
+    return boxes
 
 def readMaskRegion(regfile):
-    box = numpy.fromregex(regfile,r"box\(([0-9]*\.?[0-9]+),(-[0-9]*\.?[0-9]+),([0-9]*\.?[0-9]+)\",([0-9]*\.?[0-9]+)\",([0-9]*\.?[0-9]+)",
-                          [('xc',numpy.float),('yc',numpy.float),('width',numpy.float),('height',numpy.float),('angle',numpy.float)])
-    try:
-        box[0]
-    except IndexError:
-        print 'Assuming a positive declination region.'
-        box = numpy.fromregex(regfile,r"box\(([0-9]*\.?[0-9]+),([0-9]*\.?[0-9]+),([0-9]*\.?[0-9]+)\",([0-9]*\.?[0-9]+)\",([0-9]*\.?[0-9]+)",[('xc',numpy.float),('yc',numpy.float),('width',numpy.float),('height',numpy.float),('angle',numpy.float)])
-        
-    return box[0]
+    return readMaskRegions(regfile)[0]
 
-def createSlitmaskMask(regfile,ra,dec):
+def writeMaskRegion(regfile,box,color='green'):
     '''
+    Writes a mask box as a ds9 region file that readMaskRegion can read back.
     Input:
-    regfile = [string] name of the ds9 region file. Note region should be
-        defined using Coordinate/WCS/Degrees and Size/WCS/Arcmin options, with
-        the Size 5 by 16.1 arcmin, Angle will then correspond to the slitmask's
-        parallactic angle (i.e. +CCW from north towards east) with the guider
-        camera in the North-east quadrent at Angle=0.
+    regfile = [string] name of the region file to create
+    box = [record or tuple] (xc,yc,width,height,angle) of the mask box, units
+        (degrees,degrees,arcsec,arcsec,degrees)
+    '''
+    F = open(regfile,'w')
+    F.write('# Region file format: DS9 version 4.1\n')
+    F.write('global color={0} dashlist=8 3 width=1 font="helvetica 10 normal" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1\n'.format(color))
+    F.write('fk5\n')
+    F.write('box({0:0.6f},{1:0.6f},{2:0.3f}",{3:0.3f}",{4:0.3f})\n'
+            .format(box[0],box[1],box[2],box[3],box[4]))
+    F.close()
+
+def boxMask(box,ra,dec,index=None):
+    '''
+    Input:
+    box = [record or tuple] (xc,yc,width,height,angle) of the mask box as
+        returned by readMaskRegion, units (degrees,degrees,arcsec,arcsec,
+        degrees)
     ra = [1D array of floats; units:degrees] RA of the galaxies
     dec = [1D array of floats; units:degrees] Dec of the galaxies
+    index = [dictionary or None] skyindex index of (ra,dec). If given only the
+        galaxies within the box's bounding circle are tested, otherwise every
+        galaxy is tested. The returned mask is the same either way.
+    Output:
+    mask_slitmask = [1D boolean array] True for the galaxies inside the box
     '''
-    box = readMaskRegion(regfile)
+    if index is not None:
+        # the rotation into the box frame preserves distances, so a galaxy in
+        # the box is within half the box diagonal of its center in both axes
+        radius = numpy.sqrt(box[2]**2+box[3]**2)/(2*60**2)*(1+1e-9)
+        candidates = skyindex.boxCandidates(index,box[0],box[1],radius)
+        mask_slitmask = numpy.zeros(numpy.size(ra),dtype=bool)
+        mask_slitmask[candidates] = boxMask(box,ra[candidates],dec[candidates])
+        return mask_slitmask
     d2r = numpy.pi/180.0
     #phi is the ccw angle from the +North axis
     xc = box[0]
@@ -52,6 +103,20 @@ def createSlitmaskMask(regfile,ra,dec):
     mask_slitmask = mask_ramin*mask_ramax*mask_decmin*mask_decmax
     return mask_slitmask
 
+def createSlitmaskMask(regfile,ra,dec):
+    '''
+    Input:
+    regfile = [string] name of the ds9 region file. Note region should be
+        defined using Coordinate/WCS/Degrees and Size/WCS/Arcmin options, with
+        the Size 5 by 16.1 arcmin, Angle will then correspond to the slitmask's
+        parallactic angle (i.e. +CCW from north towards east) with the guider
+        camera in the North-east quadrent at Angle=0.
+    ra = [1D array of floats; units:degrees] RA of the galaxies
+    dec = [1D array of floats; units:degrees] Dec of the galaxies
+    '''
+    box = readMaskRegion(regfile)
+    return boxMask(box,ra,dec,skyindex.getIndex(ra,dec))
+
 def photoz_PriorityCode(z_cluster,gal_photoz,photo_z_err,plot_diag=False):
     '''
     INPUT:
@@ -69,10 +134,104 @@ def photoz_PriorityCode(z_cluster,gal_photoz,photo_z_err,plot_diag=False):
         plt.show()
     return wght
 
+def compileSampleRules(samplerules):
+    '''
+    Compiles a set of sample definitions over one or more catalog columns into
+    lookup tables, so that the whole catalog can be assigned to samples with
+    one searchsorted pass per column. The compiled rules do not depend on the
+    catalog and can be reused for every mask revision.
+    Input:
+    samplerules = [list of dictionaries] one dictionary per sample, in priority
+        order (sample 1 first). Each dictionary maps a catalog ttype name to the
+        (lower bound, upper bound) of that column for the sample, e.g.
+        ({'dered_r':(0,22.5),'z_phot':(0.25,0.5)},{'dered_r':(0,23)}). An
+        object is in a sample if lowerbound < value < upperbound for every
+        column of the sample. A bound of None is treated as unbounded.
+    Output:
+    rules = [dictionary] the compiled rule set, to be passed to
+        assignSampleRules
+    '''
+    N_sample = len(samplerules)
+    ttypes = sorted(set([ttype for rule in samplerules for ttype in rule]))
+    edges = {}
+    tables = {}
+    for ttype in ttypes:
+        lower = numpy.array([-numpy.inf if ttype not in rule or rule[ttype][0] == None else rule[ttype][0] for rule in samplerules],dtype=float)
+        upper = numpy.array([numpy.inf if ttype not in rule or rule[ttype][1] == None else rule[ttype][1] for rule in samplerules],dtype=float)
+        e = numpy.unique(numpy.concatenate((lower,upper)))
+        # The column values are divided into the open intervals between
+        # consecutive edges (even rows) and the edges themselves (odd rows),
+        # plus a final row for NaN values which never satisfy a bound.
+        table = numpy.zeros((2*numpy.size(e)+2,N_sample),dtype=bool)
+        left = numpy.concatenate(([-numpy.inf],e))
+        right = numpy.concatenate((e,[numpy.inf]))
+        table[0:-1:2,:] = numpy.logical_and(lower[numpy.newaxis,:] <= left[:,numpy.newaxis],
+                                            right[:,numpy.newaxis] <= upper[numpy.newaxis,:])
+        table[1:-1:2,:] = numpy.logical_and(lower[numpy.newaxis,:] < e[:,numpy.newaxis],
+                                            e[:,numpy.newaxis] < upper[numpy.newaxis,:])
+        # a NaN value only satisfies samples that place no bound on the column
+        table[-1,:] = [ttype not in rule for rule in samplerules]
+        edges[ttype] = e
+        tables[ttype] = table
+    return {'N_sample':N_sample,'ttypes':ttypes,'edges':edges,'tables':tables}
+
+def applySampleRules(rules,columns):
+    '''
+    Input:
+    rules = [dictionary] compiled rules returned by compileSampleRules
+    columns = [dictionary] maps each ttype name used by the rules to the 1D
+        array of that parameter for each target object
+    Output:
+    sample = [1D array of floats] the highest priority sample satisfied by each
+        object, or N_sample+1 if the object is in none of the samples
+    '''
+    N_sample = rules['N_sample']
+    insample = None
+    for ttype in rules['ttypes']:
+        param = numpy.asarray(columns[ttype],dtype=float)
+        e = rules['edges'][ttype]
+        lo = numpy.searchsorted(e,param,side='left')
+        hi = numpy.searchsorted(e,param,side='right')
+        code = 2*lo+(hi > lo)
+        code[numpy.isnan(param)] = 2*numpy.size(e)+1
+        if insample is None:
+            insample = rules['tables'][ttype][code]
+        else:
+            insample &= rules['tables'][ttype][code]
+    if insample is None:
+        # none of the samples place a bound on any column
+        N_gal = numpy.size(columns.values()[0]) if len(columns) != 0 else 0
+        insample = numpy.ones((N_gal,N_sample),dtype=bool)
+    # the first satisfied sample is the highest priority one, if for some
+    # reason the sample bounds are not all inclusive, assign by default the
+    # next highest sample.
+    sample = numpy.argmax(insample,axis=1)+1.
+    sample[~numpy.any(insample,axis=1)] = N_sample+1
+    return sample
+
+def assignSampleRules(rules,cat,key):
+    '''
+    Assigns each catalog object to a sample according to sample rules over
+    several catalog columns (e.g. magnitude, colour and photo-z).
+    Input:
+    rules = [dictionary] compiled rules returned by compileSampleRules
+    cat = [2D array] the catalog, as returned by tools.readcatalog
+    key = [dictionary] the ttype key of the catalog, as returned by
+        tools.readheader
+    Output:
+    sample = [1D array of floats] the sample of each object
+    '''
+    columns = dict([(ttype,cat[:,key[ttype]]) for ttype in rules['ttypes']])
+    return applySampleRules(rules,columns)
+
+# Compiled single parameter rules used by assignSample, keyed by samplebounds
+_samplebounds_cache = {}
+
 def assignSample(param_array,samplebounds):
     '''
-    Currently obsplan is only setup to break samples according to one object
-    variable (e.g. magnitude).  The sampel_param_ttype is the ttype name of the
+    Breaks the samples according to one object variable (e.g. magnitude), see
+    compileSampleRules and assignSampleRules for sample definitions over
+    several variables. The sampel_param_ttype is the ttype name of the
     vairable in the catalog to be used to make the sample division (e.g.
     magnitude). samplebounds defines the min and max of sample_param for each
     sample: e.g. (sample1 lowerbound, sample1 upperbound, sample2 lower bound,
@@ -85,24 +244,89 @@ def assignSample(param_array,samplebounds):
         number of samples, e.g: (sample1 lowerbound, sample1 upperbound
         sample2 lower bound,  sample2 upper bound, etc., etc.)
     '''
-    N_gal = numpy.size(param_array)
     # Make sure that samplebounds in input in pair
     if numpy.size(samplebounds)%2 != 0:
         print 'obsplan.assignSample: error, samplebounds must contain an lower and upper bound for each sample. An odd number of bounds detected. Exiting.'
         sys.exit()
-    N_sample = numpy.size(samplebounds)//2
-    # if for some reason the sample bounds are not all inclusive, assign the by
-    # default the next highest sample to all galaxies.
-    sample = numpy.ones(N_gal)*(N_sample+1)
-    # loop through each galaxy to see if it falls within a given sample bound
-    for i in numpy.arange(N_sample):
-        for j in numpy.arange(N_gal):
-            # Check if in lowest priority sample first, then overwrite if makes
-            # it in higher priority sample.
-            if param_array[j] > samplebounds[2*N_sample-2-2*i] and param_array[j] < samplebounds[2*N_sample-1-2*i]:
-                sample[j] = N_sample - i
-    return sample
-                
+    bounds = tuple(numpy.ravel(samplebounds))
+    if bounds not in _samplebounds_cache:
+        samplerules = [{'param':(bounds[2*i],bounds[2*i+1])} for i in range(len(bounds)//2)]
+        _samplebounds_cache[bounds] = compileSampleRules(samplerules)
+    return applySampleRules(_samplebounds_cache[bounds],{'param':param_array})
+
+# Sorted objid indexes built by objidIndex, keyed by the id() of the catalog
+# objid array so that every mask planned in a session reuses the same index
+_objid_index_cache = {}
+
+def objidIndex(objid):
+    '''
+    Builds (or fetches from the session cache) a sorted index of the catalog
+    object id's, so that id lists can be resolved with a single searchsorted
+    call instead of one full catalog comparison per id.
+    Input:
+    objid = [1D array int] object id's of the target catalog
+    Output:
+    index = [dictionary] 'order' is the argsort of objid, 'sorted' the objid
+        values in sorted order and 'N' the catalog length
+    '''
+    cached = _objid_index_cache.get(id(objid))
+    # the stored reference to objid keeps its id() from being reused
+    if cached != None and cached[0] is objid and cached[1]['N'] == numpy.size(objid):
+        return cached[1]
+    order = numpy.argsort(objid,kind='mergesort')
+    index = {'order':order,'sorted':numpy.asarray(objid)[order],
+             'N':numpy.size(objid)}
+    if len(_objid_index_cache) >= 8:
+        _objid_index_cache.clear()
+    _objid_index_cache[id(objid)] = (objid,index)
+    return index
+
+def matchObjid(objid,idlist):
+    '''
+    Matches a list of object id's against the catalog object id's in one
+    vectorized pass.
+    Input:
+    objid = [1D array int] object id's of the target catalog
+    idlist = [1D array int] object id's to locate in the catalog
+    Output:
+    mask_match = [1D boolean array] True for each catalog object whose id is in
+        idlist (all copies of a duplicated catalog id are flagged)
+    unmatched = [1D array int] the id's in idlist that are not in the catalog
+    '''
+    index = objidIndex(objid)
+    idlist = numpy.atleast_1d(idlist)
+    mask_match = numpy.zeros(index['N'],dtype=bool)
+    if numpy.size(idlist) == 0 or index['N'] == 0:
+        return mask_match, idlist
+    lo = numpy.searchsorted(index['sorted'],idlist,side='left')
+    hi = numpy.searchsorted(index['sorted'],idlist,side='right')
+    found = hi > lo
+    # flag the catalog entries in the sorted range [lo,hi) of each found id
+    counts = (hi-lo)[found]
+    starts = numpy.repeat(lo[found],counts)
+    offsets = numpy.arange(numpy.sum(counts))-numpy.repeat(numpy.cumsum(counts)-counts,counts)
+    mask_match[index['order'][starts+offsets]] = True
+    return mask_match, idlist[~found]
+
+def readIDList(idfile,idobjid_ttype):
+    '''
+    Reads the objid column of a ttype catalog, e.g. an exclusion or
+    preselection list.
+    Input:
+    idfile = ['string'] ttype catalog
+    idobjid_ttype = ['string'] ttype name of the objid column in idfile
+    Output:
+    idlist = [1D array] the objid's listed in idfile
+    '''
+    return catcache.loadcolumn(idfile,idobjid_ttype)
+
+def reportUnmatched(unmatched,listname):
+    '''
+    Prints the id's of an id list that do not match any catalog objid.
+    '''
+    if numpy.size(unmatched) != 0:
+        print 'obsplan: warning, {0} id(s) in {1} do not match any catalog objid:'.format(numpy.size(unmatched),listname)
+        print ' '.join(['{0:0.0f}'.format(oid) for oid in unmatched])
 
 def assignSelectionFlag(objid,psfile=None,psobjid_ttype=None):
     '''
@@ -119,19 +343,11 @@ def assignSelectionFlag(objid,psfile=None,psobjid_ttype=None):
     sflag = numpy.zeros(numpy.size(objid))    
 
     if psfile != None:
-        #read in the preselection catalog and header
-        pskey = tools.readheader(psfile)
+        #read in the preselection catalog
         print 'obsplan: determining preselections'
-        pslist = numpy.loadtxt(psfile,usecols=(pskey[psobjid_ttype],pskey[psobjid_ttype]))
-        i = 0
-        for oid in pslist[:,0]:
-            if i == 0:
-                sflag = objid == oid
-                i=1
-            else:
-                mask_i = objid == oid
-                sflag += mask_i
-                i += 1    
+        pslist = readIDList(psfile,psobjid_ttype)
+        sflag, unmatched = matchObjid(objid,pslist)
+        reportUnmatched(unmatched,psfile)
         print 'obsplan: {0} slits preselected'.format(numpy.sum(sflag))
     # Since want a list of zeros and 1's need to convert bool array
     sflag = sflag*numpy.ones(numpy.size(sflag))
@@ -149,54 +365,85 @@ def createExclusionMask(objid,exfile,exobjid_ttype):
         corresponding False value
     '''
     print 'obsplan: apply exclusion list to further filter catalog'
-    exkey = tools.readheader(exfile)
-    exlist = numpy.loadtxt(exfile,usecols=(exkey[exobjid_ttype],exkey[exobjid_ttype]))
-    mask_ex = numpy.zeros(numpy.size(objid))
-    i = 0
-    for oid in exlist[:,0]:
-        if i == 0:
-            mask_ex = objid == oid
-            i=1
-        else:
-            mask_i = objid == oid
-            mask_tmp = mask_ex+mask_i
-            mask_ex = mask_tmp > 0
+    exlist = readIDList(exfile,exobjid_ttype)
+    mask_ex, unmatched = matchObjid(objid,exlist)
+    reportUnmatched(unmatched,exfile)
+    print 'obsplan: {0} objects excluded'.format(numpy.sum(mask_ex))
     mask_ex = mask_ex == False
     return mask_ex
 
+def _scalarOrArray(x):
+    # return a python float for scalar input, as the math based versions did
+    if numpy.ndim(x) == 0:
+        return float(x)
+    return x
+
 def objectPA(H,delta,phi=19.82525):
     '''
     This function calculates the paralactic angle (PA) of an astronomical object
     a the instant of its given hour angle (H), the declination of the object 
     (delta), and the geographical latitude of the observer (phi). The
     calculation is based on Equation 14.1 of Jean Meeus' Astronomical
-    Algorithms (2nd edition).
+    Algorithms (2nd edition). The inputs may be arrays, in which case they are
+    broadcast against each other (e.g. H[numpy.newaxis,:] and
+    delta[:,numpy.newaxis] give a Dec x HA grid).
     
     Input:
-    H = [float; units=hours] object's hour angle (H is + if west of the meridian)
-    delta = [float; units=degrees] object's declination
-    phi = [float; units=degrees] observers latitude, defaults to Mauna Kea
+    H = [float or array; units=hours] object's hour angle (H is + if west of
+        the meridian)
+    delta = [float or array; units=degrees] object's declination
+    phi = [float or array; units=degrees] observers latitude, defaults to
+        Mauna Kea
     
     Output:
     parallactic angle of the object (-180 to 180 degrees) measured + from north
     ccw towards east
     '''
-    from math import atan, tan, cos, sin, pi
-    d2r = pi/180.
-    phi *= d2r    
-    H = H*15*d2r
-    delta *= d2r
-    if H < 0:
-        sign = -1
-        H = -H
-    else:
-        sign = 1  
-    denom = tan(phi)*cos(delta)-sin(delta)*cos(H)
-    q = atan(sin(H)/denom)
+    d2r = numpy.pi/180.
+    phi = numpy.asarray(phi,dtype=float)*d2r
+    H = numpy.asarray(H,dtype=float)*15*d2r
+    delta = numpy.asarray(delta,dtype=float)*d2r
+    sign = numpy.where(H < 0,-1,1)
+    H = numpy.where(H < 0,-H,H)
+    denom = numpy.tan(phi)*numpy.cos(delta)-numpy.sin(delta)*numpy.cos(H)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        q = numpy.arctan(numpy.sin(H)/denom)
     q = q/d2r
-    if denom < 0:
-        q += 180
-    return sign*q
+    q = numpy.where(denom < 0,q+180,q)
+    return _scalarOrArray(sign*q)
+
+def constrainSlitPA(pa_mask,pa_obj,relPA_min=5,relPA_max=30):
+    '''
+    Determines the best allowable slit PA given the object's parallactic
+    angle and the bounds placed on the slit orientation with respect to the
+    slitmask, see optimalPA. The inputs may be arrays and are broadcast
+    against each other.
+    
+    Input:
+    pa_mask = [float or array; units=degrees] parallactic angle of the mask
+        (0 to 360 degrees)
+    pa_obj = [float or array; units=degrees] parallactic angle of the object
+        (-180 to 180 degrees)
+    relPA_min, relPA_max = [float; units=degrees] see optimalPA
+    '''
+    pa_mask = numpy.asarray(pa_mask,dtype=float)
+    pa_obj = numpy.asarray(pa_obj,dtype=float)
+    # due to symmetery we can simplify the problem
+    pa_obj = numpy.where(pa_obj < 0,pa_obj+180,pa_obj)
+    # we do not want to redefine pa_mask since it is not really symmetric
+    # due to the offcenter guider cam and other asymmetries
+    pa_mask_prime = numpy.where(pa_mask > 180,pa_mask-180,pa_mask)
+    
+    # Determine the best allowable slit PA, on either side of the mask PA
+    diff = pa_mask_prime-pa_obj
+    pa_slit_below = numpy.where(diff < relPA_min,pa_mask_prime-relPA_min,
+                                numpy.where(diff < relPA_max,pa_obj,
+                                            pa_mask_prime-relPA_max))
+    pa_slit_above = numpy.where(-diff < relPA_min,pa_mask_prime+relPA_min,
+                                numpy.where(-diff < relPA_max,pa_obj,
+                                            pa_mask_prime+relPA_max))
+    pa_slit = numpy.where(pa_mask_prime >= pa_obj,pa_slit_below,pa_slit_above)
+    return _scalarOrArray(pa_slit)
 
 def optimalPA(pa_mask,H,delta,phi=19.82525,relPA_min=5,relPA_max=30):
     '''
@@ -208,22 +455,24 @@ def optimalPA(pa_mask,H,delta,phi=19.82525,relPA_min=5,relPA_max=30):
     by the angle + from north toward east) should equal the parallactic angle
     of the object. This is not always possible given the bounds placed on the
     slit orentation with respect to the slitmask, thus this funciton determines
-    the best possible slit position angle with respect to the slitmask.
+    the best possible slit position angle with respect to the slitmask. The
+    inputs may be arrays (e.g. per object declinations and a night's worth of
+    hour angles) and are broadcast against each other.
     
     Input:
-    pa_mask = [float; units=degrees] parallactic angle of the mask    
-    H = [float; units=hours] object's hour angle (H is + if west of the meridian)
-    delta = [float; units=degrees] object's declination
+    pa_mask = [float or array; units=degrees] parallactic angle of the mask
+    H = [float or array; units=hours] object's hour angle (H is + if west of
+        the meridian)
+    delta = [float or array; units=degrees] object's declination
     phi = [float; units=degrees] observers latitude, defaults to Mauna Kea
     relPA_min = [float; units=degrees] minimum absolute angle between the slit
        pa and the mask pa
     relPA_max = [float; units=degrees] maximum absolute angle between the slit
        pa and the mask pa
     '''
-    from math import pi,sin,cos,asin
     # test that pa_mask is defined between 0 and 360 degrees
-    test_pa_mask = numpy.logical_and(pa_mask >= 0, pa_mask <= 360)
-    if ~test_pa_mask:
+    test_pa_mask = numpy.logical_and(numpy.asarray(pa_mask) >= 0, numpy.asarray(pa_mask) <= 360)
+    if numpy.any(~test_pa_mask):
         print 'obsplan.optimalPA: error, mask_pa must be defined between 0 and 360 degrees,check that ds9 mask region is defined appropriately, exiting'
         sys.exit()
         
@@ -231,37 +480,144 @@ def optimalPA(pa_mask,H,delta,phi=19.82525,relPA_min=5,relPA_max=30):
     pa_obj = objectPA(H,delta,phi)
     
     # test to make sure that the pa_obj is in the range -180 to 180 degrees
-    test_pa_obj = numpy.logical_and(pa_obj >=-180, pa_obj <= 180)
-    if ~test_pa_obj:
+    test_pa_obj = numpy.logical_and(numpy.asarray(pa_obj) >=-180, numpy.asarray(pa_obj) <= 180)
+    if numpy.any(~test_pa_obj):
         print 'obsplan.optimalPA: error, the pa_obj returned from objectPA is not in the expected range of -180 to 180 degrees, exiting'
         sys.exit()
-        
-    # due to symmetery we can simplify the problem
-    if pa_obj < 0:
-        pa_obj += 180
-    if pa_mask > 180:
-        # we do not want to redefine pa_mask since it is not really symmetric
-        # due to the offcenter guider cam and other asymmetries
-        pa_mask_prime = pa_mask-180
-    else:
-        pa_mask_prime = pa_mask
     
-    # Determine the best allowable slit PA
-    if pa_mask_prime >= pa_obj:
-        if pa_mask_prime-pa_obj < relPA_min:
-            pa_slit = pa_mask_prime-relPA_min
-        elif pa_mask_prime-pa_obj < relPA_max:
-            pa_slit = pa_obj
-        else:
-            pa_slit = pa_mask_prime-relPA_max
-    elif pa_mask_prime < pa_obj:
-        if pa_obj-pa_mask_prime < relPA_min:
-            pa_slit = pa_mask_prime+relPA_min
-        elif pa_obj-pa_mask_prime < relPA_max:
-            pa_slit = pa_obj
-        else:
-            pa_slit = pa_mask_prime+relPA_max
-    return pa_slit
+    return constrainSlitPA(pa_mask,pa_obj,relPA_min,relPA_max)
+
+def utToHA(ut,date,ra,longitude=-155.47472):
+    '''
+    Converts universal time to the hour angle of an object, using the
+    Greenwich mean sidereal time of Equation 12.4 of Jean Meeus' Astronomical
+    Algorithms (2nd edition).
+
+    Input:
+    ut = [float or array; units=hours] universal time, may exceed 24 for a
+        night that runs past 0h UT
+    date = [(int,int,int)] (year, month, day) UT date at which ut is 0h
+    ra = [float or array; units=degrees] object's right ascension
+    longitude = [float; units=degrees] observers longitude (+ east of
+        Greenwich), defaults to Keck
+
+    Output:
+    hour angle of the object (-12 to 12 hours, + if west of the meridian)
+    '''
+    year, month, day = date
+    if month <= 2:
+        year -= 1
+        month += 12
+    A = year//100
+    B = 2-A+A//4
+    # Julian day at 0h UT of the date (Equation 7.1)
+    JD0 = numpy.floor(365.25*(year+4716))+numpy.floor(30.6001*(month+1))+day+B-1524.5
+    JD = JD0+numpy.asarray(ut,dtype=float)/24.
+    T = (JD-2451545.0)/36525.
+    gmst = (280.46061837+360.98564736629*(JD-2451545.0)+
+            0.000387933*T**2-T**3/38710000.)
+    H = (gmst+longitude-numpy.asarray(ra,dtype=float))/15.
+    return _scalarOrArray((H+12.) % 24.-12.)
+
+def windowHA(HA_start,HA_end,dH):
+    '''
+    Returns the hour angle samples (units=hours) of an exposure window from
+    HA_start to HA_end (inclusive) spaced by at most dH.
+    '''
+    if HA_end < HA_start:
+        print 'obsplan.windowHA: error, HA_end is before HA_start, exiting'
+        sys.exit()
+    N = int(numpy.ceil((HA_end-HA_start)/float(dH)-1e-9))+1
+    return numpy.linspace(HA_start,HA_end,max(N,2))
+
+def refractionLoss(pa_slit,H,delta,phi=19.82525,table=None):
+    '''
+    Relative slit loss due to atmospheric differential refraction, i.e. the
+    displacement of the object perpendicular to the slit, which following
+    Filippenko (1982, see optimalPA) scales as tan(z)*|sin(pa_slit-q)| with z
+    the zenith distance and q the parallactic angle of the object. The inputs
+    may be arrays and are broadcast against each other.
+
+    Input:
+    pa_slit = [float or array; units=degrees] slit PA
+    H = [float or array; units=hours] object's hour angle
+    delta = [float or array; units=degrees] object's declination
+    phi = [float; units=degrees] observers latitude, defaults to Mauna Kea
+    table = [dictionary or None] patable table of phi, if given the
+        parallactic angle is interpolated from it
+
+    Output:
+    loss = [float or array] tan(z)*|sin(pa_slit-q)|, NaN for an object below
+        the horizon
+    '''
+    d2r = numpy.pi/180.
+    cosz = (numpy.sin(phi*d2r)*numpy.sin(numpy.asarray(delta,dtype=float)*d2r)+
+            numpy.cos(phi*d2r)*numpy.cos(numpy.asarray(delta,dtype=float)*d2r)*
+            numpy.cos(numpy.asarray(H,dtype=float)*15*d2r))
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        tanz = numpy.where(cosz > 0,numpy.sqrt(1-cosz**2)/cosz,numpy.nan)
+    if table is None:
+        q = numpy.asarray(objectPA(H,delta,phi))*d2r
+        cosq = numpy.cos(q)
+        sinq = numpy.sin(q)
+    else:
+        import patable
+        expq = patable.tableExpPA(table,H,delta)
+        cosq = expq.real
+        sinq = expq.imag
+    pa_slit = numpy.asarray(pa_slit,dtype=float)*d2r
+    # sin(pa_slit-q) expanded, so that the trigonometry of pa_slit and q is
+    # only evaluated once each
+    return _scalarOrArray(tanz*numpy.abs(numpy.sin(pa_slit)*cosq-numpy.cos(pa_slit)*sinq))
+
+def optimalPAWindow(pa_mask,HA,delta,ra_offset=0,phi=19.82525,relPA_min=5,
+                    relPA_max=30,dPA=1.,table=None):
+    '''
+    Time resolved version of optimalPA. Rather than aligning the slits with
+    the parallactic angle at a single hour angle, the slit PA is chosen to
+    minimize the differential refraction loss (see refractionLoss) integrated
+    over the whole exposure window and summed over the objects of the mask.
+    Every allowed slit PA (in steps of dPA, on either side of the mask PA) is
+    evaluated for every object and hour angle in a single vectorized batch.
+
+    Input:
+    pa_mask = [float; units=degrees] parallactic angle of the mask
+    HA = [1D array; units=hours] hour angles of the mask center sampling the
+        exposure window, see windowHA and utToHA
+    delta = [float or 1D array; units=degrees] declination of the objects
+    ra_offset = [float or 1D array; units=degrees] RA of the objects minus the
+        RA of the mask center, shifts the hour angle of each object
+    phi = [float; units=degrees] observers latitude, defaults to Mauna Kea
+    relPA_min, relPA_max = [float; units=degrees] see optimalPA
+    dPA = [float; units=degrees] spacing of the candidate slit PAs
+    table = [dictionary or None] patable table of phi, see refractionLoss
+
+    Output:
+    pa_slit = [float; units=degrees] the slit PA with the least loss
+    loss = [1D array] window averaged loss of each object at pa_slit
+    '''
+    if pa_mask < 0 or pa_mask > 360:
+        print 'obsplan.optimalPAWindow: error, mask_pa must be defined between 0 and 360 degrees,check that ds9 mask region is defined appropriately, exiting'
+        sys.exit()
+    # the allowed slit PAs on either side of the mask PA, see constrainSlitPA
+    pa_mask_prime = pa_mask-180 if pa_mask > 180 else pa_mask
+    relPA = numpy.arange(relPA_min,relPA_max+1e-9,dPA)
+    if relPA[-1] < relPA_max:
+        relPA = numpy.append(relPA,relPA_max)
+    candidates = numpy.concatenate((pa_mask_prime-relPA[::-1],pa_mask_prime+relPA))
+    # objects x hour angles
+    delta = numpy.atleast_1d(numpy.asarray(delta,dtype=float))[:,numpy.newaxis]
+    H = (numpy.asarray(HA,dtype=float)[numpy.newaxis,:]-
+         numpy.atleast_1d(numpy.asarray(ra_offset,dtype=float))[:,numpy.newaxis]/15.)
+    # candidates x objects x hour angles
+    loss = refractionLoss(candidates[:,numpy.newaxis,numpy.newaxis],H,delta,phi,table)
+    above = numpy.isfinite(loss[0])
+    if not numpy.all(above):
+        print 'obsplan.optimalPAWindow: warning, objects are below the horizon during part of the window, these samples are ignored'
+    with numpy.errstate(invalid='ignore'):
+        loss_obj = numpy.nansum(loss,axis=2)/numpy.sum(above,axis=1)
+    best = numpy.argmin(numpy.nansum(loss_obj,axis=1))
+    return candidates[best], loss_obj[best]
 
 def slitsize(pa_slit,sky,A_gal,B_gal=None,pa_gal=None):
     '''
@@ -291,12 +647,15 @@ def slitsize(pa_slit,sky,A_gal,B_gal=None,pa_gal=None):
     return len1, len2
     
 
-def write_dsim_header(F,regfile,prefix):
+def write_dsim_header(F,regfile,prefix,box=None):
     '''
     F = an opened file (e.g. F=open(filename,'w')
-    box = 
+    regfile = [string] name of the ds9 region file of the mask
+    box = [record or None] the mask box as returned by readMaskRegion, if given
+        regfile is not read
     '''
-    box = readMaskRegion(regfile)
+    if box is None:
+        box = readMaskRegion(regfile)
     F.write('#This catalog was created by obsplan.py and is intended to be used \n')
     F.write('#as input to the deimos slitmask software following the format \n')
     F.write('#outlined at http://www.ucolick.org/~phillips/deimos_ref/masks.html\n')
@@ -355,39 +714,61 @@ def write_align_stars(F,as_ids,objid,ra,dec,magnitude,equinox='2000',passband='R
         F.write('{0}  {1}  {2}  {3}  {4:0.2f}  {5}  -2  0  1\n'
                 .format(i,ra_i,dec_i,equinox,mag_i,passband)) 
 
-def write_galaxies_to_dsim(F,objid,ra,dec,magnitude,priority_code,sample,selectflag,pa_slit,len1,len2,equinox='2000',passband='R'):
+def write_galaxies_to_dsim(F,objid,ra,dec,magnitude,priority_code,sample,selectflag,pa_slit,len1,len2,equinox='2000',passband='R',chunksize=50000):
     '''
-    
+    Writes the galaxy lines of the dsim input catalog. The sexagesimal
+    conversion is done on whole arrays and the lines are formatted and written
+    in blocks of chunksize galaxies, each with a single F.write call.
+    Input:
+    F = an opened file (e.g. F=open(filename,'w'))
+    objid, ra, dec, magnitude, priority_code, sample, selectflag, len1, len2 =
+        [1D arrays] the dsim columns of each galaxy (ra, dec in degrees)
+    pa_slit = [float or 1D array; units:degrees] slit position angle(s)
+    chunksize = [int] number of galaxies formatted per write
     '''
-    from math import floor
-    for i in numpy.arange(numpy.size(objid)):
-        #convert deg RA to sexadec RA
-        ra_i = ra[i]/15.0
-        rah = floor(ra_i)
-        res = (ra_i-rah)*60
-        ram = floor(res)
-        ras = (res-ram)*60.
-        #convert deg dec to sexadec dec
-        dec_i = dec[i]
-        if dec_i<0:
-            sign = -1.
-            dec_i = abs(dec_i)
-        else:
-            sign = 1.
-        decd = floor(dec_i)
-        res = (dec_i-decd)*60.
-        decm = floor(res)
-        decs = (res-decm)*60.
-        if numpy.size(pa_slit) == 1:
-            pa_slit_i = pa_slit
-        else:
-            pa_slit_i = pa_slit[i]
-        if sign==-1:
-            F.write('{0:0.0f}\t{1:02.0f}:{2:02.0f}:{3:06.3f}\t-{4:02.0f}:{5:02.0f}:{6:06.3f}\t{7}\t{8:0.2f}\t{9}\t{10:0.0f}\t{11:0.0f}\t{12:0.0f}\t{13:0.2f}\t{14:0.1f}\t{15:0.1f}\n'
-                    .format(objid[i],rah,ram,ras,decd,decm,decs,equinox,magnitude[i],passband,priority_code[i],sample[i],selectflag[i],pa_slit_i,len1[i],len2[i]))
-        else:
-            F.write('{0:0.0f}\t{1:02.0f}:{2:02.0f}:{3:06.3f}\t{4:02.0f}:{5:02.0f}:{6:06.3f}\t{7}\t{8:0.2f}\t{9}\t{10:0.0f}\t{11:0.0f}\t{12:0.0f}\t{13:0.2f}\t{14:0.1f}\t{15:0.1f}\n'
-                    .format(objid[i],rah,ram,ras,decd,decm,decs,equinox,magnitude[i],passband,priority_code[i],sample[i],selectflag[i],pa_slit_i,len1[i],len2[i]))
+    N = numpy.size(objid)
+    #convert deg RA to sexadec RA
+    ra_h = numpy.asarray(ra,dtype=float)/15.0
+    rah = numpy.floor(ra_h)
+    res = (ra_h-rah)*60
+    ram = numpy.floor(res)
+    ras = (res-ram)*60.
+    #convert deg dec to sexadec dec, the sign is written separately so that
+    #e.g. -0.5 deg becomes -00:30:00.000
+    dec = numpy.asarray(dec,dtype=float)
+    negative = dec < 0
+    dec_abs = numpy.where(negative,-dec,dec)
+    decd = numpy.floor(dec_abs)
+    res = (dec_abs-decd)*60.
+    decm = numpy.floor(res)
+    decs = (res-decm)*60.
+    sign = numpy.where(negative,'-','')
+    if numpy.size(pa_slit) == 1:
+        pa_slit = numpy.ones(N)*numpy.ravel(pa_slit)[0]
+    line = ('%0.0f\t%02.0f:%02.0f:%06.3f\t%s%02.0f:%02.0f:%06.3f\t%s'
+            +'\t%0.2f\t%s\t%0.0f\t%0.0f\t%0.0f\t%0.2f\t%0.1f\t%0.1f\n')
+    columns = (objid,rah,ram,ras,sign,decd,decm,decs,magnitude,priority_code,
+               sample,selectflag,pa_slit,len1,len2)
+    for start in range(0,N,chunksize):
+        chunk = [numpy.asarray(col)[start:start+chunksize].tolist() for col in columns]
+        # equinox and passband are the same for every galaxy
+        n = len(chunk[0])
+        chunk.insert(8,[str(equinox)]*n)
+        chunk.insert(10,[str(passband)]*n)
+        rows = zip(*chunk)
+        F.write(''.join([line % row for row in rows]))
+
+def writeRefractionLoss(filename,objid,loss):
+    '''
+    Writes the window averaged differential refraction loss of each object
+    (see optimalPAWindow) as a ttype catalog.
+    '''
+    F = open(filename,'w')
+    F.write('#ttype1 = objID\n')
+    F.write('#ttype2 = dar_loss\n')
+    for i in range(numpy.size(objid)):
+        F.write('{0:0.0f}\t{1:0.4f}\n'.format(objid[i],loss[i]))
+    F.close()
 
 def makeSlitmaskRegion(prefix,ra,dec,pa_slit,length,sample,width=1):
     '''
@@ -411,7 +792,406 @@ def makeSlitmaskRegion(prefix,ra,dec,pa_slit,length,sample,width=1):
             color = 'blue'
         out.write('box({0:1.5f},{1:1.5f},{2:1.1f}",{3:1.1f}",{4:0.0f}) # color={5}'.format(ra_i,dec_i,width,length_i,pa_slit_i,color)+'\n')
     out.close()
-    
+
+def planMask(box,prefix,columns,HA,sky,gs_ids=None,as_ids=None,equinox='2000',passband='R',HA_window=None,on_mask_preselect=False):
+    '''
+    Creates the dsim input catalog (prefix_maskcat.txt) and the slit region
+    file (prefix_slits.reg) of a single mask. Everything that does not depend
+    on the mask (priority codes, samples, preselection and catalog filtering)
+    is computed once beforehand and passed in through columns.
+    Input:
+    box = [record] the mask box as returned by readMaskRegion
+    prefix = [string] prefix of the mask's output files
+    columns = [dictionary] catalog arrays, with keys
+        'objid','ra','dec','mag' = object id, RA, Dec (degrees) and magnitude
+        'priority_code','sample','selectflag' = as returned by
+            photoz_PriorityCode, assignSample and assignSelectionFlag
+        'mask' = [1D boolean array] galaxy, magnitude and exclusion filter of
+            the catalog, excluding the slitmask footprint
+        'A_gal','B_gal','pa_gal' = galaxy size inputs of slitsize (B_gal and
+            pa_gal may be None)
+        'sky_order' = (optional) the skyindex declination order of the
+            catalog, to avoid sorting it again
+    HA = [float; units=hours] hour angle of the mask
+    sky = [(float,float); units:arcsec] sky on either side of the galaxy
+    gs_ids, as_ids = [list of ints or None] guide and alignment star id's
+    HA_window = [(float,float,float) or None; units=hours] (HA_start, HA_end,
+        dH) exposure window of the mask. If given the slit PA minimizes the
+        differential refraction loss over the window (see optimalPAWindow)
+        instead of being optimal at HA, and the window averaged loss of each
+        galaxy is written to prefix_dar.txt
+    on_mask_preselect = [boolean] only force the preselected galaxies that lie
+        on the mask into the dsim catalog, rather than every preselected
+        galaxy of the catalog. planMasks sets it when it plans several masks,
+        so that each preselected galaxy is only written to the masks it is on
+    Output:
+    N = [int] number of galaxies written to the dsim catalog
+    '''
+    objid = columns['objid']
+    ra = columns['ra']
+    dec = columns['dec']
+    mag = columns['mag']
+    selectflag = columns['selectflag']
+    # Filter the galaxy catalog to the slitmask, but include any preselected
+    # galaxies (of the slitmask) that might be excluded by the catalog filter
+    mask_slitmask = boxMask(box,ra,dec,skyindex.getIndex(ra,dec,columns.get('sky_order')))
+    preselected = selectflag
+    if on_mask_preselect:
+        preselected = numpy.logical_and(selectflag,mask_slitmask)
+    mask = numpy.logical_or(columns['mask']*mask_slitmask,preselected)
+    # Determine the optimal slit PA from the mask declination and PA
+    if HA_window is None:
+        pa_slit = optimalPA(box[4],HA,box[1])
+    else:
+        ra_offset = (ra[mask]-box[0]+180.) % 360.-180.
+        pa_slit, loss = optimalPAWindow(box[4],windowHA(*HA_window),dec[mask],ra_offset)
+        writeRefractionLoss(prefix+'_dar.txt',objid[mask],loss)
+        print 'obsplan: {0}, slit PA {1:0.1f} minimizes the refraction loss over HA {2} to {3} h, mean loss {4:0.3f}, max loss {5:0.3f}'.format(prefix,pa_slit,HA_window[0],HA_window[1],numpy.nanmean(loss),numpy.nanmax(loss))
+    # Determine the slit size of the galaxies on the mask
+    B_gal = columns['B_gal']
+    pa_gal = columns['pa_gal']
+    if B_gal is not None:
+        B_gal = B_gal[mask]
+    if pa_gal is not None:
+        pa_gal = pa_gal[mask]
+    len1, len2 = slitsize(pa_slit,sky,columns['A_gal'][mask],B_gal,pa_gal)
+
+    outcatname = prefix+'_maskcat.txt'
+    print 'started to write out to ', outcatname
+    F = open(outcatname,'w')
+    write_dsim_header(F,None,prefix,box=box)
+    if gs_ids is not None:
+        write_guide_stars(F,gs_ids,objid,ra,dec,mag,equinox,passband)
+    if as_ids is not None:
+        write_align_stars(F,as_ids,objid,ra,dec,mag,equinox,passband)
+    write_galaxies_to_dsim(F,objid[mask],ra[mask],dec[mask],mag[mask],
+                           columns['priority_code'][mask],columns['sample'][mask],
+                           selectflag[mask],pa_slit,len1,len2,equinox=equinox,
+                           passband=passband)
+    F.close()
+
+    # Create the target galaxy slit region file
+    makeSlitmaskRegion(prefix,ra[mask],dec[mask],pa_slit,len1+len2,
+                       columns['sample'][mask],width=1)
+    # Report how many slits dsim can be expected to allocate
+    selected = allocateSlits(box,ra[mask],dec[mask],columns['priority_code'][mask],
+                             columns['sample'][mask],selectflag[mask],pa_slit,len1,len2)
+    print 'obsplan: {0}, about {1} of the {2} galaxies can be allocated a slit'.format(prefix,numpy.sum(selected),numpy.sum(mask))
+    return numpy.sum(mask)
+
+def allocateSlits(box,ra,dec,priority_code,sample,selectflag,pa_slit,len1,len2,gap=0.35):
+    '''
+    Emulates the dsimulator slit allocation, so that a target selection can be
+    checked without a round trip through dsim. The targets inside the mask
+    are projected onto the mask's spatial (long) axis, where each slit covers
+    len1 and len2 on either side of its target, projected along the slit PA.
+    Slits are then taken in the dsim selection order: preselected targets
+    first, then sample 1, sample 2, etc., and by decreasing priority_code
+    within a sample. A slit is kept if it does not overlap (within gap) a slit
+    already kept and it fits within the mask length.
+    Input:
+    box = [record or tuple] the mask box as returned by readMaskRegion
+    ra, dec = [1D arrays of floats; units:degrees] target coordinates
+    priority_code, sample, selectflag = [1D arrays] as written to the dsim
+        input catalog
+    pa_slit = [float or 1D array; units:degrees] slit position angle(s)
+    len1, len2 = [1D arrays of floats; units:arcsec] slit length on the +PA
+        and -PA side of the target, as returned by slitsize
+    gap = [float; units:arcsec] minimum separation between slits
+    Output:
+    selected = [1D boolean array] True for the targets that get a slit
+    '''
+    d2r = numpy.pi/180.0
+    N = numpy.size(ra)
+    selected = numpy.zeros(N,dtype=bool)
+    inmask = boxMask(box,ra,dec)
+    # position along the mask's long axis (arcsec), see boxMask
+    phi = box[4]*d2r
+    s = (-(ra-box[0])*numpy.cos(box[1]*d2r)*numpy.sin(-phi)+(dec-box[1])*numpy.cos(-phi))*60**2
+    # projection of the slit length onto the long axis
+    proj = numpy.cos((pa_slit-box[4])*d2r)*numpy.ones(N)
+    lower = s+numpy.minimum(len1*proj,-len2*proj)
+    upper = s+numpy.maximum(len1*proj,-len2*proj)
+    inmask *= (lower >= -box[3]/2.)*(upper <= box[3]/2.)
+    candidates = numpy.flatnonzero(inmask)
+    # dsim selection order, numpy.lexsort sorts by the last key first
+    order = numpy.lexsort((-numpy.asarray(priority_code)[candidates],
+                           numpy.asarray(sample)[candidates],
+                           numpy.asarray(selectflag)[candidates] == 0))
+    # the slits kept so far, as sorted non-overlapping intervals
+    starts = []
+    ends = []
+    for i in candidates[order]:
+        lo = lower[i]-gap
+        hi = upper[i]+gap
+        k = bisect.bisect_left(starts,lo)
+        if k > 0 and ends[k-1] > lo:
+            continue
+        if k < len(starts) and starts[k] < hi:
+            continue
+        starts.insert(k,lower[i])
+        ends.insert(k,upper[i])
+        selected[i] = True
+    return selected
+
+def _shareColumns(columns,tmpdir):
+    '''
+    Saves the catalog arrays as .npy files in tmpdir so that worker processes
+    can memory-map them instead of receiving a pickled copy per mask. Returns
+    the dictionary of file names (None for columns that are None).
+    '''
+    shared = {}
+    for name in columns:
+        if columns[name] is None:
+            shared[name] = None
+        else:
+            shared[name] = os.path.join(tmpdir,name+'.npy')
+            numpy.save(shared[name],numpy.ascontiguousarray(columns[name]))
+    return shared
+
+def _planMaskWorker(task):
+    '''
+    Process pool worker of planMasks, plans one mask from the shared columns.
+    '''
+    i,box,prefix,shared,HA,sky,gs_ids,as_ids,equinox,passband,HA_window,on_mask_preselect = task
+    start = time.time()
+    columns = {}
+    for name in shared:
+        if shared[name] is None:
+            columns[name] = None
+        else:
+            columns[name] = numpy.load(shared[name],mmap_mode='r')
+    try:
+        N = planMask(box,prefix,columns,HA,sky,gs_ids,as_ids,equinox,passband,HA_window,on_mask_preselect)
+    except SystemExit:
+        # planMask exits on input errors (after printing them), which would
+        # kill the worker and leave pool.map waiting, report the failure
+        # instead
+        return i, None, time.time()-start
+    return i, N, time.time()-start
+
+def planMasks(regfiles,prefix,columns,HA,sky,stars=None,equinox='2000',passband='R',processes=1,HA_window=None):
+    '''
+    Plans every mask defined by the box regions of one or more ds9 region
+    files in a single run, sharing the catalog columns between the masks. With
+    processes > 1 the masks are spread over a process pool; the catalog
+    columns are then shared with the workers through memory-mapped files and
+    the output is identical to a serial run.
+    Input:
+    regfiles = [string or list of strings] ds9 region file(s), each box is a
+        mask
+    prefix = [string] prefix of all output files, mask n (counting the boxes
+        from 1 in the order of readMaskRegions) is written with the prefix
+        prefix_m<n>
+    columns = [dictionary] catalog arrays, see planMask
+    HA = [float or list of floats; units=hours] hour angle of all masks or of
+        each mask
+    sky = [(float,float); units:arcsec] sky on either side of the galaxy
+    stars = [list or None] (gs_ids,as_ids) of each mask, or None to write no
+        guide and alignment stars
+    processes = [int] number of worker processes, 1 plans the masks serially
+    HA_window = [tuple, list of tuples or None] exposure window of all masks
+        or of each mask, see planMask
+    With several masks only the preselected galaxies on a mask are forced
+    into its dsim catalog (see planMask, on_mask_preselect), a single mask is
+    planned with every preselected galaxy as before.
+    Output:
+    prefixes = [list of strings] output prefix of each mask
+    '''
+    boxes = readMaskRegions(regfiles)
+    N_mask = numpy.size(boxes)
+    if numpy.size(HA) == 1:
+        HA = [HA]*N_mask
+    if stars is None:
+        stars = [(None,None)]*N_mask
+    if HA_window is None or numpy.ndim(HA_window) == 1:
+        HA_window = [HA_window]*N_mask
+    if numpy.size(HA) != N_mask or len(stars) != N_mask or len(HA_window) != N_mask:
+        print 'obsplan.planMasks: error, {0} masks found but HA, HA_window or stars given for a different number of masks, exiting'.format(N_mask)
+        sys.exit()
+    prefixes = [prefix+'_m{0}'.format(i+1) for i in range(N_mask)]
+    start = time.time()
+    if processes > 1 and N_mask > 1:
+        # sort the catalog for the footprint queries once for all workers
+        columns = dict(columns)
+        columns['sky_order'] = skyindex.getIndex(columns['ra'],columns['dec'])['order']
+        tmpdir = tempfile.mkdtemp(prefix='obsplan')
+        try:
+            shared = _shareColumns(columns,tmpdir)
+            tasks = [(i,tuple(boxes[i]),prefixes[i],shared,HA[i],sky,stars[i][0],
+                      stars[i][1],equinox,passband,HA_window[i],N_mask > 1) for i in range(N_mask)]
+            pool = multiprocessing.Pool(min(processes,N_mask))
+            try:
+                results = pool.map(_planMaskWorker,tasks,chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(tmpdir)
+    else:
+        results = []
+        for i in range(N_mask):
+            start_i = time.time()
+            N = planMask(boxes[i],prefixes[i],columns,HA[i],sky,stars[i][0],
+                         stars[i][1],equinox,passband,HA_window[i],N_mask > 1)
+            results.append((i,N,time.time()-start_i))
+    failed = [i+1 for i, N, elapsed in results if N is None]
+    if len(failed) > 0:
+        print 'obsplan.planMasks: error, planning of mask(s) {0} failed, exiting'.format(', '.join(str(i) for i in failed))
+        sys.exit()
+    for i, N, elapsed in results:
+        print 'obsplan: mask {0} of {1}, {2} galaxies written with prefix {3} ({4:0.2f} s)'.format(i+1,N_mask,N,prefixes[i],elapsed)
+    print 'obsplan: {0} masks planned in {1:0.2f} s'.format(N_mask,time.time()-start)
+    return prefixes
+
+def _boxSums(u,v,weight,width,height,cell,ucenters,vcenters):
+    '''
+    Total weight inside an axis aligned width x height box centred on every
+    (ucenters, vcenters) grid node, computed from a summed-area table of the
+    weights binned in cells of size cell (all in arcsec).
+    '''
+    nw = int(round(width/(2*cell)))
+    nh = int(round(height/(2*cell)))
+    # the grid nodes run from u0 to u0+(nu-1)*cell, pad by the box half size
+    u0 = ucenters[0]-nw*cell
+    v0 = vcenters[0]-nh*cell
+    nu = numpy.size(ucenters)+2*nw
+    nv = numpy.size(vcenters)+2*nh
+    iu = numpy.floor((u-u0)/cell).astype(int)
+    iv = numpy.floor((v-v0)/cell).astype(int)
+    keep = (iu >= 0)*(iu < nu)*(iv >= 0)*(iv < nv)
+    hist = numpy.bincount(iu[keep]*nv+iv[keep],weights=weight[keep],
+                          minlength=nu*nv).reshape(nu,nv)
+    sat = numpy.zeros((nu+1,nv+1))
+    sat[1:,1:] = numpy.cumsum(numpy.cumsum(hist,axis=0),axis=1)
+    # centre node k covers the cells [k, k+2*nw) in u and [l, l+2*nh) in v
+    Nu = numpy.size(ucenters)
+    Nv = numpy.size(vcenters)
+    return (sat[2*nw:2*nw+Nu,2*nh:2*nh+Nv]-sat[0:Nu,2*nh:2*nh+Nv]
+            -sat[2*nw:2*nw+Nu,0:Nv]+sat[0:Nu,0:Nv])
+
+def _bestBoxes(x,y,weight,angles,width,height,cell,xlim,ylim,radius,N_best):
+    '''
+    Evaluates every box centre on a grid of spacing cell within (xlim, ylim)
+    and radius of the origin, for every angle, and returns the N_best
+    (total weight, x, y, angle) found. x, y are the flat sky offsets of the
+    galaxies from the search centre in arcsec.
+    '''
+    d2r = numpy.pi/180.0
+    best = []
+    for angle in angles:
+        phi = angle*d2r
+        # rotate into the box frame, as done in boxMask
+        u = x*numpy.cos(-phi)+y*numpy.sin(-phi)
+        v = -x*numpy.sin(-phi)+y*numpy.cos(-phi)
+        # box centres are evaluated on a grid aligned with the box axes that
+        # covers the (xlim, ylim) search window
+        xcorner = numpy.array([xlim[0],xlim[0],xlim[1],xlim[1]])
+        ycorner = numpy.array([ylim[0],ylim[1],ylim[0],ylim[1]])
+        ucorner = xcorner*numpy.cos(-phi)+ycorner*numpy.sin(-phi)
+        vcorner = -xcorner*numpy.sin(-phi)+ycorner*numpy.cos(-phi)
+        ugrid = numpy.arange(ucorner.min(),ucorner.max()+cell,cell)
+        vgrid = numpy.arange(vcorner.min(),vcorner.max()+cell,cell)
+        sums = _boxSums(u,v,weight,width,height,cell,ugrid,vgrid)
+        uc, vc = numpy.meshgrid(ugrid,vgrid,indexing='ij')
+        # centre offsets back in the sky frame
+        xc = uc*numpy.cos(phi)+vc*numpy.sin(phi)
+        yc = -uc*numpy.sin(phi)+vc*numpy.cos(phi)
+        valid = (xc >= xlim[0])*(xc <= xlim[1])*(yc >= ylim[0])*(yc <= ylim[1])*(numpy.hypot(xc,yc) <= radius)
+        sums = numpy.where(valid,sums,-numpy.inf)
+        top = numpy.argsort(sums,axis=None)[::-1][:N_best]
+        best.extend([(sums.flat[k],xc.flat[k],yc.flat[k],angle) for k in top])
+    best.sort(reverse=True)
+    return best[:N_best]
+
+def optimizeMaskPosition(ra,dec,weight,xc,yc,search_radius,width=300.,height=966.,
+                         HA=None,phi=19.82525,relPA_min=5,relPA_max=30,
+                         angle_step=5.,cell=10.,regfile=None):
+    '''
+    Searches the mask centre and angle that maximise the total weight (e.g.
+    priority code) of the galaxies inside the mask footprint. The search is
+    coarse-to-fine: every angle (step angle_step) and every centre on a grid
+    of spacing cell is evaluated in one vectorized summed-area table pass per
+    angle, the best candidates are refined with a 5 times finer grid and 1
+    degree steps, and the finalists are scored exactly with boxMask.
+    Input:
+    ra, dec = [1D arrays of floats; units:degrees] galaxy coordinates
+    weight = [1D array of floats] weight of each galaxy, galaxies that can not
+        be selected (e.g. stars or excluded objects) should have weight 0
+    xc, yc = [floats; units:degrees] centre of the search area
+    search_radius = [float; units:arcmin] maximum offset of the mask centre
+        from (xc, yc)
+    width, height = [floats; units:arcsec] size of the mask footprint
+    HA = [float or None; units:hours] hour angle of the mask. If given only
+        mask angles for which the optimal slit PA (see optimalPA) is the
+        parallactic angle, i.e. within relPA_min and relPA_max of the mask PA,
+        are searched.
+    angle_step = [float; units:degrees] coarse angle step
+    cell = [float; units:arcsec] coarse centre grid spacing
+    regfile = [string or None] if given the best box is written to this ds9
+        region file
+    Output:
+    box = [tuple] (xc,yc,width,height,angle) of the best mask, the angle is
+        between 0 and 180 degrees (the footprint is symmetric, add 180 to put
+        the guider camera on the other side)
+    total = [float] total weight of the galaxies inside the best mask
+    '''
+    d2r = numpy.pi/180.0
+    weight = numpy.asarray(weight,dtype=float)
+    radius = search_radius*60.
+    diag = numpy.hypot(width,height)/2.
+    # only galaxies that can fall in any of the searched masks are needed
+    index = skyindex.getIndex(ra,dec)
+    candidates = skyindex.boxCandidates(index,xc,yc,(radius+diag+2*cell)/(60**2))
+    candidates = candidates[weight[candidates] != 0]
+    x = (ra[candidates]-xc)*numpy.cos(yc*d2r)*60**2
+    y = (dec[candidates]-yc)*60**2
+    w = weight[candidates]
+
+    def allowed(angles):
+        # the footprint is symmetric under a rotation of 180 degrees
+        angles = numpy.mod(angles,180.)
+        if HA is None:
+            return angles
+        pa_obj = objectPA(HA,yc,phi)
+        if pa_obj < 0:
+            pa_obj += 180
+        diff = numpy.abs(angles-pa_obj)
+        return angles[(diff >= relPA_min)*(diff < relPA_max)]
+
+    angles = allowed(numpy.arange(0,180,angle_step))
+    if numpy.size(angles) == 0:
+        print 'obsplan.optimizeMaskPosition: error, no mask angle satisfies the relPA_min, relPA_max constraints for the given HA, exiting'
+        sys.exit()
+    lim = (-radius,radius)
+    coarse = _bestBoxes(x,y,w,angles,width,height,cell,lim,lim,radius,5)
+
+    # refine around each of the best coarse candidates
+    fine = []
+    for total_c, x_c, y_c, angle_c in coarse:
+        fine_angles = allowed(numpy.arange(angle_c-angle_step,angle_c+angle_step+1,1.))
+        if numpy.size(fine_angles) == 0:
+            fine_angles = [angle_c]
+        fine.extend(_bestBoxes(x,y,w,numpy.unique(fine_angles),width,height,cell/5.,
+                               (x_c-2*cell,x_c+2*cell),(y_c-2*cell,y_c+2*cell),
+                               radius,3))
+
+    # score the finalists exactly
+    best_box = None
+    best_total = -numpy.inf
+    for total_f, x_f, y_f, angle_f in fine:
+        dec_f = yc+y_f/60**2
+        ra_f = xc+x_f/(60**2*numpy.cos(yc*d2r))
+        box = (ra_f,dec_f,width,height,angle_f)
+        total = numpy.sum(w[boxMask(box,ra[candidates],dec[candidates])])
+        if total > best_total:
+            best_box = box
+            best_total = total
+    print 'obsplan: best mask at RA={0:0.5f} Dec={1:0.5f} angle={2:0.1f} with total weight {3:0.1f}'.format(best_box[0],best_box[1],best_box[4],best_total)
+    if regfile != None:
+        writeMaskRegion(regfile,best_box)
+    return best_box, best_total
+
 def plotcoverage(redshift,lambda_central,filename=None):
     '''
     Creates a plot of common spectral features in the observed frame. Along with
@@ -454,108 +1234,15 @@ def plotcoverage(redshift,lambda_central,filename=None):
     pylab.plot((lcl_up-411,lcl_up-411),yl,
                '-.b',alpha=0.5,linewidth=3)    
 
-    #Plot common spectral lines
-    x_Lyb = 1025.7*(1+redshift)
-    x_Lya = 1215.7*(1+redshift)
-    x_CIV = 1549.1*(1+redshift)
-    x_AlIII = 1858.7*(1+redshift)
-    x_FeII = 2600*(1+redshift)
-    x_MgII = 2799.8*(1+redshift)
-    x_MgI = 2852*(1+redshift)
-    x_OII = 3727.61*(1+redshift)
-    x_CalK = 3933.667*(1+redshift)
-    x_CalH = 3968.472*(1+redshift)
-    x_Hd = 4101.74*(1+redshift)
-    x_Gband = 4305*(1+redshift)
-    x_Hg = 4340.47*(1+redshift)
-    x_Hb = 4861.33*(1+redshift)
-    x_OIII_1 = 4960.3*(1+redshift)
-    x_OIII_2 = 5008.24*(1+redshift)
-    x_Mgb = 5176*(1+redshift)
-    x_FeI = 5269*(1+redshift)
-    x_NaD = 5893*(1+redshift)
-    x_NII_1 = 6548.06*(1+redshift)
-    x_Ha = 6562.799*(1+redshift)
-    x_NII_2 = 6585.2*(1+redshift)
-    x_SII = 6725.5*(1+redshift)
-    
-    # Plot dashed lines at the respective redshifts
-    pylab.plot((x_Lyb,x_Lyb),yl,'--k')
-    pylab.plot((x_Lya,x_Lya),yl,'--k')
-    pylab.plot((x_CIV,x_CIV),yl,'--k')
-    pylab.plot((x_AlIII,x_AlIII),yl,'--k')
-    pylab.plot((x_FeII,x_FeII),yl,'--k')
-    pylab.plot((x_MgII,x_MgII),yl,'--k')
-    pylab.plot((x_MgI,x_MgI),yl,'--k')
-    pylab.plot((x_OII,x_OII),yl,'--k')
-    pylab.plot((x_CalK,x_CalK),yl,'--k')
-    pylab.plot((x_CalH,x_CalH),yl,'--k')
-    pylab.plot((x_Hd,x_Hd),yl,'--k')
-    pylab.plot((x_Gband,x_Gband),yl,'--k')
-    pylab.plot((x_Hg,x_Hg),yl,'--k')
-    pylab.plot((x_Hb,x_Hb),yl,'--k')
-    pylab.plot((x_OIII_1,x_OIII_1),yl,'--k')
-    pylab.plot((x_OIII_2,x_OIII_2),yl,'--k')
-    pylab.plot((x_Mgb,x_Mgb),yl,'--k')
-    pylab.plot((x_FeI,x_FeI),yl,'--k')
-    pylab.plot((x_NaD,x_NaD),yl,'--k')
-    pylab.plot((x_NII_1,x_NII_1),yl,'--k')
-    pylab.plot((x_Ha,x_Ha),yl,'--k')
-    pylab.plot((x_NII_2,x_NII_2),yl,'--k')
-    pylab.plot((x_SII,x_SII),yl,'--k')
-    
     labeloff = 0.5
     pylab.text(lambda_central, labeloff*(yl[0]+yl[1]),
                '$\lambda_\mathrm{central}$'+'={0}'.format(lambda_central), 
                horizontalalignment='right',verticalalignment='center', 
                rotation='vertical',fontsize=16)
     
-    if x_Lyb > xl[0] and x_Lyb < xl[1]:    
-        pylab.text(x_Lyb, labeloff*(yl[0]+yl[1]), 'Ly-beta', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_Lya > xl[0] and x_Lya < xl[1]:    
-        pylab.text(x_Lya, labeloff*(yl[0]+yl[1]), 'Ly-alpha', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_CIV > xl[0] and x_CIV < xl[1]:    
-        pylab.text(x_CIV, labeloff*(yl[0]+yl[1]), 'C IV', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_AlIII > xl[0] and x_AlIII < xl[1]:    
-        pylab.text(x_AlIII, labeloff*(yl[0]+yl[1]), 'Al III', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_FeII > xl[0] and x_FeII < xl[1]:    
-        pylab.text(x_FeII, labeloff*(yl[0]+yl[1]), 'Fe II', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_MgII > xl[0] and x_MgII < xl[1]:    
-        pylab.text(x_MgII, labeloff*(yl[0]+yl[1]), 'Mg II', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_MgI > xl[0] and x_MgI < xl[1]:    
-        pylab.text(x_MgI, labeloff*(yl[0]+yl[1]), 'Mg I', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_OII > xl[0] and x_OII < xl[1]:    
-        pylab.text(x_OII, labeloff*(yl[0]+yl[1]), '[O II]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_CalK > xl[0] and x_CalK < xl[1]:    
-        pylab.text(x_CalK, labeloff*(yl[0]+yl[1]), 'Cal K', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_CalH > xl[0] and x_CalH < xl[1]:    
-        pylab.text(x_CalH, labeloff*(yl[0]+yl[1]), 'Cal H', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_Hd > xl[0] and x_Hd < xl[1]:    
-        pylab.text(x_Hd, labeloff*(yl[0]+yl[1]), 'Hd', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_Gband > xl[0] and x_Gband < xl[1]:    
-        pylab.text(x_Gband, labeloff*(yl[0]+yl[1]), 'G-band', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_Hg > xl[0] and x_Hg < xl[1]:    
-        pylab.text(x_Hg, labeloff*(yl[0]+yl[1]), 'Hg', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_Hb > xl[0] and x_Hb < xl[1]:    
-        pylab.text(x_Hb, labeloff*(yl[0]+yl[1]), 'Hb', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_OIII_1 > xl[0] and x_OIII_1 < xl[1]:    
-        pylab.text(x_OIII_1, labeloff*(yl[0]+yl[1]), '[OIII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_OIII_2 > xl[0] and x_OIII_2 < xl[1]:    
-        pylab.text(x_OIII_2, labeloff*(yl[0]+yl[1]), '[OIII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_Mgb > xl[0] and x_Mgb < xl[1]:    
-        pylab.text(x_Mgb, labeloff*(yl[0]+yl[1]), 'Mg I(b)', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_FeI > xl[0] and x_FeI < xl[1]:    
-        pylab.text(x_FeI, labeloff*(yl[0]+yl[1]), 'Fe I', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_NaD > xl[0] and x_NaD < xl[1]:    
-        pylab.text(x_NaD, labeloff*(yl[0]+yl[1]), 'Na I (D)', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_NII_1 > xl[0] and x_NII_1 < xl[1]:    
-        pylab.text(x_NII_1, (labeloff-0.1)*(yl[0]+yl[1]), '[NII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_Ha > xl[0] and x_Ha < xl[1]:    
-        pylab.text(x_Ha, labeloff*(yl[0]+yl[1]), 'Ha', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_NII_2 > xl[0] and x_NII_2 < xl[1]:    
-        pylab.text(x_NII_2, (labeloff+0.1)*(yl[0]+yl[1]), '[NII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    if x_SII > xl[0] and x_SII < xl[1]:    
-        pylab.text(x_SII, labeloff*(yl[0]+yl[1]), '[SII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
+    #Plot dashed lines at the common spectral lines, redshifted and
+    #labelled within the plotted range
+    linelist.drawLines(pylab.gca(),linelist.common_lines,redshift,xl,yl,labeloff)
     
     pylab.xlim(xl)
     frame1 = pylab.gca()
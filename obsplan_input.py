@@ -6,6 +6,7 @@ All position angles are defined +CCW from North towards East
 from __future__ import division
 import numpy
 import tools
+import catcache
 import obsplan
 
 ###########################################################################
@@ -18,6 +19,14 @@ import obsplan
 prefix = '/Users/dawson/SkyDrive/Observing/Keck2013a/MACSJ1752/macs1752_Mask1_rev0'
 # Hour angle of the target for the mask (float; unit:hours)
 HA = -40/60.
+# Alternatively the planned exposure window (HA_start, HA_end, dH) of the mask
+# (tuple of floats; unit:hours), e.g. (-1.5, 0.5, 0.1). If not None the slit PA
+# minimizes the differential refraction loss over the whole window rather than
+# being optimal at HA, and the loss of each galaxy is written to
+# prefix_dar.txt. A UT window can be converted with obsplan.utToHA.
+HA_window = None
+# Number of processes used to plan several masks in parallel (see regfile)
+processes = 1
 
 ## Star and Galaxy catalog inputs
 
@@ -30,9 +39,9 @@ passband = 'R'
 equinox = '2000'
 
 # Go ahead and read in the catalog since this will be needed to create the
-# galaxy mask later in the user input section
-cat = tools.readcatalog(catalog)
-key = tools.readheader(catalog)
+# galaxy mask later in the user input section. The catalog is parsed once and
+# cached in binary form next to the catalog file for later runs.
+cat, key = catcache.loadcatalog(catalog)
 
 ## Slitmask ds9 region input
 
@@ -42,6 +51,10 @@ key = tools.readheader(catalog)
 # correspond to the slitmask's parallactic angle (i.e. +CCW from north towards
 # east) with the guider camera in the North-east quadrent at Angle=0.
 regfile = '/Users/dawson/SkyDrive/Observing/Keck2013a/MACSJ1752/mask1_rev0.reg'
+# To plan several masks in one run regfile may also be a list of region files
+# and/or the region file(s) may contain several boxes. Each box is then planned
+# as a separate mask with the output prefix prefix_m1, prefix_m2, etc. in the
+# order of the boxes, and the catalog is only read and prioritized once.
 
 ## Slit size inputs
 
@@ -65,6 +78,9 @@ pa_ga_ttype = None # if None then galaxy assumed circular
 gs_ids = (775311575)
 # Alignment star id's
 as_ids = (775311757, 775311662, 530933312, 530868425, 530868397)
+# When planning several masks, a list with the (gs_ids, as_ids) of each mask.
+# If None every mask uses the gs_ids and as_ids above.
+mask_stars = None
 
 ## Exclusion list input
 
@@ -94,6 +110,13 @@ photo_z_err_ttype = 'z_phot_Err'
 sample_param_ttype = 'dered_r'
 samplebounds = (0,22.5,22.5,23)
 
+# Alternatively samples can be defined over several catalog variables at once.
+# samplerules is a list with one dictionary per sample (sample 1 first) that
+# maps ttype names to the (lower bound, upper bound) of that variable, e.g.
+# ({'dered_r':(0,22.5),'z_phot':(0.25,0.5)},{'dered_r':(0,23)}). If not None
+# samplerules is used instead of sample_param_ttype and samplebounds.
+samplerules = None
+
 ## Preselected list input
 
 # ttype catalog of galaxies to preselect in dsim.
@@ -124,9 +147,6 @@ ra = cat[:,key[ra_ttype]]
 dec = cat[:,key[dec_ttype]]
 mag = cat[:,key[mag_ttype]]
 
-# Create the slitmask mask
-mask_slitmask = obsplan.createSlitmaskMask(regfile,ra,dec)
-
 # Create the exclusion list mask
 if exfile == None:
     # then make a numpy.array of just True's
@@ -141,22 +161,18 @@ priority_code = obsplan.photoz_PriorityCode(z_cluster,gal_photoz,photo_z_err,plo
 
 # Determine the sample for each galaxy (sample 1 objects selected first, then
 # sample 2, etc.). This order of selection take priority over the priority_code
-param_array = cat[:,key[sample_param_ttype]]
-sample = obsplan.assignSample(param_array,samplebounds)
+if samplerules == None:
+    param_array = cat[:,key[sample_param_ttype]]
+    sample = obsplan.assignSample(param_array,samplebounds)
+else:
+    rules = obsplan.compileSampleRules(samplerules)
+    sample = obsplan.assignSampleRules(rules,cat,key)
 
 # Determine the selection flag for each galaxy. If non-zero then the object is
 # preselected
 selectflag = obsplan.assignSelectionFlag(objid,psfile,psobjid_ttype)
 
-# determine object declination and the mask PA from the regfile
-box = obsplan.readMaskRegion(regfile)
-delta = box[1]
-pa_mask = box[4]
-
-# Determine the optimal slit PA
-pa_slit = obsplan.optimalPA(pa_mask,HA,delta)
-
-# Determine the slit size for each object
+# Determine the slit size inputs for each object
 A_gal = cat[:,key[A_gal_ttype]]
 if B_gal_ttype == None:
     B_gal = None
@@ -166,34 +182,20 @@ if pa_ga_ttype == None:
     pa_gal = None
 else:
     pa_gal = cat[:,key[pa_ga_ttype]]
-len1, len2 = obsplan.slitsize(pa_slit,sky,A_gal,B_gal,pa_gal)
-
-# Create the output dsim file
-outcatname = prefix+'_maskcat.txt'
-print 'started to write out to ', outcatname
-F = open(outcatname,'w')
-
-# Write the dsim header information to the output file
-obsplan.write_dsim_header(F,regfile,prefix)
 
-# Write the guide star info to the dsim output file
-obsplan.write_guide_stars(F,gs_ids,objid,ra,dec,mag,equinox,passband)
-
-# Write the alignment star info to the dsim output file
-obsplan.write_align_stars(F,as_ids,objid,ra,dec,mag,equinox,passband)
-
-# Filter the galaxy catalog before creating dsim input
-mask_temp = mask_galaxy*mask_mag*mask_ex*mask_slitmask
-# but need to include any preselected galaxies that might be excluded by the
-# above masks
-mask = numpy.logical_or(mask_temp,selectflag)
-
-# Write the galaxy info to the desim output file
-obsplan.write_galaxies_to_dsim(F,objid[mask],ra[mask],dec[mask],mag[mask],priority_code[mask],sample[mask],selectflag[mask],pa_slit,len1[mask],len2[mask],equinox='2000',passband='R')
-
-# Close the output dsim file
-F.close()
-
-# Create the target galaxy slit region file
-length = len1+len2
-obsplan.makeSlitmaskRegion(prefix,ra[mask],dec[mask],pa_slit,length[mask],sample[mask],width=1)
\ No newline at end of file
+# Gather the catalog arrays shared by all masks. The galaxy catalog is
+# filtered before creating the dsim input, the slitmask footprint filter is
+# applied per mask.
+columns = {'objid':objid,'ra':ra,'dec':dec,'mag':mag,
+           'priority_code':priority_code,'sample':sample,
+           'selectflag':selectflag,'mask':mask_galaxy*mask_mag*mask_ex,
+           'A_gal':A_gal,'B_gal':B_gal,'pa_gal':pa_gal}
+
+# Create the dsim input catalog and slit region file of each mask
+boxes = obsplan.readMaskRegions(regfile)
+if numpy.size(boxes) == 1:
+    obsplan.planMask(boxes[0],prefix,columns,HA,sky,gs_ids,as_ids,equinox,passband,HA_window)
+else:
+    if mask_stars == None:
+        mask_stars = [(gs_ids,as_ids)]*numpy.size(boxes)
+    obsplan.planMasks(regfile,prefix,columns,HA,sky,mask_stars,equinox,passband,processes,HA_window)
@@ -0,0 +1,297 @@
+'''
+Precomputed parallactic angle tables.
+
+obsplan.objectPA evaluates Meeus' equation 14.1 on every call, which adds up
+when planning sweeps over a night's worth of hour angles for every object of a
+catalog. This module tabulates the parallactic angle once per observatory
+latitude on a dense Dec x HA grid and answers later queries by bilinear
+interpolation. The table stores exp(iq) rather than q, so the interpolation is
+continuous across the +/-180 degree wrap of the angle, and q is recovered as
+its argument. The interpolation error of every grid cell is
+measured against the exact formula when the table is built (at the cell
+center and the midpoints of its edges) and kept with the table; queries that
+fall in cells worse than a given tolerance, i.e. the few cells around the
+zenith where the parallactic angle swings through 180 degrees, are evaluated
+exactly instead. The cell error is the largest of these 5 samples, an estimate
+rather than a guaranteed bound on the error within the cell. Queries with a
+non-finite hour angle or declination give NaN, as objectPA does.
+
+Tables are saved as float32 .npz files, named after their latitude and grid,
+so that a table is only ever built once per observatory.
+
+Usage:
+    table = patable.getPATable(19.82525)
+    pa_obj = patable.tablePA(table,H,delta)
+    pa_slit = patable.tableOptimalPA(table,pa_mask,H,delta)
+    HA, expq = patable.tableSweep(table,HA_start,HA_end,delta)
+'''
+import os
+import sys
+import numpy
+import obsplan
+
+# Tables returned by getPATable, keyed by their file name
+_table_cache = {}
+
+def _wrapAngle(angle):
+    # wrap an angle difference into -180 to 180 degrees
+    return (numpy.asarray(angle)+180.) % 360.-180.
+
+def _cellCoordinates(table,H,delta):
+    # returns the flat index k of the lower left node of the cell in which
+    # each query falls, the fractional position of the query within the cell
+    # (t along Dec, u along HA) and whether the query falls on the table.
+    # Non-finite queries are placed off the table, so that they are evaluated
+    # exactly (and give NaN)
+    N_dec, N_HA = numpy.shape(table['expq'])
+    fi = (numpy.asarray(delta,dtype=float)-table['dec_min'])*(1./table['dec_step'])
+    # q is periodic in H with a period of 24 hours
+    fj = ((numpy.asarray(H,dtype=float)-table['HA_min']) % 24.)*(1./table['HA_step'])
+    finite = numpy.logical_and(numpy.isfinite(fi),numpy.isfinite(fj))
+    fi = numpy.where(finite,fi,-1.)
+    fj = numpy.where(finite,fj,0.)
+    inside = numpy.logical_and(fi >= 0,fi <= N_dec-1)
+    i = numpy.clip(numpy.floor(fi),0,N_dec-2).astype(numpy.intp)
+    j = numpy.clip(numpy.floor(fj),0,N_HA-2).astype(numpy.intp)
+    t = (fi-i).astype(numpy.float32)
+    u = (fj-j).astype(numpy.float32)
+    return i*N_HA+j, t, u, inside
+
+def _interpExpPA(table,k,t,u):
+    # bilinear interpolation of exp(iq), the nodes are gathered from the
+    # flattened table which is considerably faster than 2D fancy indexing
+    flat = table['expq'].ravel()
+    N_HA = numpy.shape(table['expq'])[1]
+    lo = flat.take(k)
+    lo += u*(flat.take(k+1)-lo)
+    hi = flat.take(k+N_HA)
+    hi += u*(flat.take(k+N_HA+1)-hi)
+    lo += t*(hi-lo)
+    return lo
+
+def _interpPA(table,k,t,u):
+    return numpy.angle(_interpExpPA(table,k,t,u),deg=True)
+
+def _cellError(table,k):
+    # the nodes are indexed on a N_HA wide grid, the cells on a N_HA-1 wide one
+    N_HA = numpy.shape(table['expq'])[1]
+    return table['maxerr'].ravel().take(k-k//N_HA)
+
+def buildPATable(phi=19.82525,dec_min=-90.,dec_max=90.,dec_step=0.5,
+                 HA_step=0.05):
+    '''
+    Tabulates the parallactic angle of obsplan.objectPA for an observatory.
+
+    Input:
+    phi = [float; units=degrees] observers latitude, defaults to Mauna Kea
+    dec_min, dec_max = [floats; units=degrees] declination range of the table
+    dec_step = [float; units=degrees] declination spacing of the grid
+    HA_step = [float; units=hours] hour angle spacing of the grid, the table
+        always covers -12 to 12 hours
+
+    Output:
+    table = [dictionary] 'expq' the parallactic angle q on the Dec x HA grid,
+        stored as the complex64 exp(iq), 'maxerr' the largest
+        interpolation error (degrees) measured in each grid cell, plus 'phi'
+        and the grid definition 'dec_min', 'dec_step', 'HA_min' and 'HA_step'
+    '''
+    N_dec = int(round((dec_max-dec_min)/dec_step))+1
+    N_HA = int(round(24./HA_step))+1
+    dec = dec_min+dec_step*numpy.arange(N_dec)
+    HA = -12.+HA_step*numpy.arange(N_HA)
+    q = numpy.asarray(obsplan.objectPA(HA[numpy.newaxis,:],dec[:,numpy.newaxis],phi))*numpy.pi/180.
+    table = {'phi':float(phi),'dec_min':float(dec_min),'dec_step':float(dec_step),
+             'HA_min':-12.,'HA_step':float(HA_step),
+             'expq':numpy.exp(1j*q).astype(numpy.complex64)}
+
+    # measure the interpolation error at the center and the edge midpoints of
+    # every cell
+    i = numpy.arange(N_dec-1)[:,numpy.newaxis]
+    j = numpy.arange(N_HA-1)[numpy.newaxis,:]
+    k = i*N_HA+j
+    maxerr = numpy.zeros((N_dec-1,N_HA-1))
+    for t,u in ((0.5,0.5),(0.,0.5),(1.,0.5),(0.5,0.),(0.5,1.)):
+        exact = obsplan.objectPA(HA[j]+u*HA_step,dec[i]+t*dec_step,phi)
+        interp = _interpPA(table,k,numpy.float32(t),numpy.float32(u))
+        error = numpy.abs(_wrapAngle(interp-exact))
+        maxerr = numpy.maximum(maxerr,numpy.where(numpy.isfinite(error),error,180.))
+    table['maxerr'] = maxerr.astype(numpy.float32)
+    return table
+
+def savePATable(filename,table):
+    '''
+    Saves a table returned by buildPATable as a float32 .npz file.
+    '''
+    tmp = filename+'.tmp.npz'
+    numpy.savez(tmp,**table)
+    os.rename(tmp,filename)
+
+def loadPATable(filename):
+    '''
+    Loads a table saved by savePATable.
+    '''
+    data = numpy.load(filename)
+    table = {}
+    for name in data.files:
+        if numpy.ndim(data[name]) == 0:
+            table[name] = float(data[name])
+        else:
+            table[name] = data[name]
+    data.close()
+    return table
+
+def tableFilename(phi=19.82525,dec_min=-90.,dec_max=90.,dec_step=0.5,
+                  HA_step=0.05,tabledir='.'):
+    '''
+    Returns the file name under which getPATable keeps the table of the given
+    latitude and grid.
+    '''
+    name = 'patable_phi{0:+.5f}_dec{1:+g}_{2:+g}_{3:g}_ha{4:g}.npz'.format(phi,dec_min,dec_max,dec_step,HA_step)
+    return os.path.join(tabledir,name)
+
+def getPATable(phi=19.82525,dec_min=-90.,dec_max=90.,dec_step=0.5,HA_step=0.05,
+               tabledir='.'):
+    '''
+    Returns the parallactic angle table of an observatory, loading it from
+    tabledir if it was saved before and otherwise building and saving it.
+    Tables are also kept in memory for the rest of the session. See
+    buildPATable for the inputs.
+    '''
+    filename = tableFilename(phi,dec_min,dec_max,dec_step,HA_step,tabledir)
+    if filename in _table_cache:
+        return _table_cache[filename]
+    if os.path.exists(filename):
+        table = loadPATable(filename)
+    else:
+        print 'patable: building the parallactic angle table {0}'.format(filename)
+        table = buildPATable(phi,dec_min,dec_max,dec_step,HA_step)
+        try:
+            savePATable(filename,table)
+        except (IOError,OSError):
+            print 'patable: warning, unable to save the table {0}'.format(filename)
+    _table_cache[filename] = table
+    return table
+
+def _exactQueries(table,H,delta,tolerance):
+    # broadcasts the queries and locates them on the table, flagging those
+    # that are to be evaluated with the exact formula
+    H, delta = numpy.broadcast_arrays(numpy.asarray(H,dtype=float),
+                                      numpy.asarray(delta,dtype=float))
+    k, t, u, inside = _cellCoordinates(table,H,delta)
+    exact = numpy.logical_or(~inside,_cellError(table,k) > tolerance)
+    return H, delta, k, t, u, exact
+
+def tablePA(table,H,delta,tolerance=0.05):
+    '''
+    Parallactic angle of an object interpolated from a table, a drop in
+    replacement for obsplan.objectPA. The inputs may be arrays and are
+    broadcast against each other.
+
+    Input:
+    table = [dictionary] table returned by getPATable or buildPATable
+    H = [float or array; units=hours] object's hour angle (H is + if west of
+        the meridian)
+    delta = [float or array; units=degrees] object's declination
+    tolerance = [float; units=degrees] queries in grid cells whose measured
+        interpolation error (sampled at 5 points per cell, not a guaranteed
+        bound) exceeds tolerance, or that lie outside the declination range of
+        the table, are evaluated with the exact formula
+
+    Output:
+    parallactic angle of the object (-180 to 180 degrees) measured + from north
+    ccw towards east
+    '''
+    H, delta, k, t, u, exact = _exactQueries(table,H,delta,tolerance)
+    q = _interpPA(table,k,t,u)
+    if numpy.any(exact):
+        q = numpy.array(q)
+        q[exact] = obsplan.objectPA(H[exact],delta[exact],table['phi'])
+    return obsplan._scalarOrArray(q)
+
+def tableExpPA(table,H,delta,tolerance=0.05):
+    '''
+    Returns exp(iq) of the parallactic angle q interpolated from a table, i.e.
+    cos(q) as the real part and sin(q) as the imaginary part. Quantities such
+    as the misalignment sin(pa_slit-q) of a slit follow from it with a few
+    multiplications, without evaluating any trigonometric function per query.
+    See tablePA for the inputs.
+    '''
+    H, delta, k, t, u, exact = _exactQueries(table,H,delta,tolerance)
+    z = _interpExpPA(table,k,t,u)
+    # the interpolation of two unit vectors falls slightly inside the unit
+    # circle
+    z /= numpy.abs(z)
+    if numpy.any(exact):
+        z = numpy.array(z)
+        z[exact] = numpy.exp(1j*numpy.pi/180.*obsplan.objectPA(H[exact],delta[exact],table['phi']))
+    return z
+
+def tableSweep(table,HA_start,HA_end,delta,tolerance=0.05):
+    '''
+    Samples exp(iq) of the parallactic angle q of a set of objects at every
+    hour angle node of the table between HA_start and HA_end, e.g. over a
+    night's observing window. Because the samples fall on the nodes of the
+    table the sweep reduces to blending whole table rows, which avoids both
+    the trigonometry of objectPA and the per query lookups of tableExpPA.
+
+    Input:
+    table = [dictionary] table returned by getPATable or buildPATable
+    HA_start, HA_end = [floats; units=hours] hour angle window, rounded
+        outwards to the nodes of the table
+    delta = [float or 1D array; units=degrees] declinations of the objects
+    tolerance = [float; units=degrees] see tablePA
+
+    Output:
+    HA = [1D array; units=hours] the sampled hour angles, spaced by the
+        table's HA_step
+    z = [2D array] exp(iq) of every object (rows) at every hour angle
+        (columns)
+    '''
+    N_dec, N_HA = numpy.shape(table['expq'])
+    j_start = int(numpy.floor((HA_start-table['HA_min'])/table['HA_step']+1e-9))
+    j_end = int(numpy.ceil((HA_end-table['HA_min'])/table['HA_step']-1e-9))
+    HA = table['HA_min']+table['HA_step']*numpy.arange(j_start,j_end+1)
+    # the first and last columns of the table are the same hour angle, so
+    # windows are wrapped on the N_HA-1 distinct columns
+    columns = numpy.arange(j_start,j_end+1) % (N_HA-1)
+    delta = numpy.atleast_1d(numpy.asarray(delta,dtype=float))
+    fi = (delta-table['dec_min'])*(1./table['dec_step'])
+    # non-finite declinations are evaluated exactly (and give NaN)
+    fi = numpy.where(numpy.isfinite(fi),fi,-1.)
+    inside = numpy.logical_and(fi >= 0,fi <= N_dec-1)
+    i = numpy.clip(numpy.floor(fi),0,N_dec-2).astype(numpy.intp)
+    t = (fi-i).astype(numpy.float32)[:,numpy.newaxis]
+    window = table['expq'].take(columns,axis=1)
+    z = window[i]
+    z += t*(window[i+1]-z)
+    z /= numpy.abs(z)
+    exact = table['maxerr'].take(numpy.minimum(columns,N_HA-2),axis=1)[i] > tolerance
+    exact[~inside,:] = True
+    if numpy.any(exact):
+        rows, cols = numpy.nonzero(exact)
+        z[rows,cols] = numpy.exp(1j*numpy.pi/180.*obsplan.objectPA(HA[cols],delta[rows],table['phi']))
+    return HA, z
+
+def tableError(table,H,delta):
+    '''
+    Returns the interpolation error (degrees) measured for the grid cells of
+    the queries, i.e. the accuracy of tablePA when no query is evaluated
+    exactly. The error of a cell is the largest of the 5 points sampled when
+    the table was built, an estimate rather than a guaranteed bound. Queries
+    outside the table or not finite are given an infinite error.
+    '''
+    k, t, u, inside = _cellCoordinates(table,H,delta)
+    return obsplan._scalarOrArray(numpy.where(inside,_cellError(table,k),numpy.inf))
+
+def tableOptimalPA(table,pa_mask,H,delta,relPA_min=5,relPA_max=30,tolerance=0.05):
+    '''
+    Optimal slit PA of obsplan.optimalPA, with the parallactic angle of the
+    object interpolated from a table. See optimalPA and tablePA for the
+    inputs.
+    '''
+    test_pa_mask = numpy.logical_and(numpy.asarray(pa_mask) >= 0, numpy.asarray(pa_mask) <= 360)
+    if numpy.any(~test_pa_mask):
+        print 'patable.tableOptimalPA: error, mask_pa must be defined between 0 and 360 degrees,check that ds9 mask region is defined appropriately, exiting'
+        sys.exit()
+    pa_obj = tablePA(table,H,delta,tolerance)
+    return obsplan.constrainSlitPA(pa_mask,pa_obj,relPA_min,relPA_max)
@@ -6,6 +6,12 @@ import numpy
 import pylab
 import pyfits
 import sys
+import bintabs
+import spec1d
+import linelist
+
+# lines marked on the spectra
+_spectrum_lines = linelist.selectLines(linelist.common_lines,linelist.spectrum_lines)
 
 ## User Input
 #datapath = '/sandbox/deimos/1rxs3A/2013sep05/'
@@ -20,141 +26,31 @@ def plot1D(datapath,maskname,slit,redshift,which_trace=0,pixbin=10):
     ### PROGRAM
     ###########################
     binfile = maskname+'.bintabs.fits'
-    # Gather the basic slit info tables from the bintabs.fits file
-    hdubin = pyfits.open(datapath+binfile)
-    # Target table information, similar to dsim .lst information
-    tb_targets = hdubin[1].data
-    # Table of slitmask information
-    tb_mask = hdubin[2].data
-    # Table of each slit's physical properties
-    tb_slits = hdubin[3].data
-    # Table that maps the id's of the previous two tables
-    tb_map = hdubin[4].data
-    
-    #Filter the tables keeping only the current slit
-    if slit < 10:
-        slit = '00'+str(slit)
-    elif slit < 100:
-        slit = '0'+str(slit)
-    else:
-        slit = str(slit)
-    tb_s = tb_slits[tb_slits.field('SLITNAME')==slit]
-    # slitid
-    dslitid = tb_s.field('DSLITID')
-    tb_m = tb_map[tb_map.field('DSLITID')==dslitid]
-    # objectid
-    objectid = tb_m.field('OBJECTID')
-    tb_t = tb_targets[tb_targets.field('OBJECTID')==objectid]
+    # Gather the slit info from the bintabs.fits file, joined once per slit
+    bt = bintabs.readBintabs(datapath+binfile)
+    # three digit slit name, e.g. '007'
+    slit = bintabs.slitName(slit)
     # object (e.g.: DLS photometric objid)
-    obj = tb_t.field('OBJECT')[0]
+    try:
+        obj = bintabs.slitRecord(bt,slit)['OBJECT']
+    except KeyError:
+        print 'plot1Dspec: Error, there is no slit number {0} in {1}, exiting'.format(slit,binfile)
+        sys.exit()
     
     # check if there is a 1d trace for this slit
-    if which_trace == 0:
-        try:
-            hdutrace = pyfits.open(datapath+'spec1d.{0}.{1}.{2}.fits'.format(maskname,slit,obj))
-        except IOError:
+    fig_title = spec1d.spec1dFilename(maskname,slit,obj,which_trace)
+    try:
+        spec = spec1d.readSpec1d(datapath+fig_title)
+    except IOError:
+        if which_trace == 0:
             print 'plot1Dspec: Error, there is no spec1d trace file for slit number {}, exiting'.format(slit)
-            sys.exit()
         else:
-            hdutrace = pyfits.open(datapath+'spec1d.{0}.{1}.{2}.fits'.format(maskname,slit,obj))
-            fig_title = 'spec1d.{0}.{1}.{2}.fits'.format(maskname,slit,obj)
-        
-    if which_trace > 0:
-        try:
-            hdutrace = pyfits.open(datapath+'spec1d.{0}.{1}.serendip{2}.fits'.format(maskname,slit,which_trace))
-        except IOError:
             print 'plot1Dspec: Error, there is no serendip{0} spec1d trace file for slit number {1}, exiting'.format(which_trace,slit)
-            sys.exit()
-        else:
-            # the file exists, read in the data
-            hdutrace = pyfits.open(datapath+'spec1d.{0}.{1}.serendip{2}.fits'.format(maskname,slit,which_trace))
-            fig_title = 'spec1d.{0}.{1}.serendip{2}.fits'.format(maskname,slit,which_trace)
-    
-    # read in the blue side data
-    blue = hdutrace[3].data # this grabs the Horne extraction
-    spec_b = blue[0][0] #trace flux
-    lambda_b = blue[0][1] #trace observed wavelendth
-    
-    # read in the red side data
-    red = hdutrace[4].data # this grabs the Horne extraction
-    spec_r = red[0][0]
-    lambda_r = red[0][1]
-    
-    # get rid of the zeroed out spectrum values (typically just at the very ends of
-    # the blue and red sides
-    mask_b = spec_b > 0
-    mask_r = spec_r > 0
-    spec_b = spec_b[mask_b]
-    lambda_b = lambda_b[mask_b]
-    spec_r = spec_r[mask_r]
-    lambda_r = lambda_r[mask_r]
-    
-    # trim off the first and last 10 pixels of the spectra since these are usually
-    # just noisy pixels
-    spec_b = spec_b[10:]
-    lambda_b = lambda_b[10:]
-    spec_r = spec_r[:-10]
-    lambda_r = lambda_r[:-10]
-    
+        sys.exit()
     
-    
-    if pixbin > 1:
-        # convolve the spectra with a boxcar of size pixbin
-        boxcar = numpy.ones(pixbin)
-        spec_b = numpy.convolve(spec_b,boxcar)    
-        spec_r = numpy.convolve(spec_r,boxcar)
-        # trim the new edges from the convolved spectra
-        # determine the added number of pixels during the convolution
-        pix_added = pixbin-1
-        trim_left = pix_added // 2
-        trim_right = pix_added - trim_left
-        spec_b = spec_b[trim_left:-trim_right]
-        spec_r = spec_r[trim_left:-trim_right]
-            
+    lambda_b,spec_b,lambda_r,spec_r = prepareSpectrum(spec,pixbin)
     fig = pylab.figure(figsize=(20,5))
-    pylab.plot(lambda_b,spec_b,'k')
-    pylab.plot(lambda_r,spec_r,'k')
-    xl = pylab.xlim()
-    yl = pylab.ylim()
-    #Plot common spectral lines
-    x_Hb = 4861*(1+redshift)
-    x_OIII_1 = 4960*(1+redshift)
-    x_OIII_2 = 5008*(1+redshift)
-    x_Mgb = 5176*(1+redshift)
-    x_FeI = 5269*(1+redshift)
-    x_NaD = 5893*(1+redshift)
-    x_NII_1 = 6548*(1+redshift)
-    x_Ha = 6563*(1+redshift)
-    x_NII_2 = 6585*(1+redshift)
-    x_SII = 6726*(1+redshift)
-    
-    
-    pylab.plot((x_Hb,x_Hb),yl,'--k')
-    pylab.plot((x_OIII_1,x_OIII_1),yl,'--k')
-    pylab.plot((x_OIII_2,x_OIII_2),yl,'--k')
-    pylab.plot((x_Mgb,x_Mgb),yl,'--k')
-    pylab.plot((x_FeI,x_FeI),yl,'--k')
-    pylab.plot((x_NaD,x_NaD),yl,'--k')
-    pylab.plot((x_NII_1,x_NII_1),yl,'--k')
-    pylab.plot((x_Ha,x_Ha),yl,'--k')
-    pylab.plot((x_NII_2,x_NII_2),yl,'--k')
-    
-    pylab.text(x_Hb, 0.05*(yl[0]+yl[1]), 'Hb', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    pylab.text(x_OIII_1, 0.05*(yl[0]+yl[1]), '[OIII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    pylab.text(x_OIII_2, 0.05*(yl[0]+yl[1]), '[OIII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    pylab.text(x_Mgb, 0.05*(yl[0]+yl[1]), 'Mg I(b)', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    pylab.text(x_FeI, 0.05*(yl[0]+yl[1]), 'Fe I', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    pylab.text(x_NaD, 0.05*(yl[0]+yl[1]), 'Na I (D)', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    pylab.text(x_NII_1, 0.05*(yl[0]+yl[1]), '[NII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    pylab.text(x_Ha, 0.05*(yl[0]+yl[1]), 'Ha', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    pylab.text(x_NII_2, 0.05*(yl[0]+yl[1]), '[NII]', horizontalalignment='right',verticalalignment='center', rotation='vertical')
-    
-    
-    
-    
-    pylab.xlabel('$\lambda_{observed}$')
-    pylab.ylabel('Flux')
-    pylab.title(fig_title)
+    drawSpectrum(pylab.gca(),lambda_b,spec_b,lambda_r,spec_r,redshift,fig_title)
     
     ## Flats
     ## check if there is a blue side calibration for this slit, and read it in
@@ -188,6 +84,70 @@ def plot1D(datapath,maskname,slit,redshift,which_trace=0,pixbin=10):
     
     #lam1_b = lambda_b[-1]+dlam_b
     
-    pylab.ylim(yl)
     pylab.show()
+
+def prepareSpectrum(spec,pixbin=10):
+    '''
+    Prepares a spectrum for plotting: the zeroed out values are removed, the
+    outer 10 pixels trimmed and the flux smoothed with a boxcar.
+    Input:
+    spec = [dictionary] spectrum read by spec1d.readSpec1d
+    pixbin = [int; units:pixels] width of the boxcar, 1 for no smoothing
+    Output:
+    lambda_b, spec_b, lambda_r, spec_r = [1D arrays] observed wavelength and
+        flux of the blue and red sides
+    '''
+    # the blue and red side trace flux and observed wavelength of the Horne
+    # extraction
+    (lambda_b,spec_b,ivar_b),(lambda_r,spec_r,ivar_r) = spec1d.sides(spec)
     
+    # get rid of the zeroed out spectrum values (typically just at the very ends of
+    # the blue and red sides
+    mask_b = spec_b > 0
+    mask_r = spec_r > 0
+    spec_b = spec_b[mask_b]
+    lambda_b = lambda_b[mask_b]
+    spec_r = spec_r[mask_r]
+    lambda_r = lambda_r[mask_r]
+    
+    # trim off the first and last 10 pixels of the spectra since these are usually
+    # just noisy pixels
+    spec_b = spec_b[10:]
+    lambda_b = lambda_b[10:]
+    spec_r = spec_r[:-10]
+    lambda_r = lambda_r[:-10]
+    
+    
+    
+    if pixbin > 1:
+        # convolve the spectra with a boxcar of size pixbin
+        boxcar = numpy.ones(pixbin)
+        spec_b = numpy.convolve(spec_b,boxcar)    
+        spec_r = numpy.convolve(spec_r,boxcar)
+        # trim the new edges from the convolved spectra
+        # determine the added number of pixels during the convolution
+        pix_added = pixbin-1
+        trim_left = pix_added // 2
+        trim_right = pix_added - trim_left
+        spec_b = spec_b[trim_left:-trim_right]
+        spec_r = spec_r[trim_left:-trim_right]
+    return lambda_b,spec_b,lambda_r,spec_r
+
+def drawSpectrum(ax,lambda_b,spec_b,lambda_r,spec_r,redshift=None,title=None):
+    '''
+    Draws a spectrum prepared by prepareSpectrum on the matplotlib axes ax,
+    with the common spectral lines marked at redshift (None for no lines).
+    '''
+    ax.plot(lambda_b,spec_b,'k')
+    ax.plot(lambda_r,spec_r,'k')
+    xl = ax.get_xlim()
+    yl = ax.get_ylim()
+    if redshift != None:
+        #Plot dashed lines at the common spectral lines within the spectrum
+        linelist.drawLines(ax,_spectrum_lines,redshift,xl,yl,label_y=0.05,stagger=0)
+
+    ax.set_xlabel('$\lambda_{observed}$')
+    ax.set_ylabel('Flux')
+    if title != None:
+        ax.set_title(title)
+    ax.set_ylim(yl)
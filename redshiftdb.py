@@ -0,0 +1,235 @@
+'''
+File-backed redshift store.
+
+The redshifts of the zspec outputs (see zspecReformat) and of the slitcatmatch
+match catalogs are kept in a single SQLite file, with indexes on the object
+name, mask, slit, redshift quality, matched catalog objid and declination, so
+that questions such as "which objects already have ZQUALITY >= 3" or "all
+redshifts of mask X" are answered without re-reading and scanning the text
+catalogs. Each row records the file it was loaded from, reloading a file
+replaces its rows.
+
+Usage:
+    db = redshiftdb.openStore('/sandbox/deimos/redshifts.db')
+    redshiftdb.updateZspec(db,'/sandbox/deimos/')
+    redshiftdb.addMatches(db,'/sandbox/deimos/z1851a/matchcat_z1851a_gmos.txt')
+    good = redshiftdb.selectRedshifts(db,min_quality=3)
+    redshiftdb.writeExclusionList(db,'exclusion.txt',min_quality=3)
+The exclusion list is a ttype catalog with the objID column that
+obsplan.createExclusionMask reads (exobjid_ttype = 'objID').
+'''
+import os
+import sys
+import sqlite3
+import numpy
+import catcache
+import skyindex
+import zspecReformat
+
+# name and SQLite type of each column of the redshifts table
+store_columns = [('objname','TEXT'),('maskname','TEXT'),('slitname','TEXT'),
+                 ('which_trace','TEXT'),('z','REAL'),('zerr','REAL'),
+                 ('zquality','INTEGER'),('comment','TEXT'),('ra','REAL'),
+                 ('dec','REAL'),('objid','INTEGER'),('source','TEXT')]
+# version of the store (PRAGMA user_version), stores of version 0 may hold
+# zspec names padded with blanks
+_store_version = 1
+
+def openStore(dbfile):
+    '''
+    Opens the redshift store, creating the file, its tables and indexes if
+    needed.
+    Output:
+    db = [sqlite3.Connection] the store
+    '''
+    db = sqlite3.connect(dbfile)
+    db.execute('CREATE TABLE IF NOT EXISTS redshifts ({0})'.format(
+        ', '.join('{0} {1}'.format(name,kind) for name,kind in store_columns)))
+    for name in ('objname','maskname','slitname','zquality','objid','source'):
+        db.execute('CREATE INDEX IF NOT EXISTS redshifts_{0} ON redshifts ({0})'.format(name))
+    # positions are queried through a declination strip, see coneSearch
+    db.execute('CREATE INDEX IF NOT EXISTS redshifts_position ON redshifts (dec, ra)')
+    db.execute('CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, '
+               'size INTEGER, mtime REAL, md5 TEXT)')
+    if db.execute('PRAGMA user_version').fetchone()[0] < _store_version:
+        db.execute('UPDATE redshifts SET objname = trim(objname), maskname = trim(maskname), '
+                   'slitname = trim(slitname), comment = trim(comment)')
+        db.execute('PRAGMA user_version = {0}'.format(_store_version))
+    db.commit()
+    return db
+
+def _replaceSource(db,source,rows):
+    # replace the rows of a source file in a single transaction
+    names = [name for name,kind in store_columns]
+    db.execute('DELETE FROM redshifts WHERE source = ?',(source,))
+    db.executemany('INSERT INTO redshifts ({0}) VALUES ({1})'.format(
+        ', '.join(names),', '.join('?'*len(names))),rows)
+    st = os.stat(source)
+    db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)',
+               (source,st.st_size,st.st_mtime,catcache.fileHash(source)))
+    db.commit()
+
+def _isCurrent(db,source):
+    # True if source was loaded and has not changed since
+    st = os.stat(source)
+    row = db.execute('SELECT size, mtime, md5 FROM sources WHERE path = ?',(source,)).fetchone()
+    if row == None or row[0] != st.st_size:
+        return False
+    if row[1] == st.st_mtime:
+        return True
+    # the file was touched, it is current if its contents have not changed
+    if row[2] == catcache.fileHash(source):
+        db.execute('UPDATE sources SET mtime = ? WHERE path = ?',(st.st_mtime,source))
+        db.commit()
+        return True
+    return False
+
+def addZspec(db,fitsfile):
+    '''
+    Loads (or reloads) the redshifts of a zspec file into the store.
+    '''
+    source = os.path.abspath(fitsfile)
+    columns = zspecReformat.readZspec(source)
+    N = numpy.size(columns['z'])
+    # python values (tolist) for sqlite, the names stripped so that they match
+    # exactly, the zspec rows have no position
+    text = dict((name,numpy.char.strip(columns[name].astype(str)).tolist())
+                for name in ('objid','mask','slit','comment'))
+    rows = zip(text['objid'],text['mask'],text['slit'],['primary']*N,
+               columns['z'].astype(float).tolist(),columns['zerr'].astype(float).tolist(),
+               columns['quality'].astype(int).tolist(),text['comment'],
+               [None]*N,[None]*N,[None]*N,[source]*N)
+    _replaceSource(db,source,rows)
+    return N
+
+def updateZspec(db,zspecdir,pattern='zspec.*.fits'):
+    '''
+    Loads the new and changed zspec files of a directory tree into the store
+    and removes the redshifts of zspec files that no longer exist.
+    Output:
+    updated = [list of strings] the zspec files (re)loaded
+    '''
+    files = zspecReformat.findZspec(zspecdir,pattern)
+    updated = [path for path in files if not _isCurrent(db,path)]
+    for path in updated:
+        addZspec(db,path)
+    root = os.path.join(os.path.abspath(zspecdir),'')
+    known = [row[0] for row in db.execute('SELECT path FROM sources')]
+    for path in known:
+        if path.startswith(root) and path not in files and os.path.basename(path).startswith('zspec.'):
+            db.execute('DELETE FROM redshifts WHERE source = ?',(path,))
+            db.execute('DELETE FROM sources WHERE path = ?',(path,))
+    db.commit()
+    print 'redshiftdb: {0} of {1} zspec files loaded'.format(len(updated),len(files))
+    return updated
+
+def addMatches(db,matchfile):
+    '''
+    Loads (or reloads) a slitcatmatch match catalog into the store. The trace
+    position is stored as the position of the row, and the matched catalog
+    objid (NULL if unmatched) as its objid.
+    '''
+    source = os.path.abspath(matchfile)
+    rows = []
+    for line in open(source):
+        if line.startswith('#') or line.strip() == '':
+            continue
+        f = line.rstrip('\n').split('\t')
+        objid = int(float(f[10]))
+        rows.append((f[0],f[4],f[5],f[6],float(f[1]),float(f[2]),
+                     int(float(f[3])),f[-1].strip('"'),float(f[8]),float(f[9]),
+                     None if objid == -99 else objid,source))
+    _replaceSource(db,source,rows)
+    return len(rows)
+
+def _columns(cursor):
+    # the rows of a query as a dictionary of column arrays
+    names = [d[0] for d in cursor.description]
+    rows = cursor.fetchall()
+    columns = {}
+    for i,name in enumerate(names):
+        values = [row[i] for row in rows]
+        kind = dict(store_columns).get(name)
+        if kind == 'REAL':
+            columns[name] = numpy.array([numpy.nan if v == None else v for v in values],dtype=float)
+        elif kind == 'INTEGER':
+            columns[name] = numpy.array([-99 if v == None else v for v in values],dtype=numpy.int64)
+        else:
+            columns[name] = numpy.array(values,dtype=str)
+    return columns
+
+def selectRedshifts(db,objname=None,maskname=None,slitname=None,min_quality=None,which_trace=None):
+    '''
+    Selects the redshifts matching all of the given criteria.
+    Input:
+    objname, maskname, slitname, which_trace = ['string' or None] exact
+        values of these columns
+    min_quality = [int or None] minimum zquality
+    Output:
+    columns = [dictionary] maps each store column to a [1D array], NaN for
+        missing positions and -99 for missing objids
+    '''
+    where = []
+    values = []
+    for name,value in (('objname',objname),('maskname',maskname),
+                       ('slitname',slitname),('which_trace',which_trace)):
+        if value != None:
+            where.append('{0} = ?'.format(name))
+            values.append(value)
+    if min_quality != None:
+        where.append('zquality >= ?')
+        values.append(min_quality)
+    sql = 'SELECT * FROM redshifts'
+    if len(where) > 0:
+        sql += ' WHERE '+' AND '.join(where)
+    return _columns(db.execute(sql,values))
+
+def coneSearch(db,ra,dec,radius):
+    '''
+    Selects the redshifts within radius of (ra, dec).
+    Input:
+    ra, dec = [floats; units:degrees] center of the search
+    radius = [float; units:arcsec] search radius
+    Output:
+    columns = [dictionary] see selectRedshifts, with the separation (arcsec)
+        of each row in 'separation', sorted by separation
+    '''
+    r = radius/3600.
+    # the declination strip uses the (dec, ra) index, the exact separation is
+    # then computed for the strip only
+    columns = _columns(db.execute('SELECT * FROM redshifts WHERE dec BETWEEN ? AND ?',
+                                  (dec-r,dec+r)))
+    separation = skyindex.angularSeparation(ra,dec,columns['ra'],columns['dec'])*3600
+    keep = numpy.flatnonzero(separation <= radius)
+    keep = keep[numpy.argsort(separation[keep],kind='mergesort')]
+    columns = dict((name,column[keep]) for name,column in columns.items())
+    columns['separation'] = separation[keep]
+    return columns
+
+def writeExclusionList(db,exfile,min_quality=3,column='objname'):
+    '''
+    Writes the ids of the objects with a redshift of at least min_quality as
+    a ttype catalog with an objID column, the format read by
+    obsplan.createExclusionMask (exobjid_ttype = 'objID').
+    Input:
+    exfile = ['string'] the exclusion list
+    min_quality = [int] minimum zquality of the excluded objects
+    column = ['string'] 'objname' for the target names of the masks (the
+        objid's given to dsim) or 'objid' for the catalog objid's matched by
+        slitcatmatch
+    Output:
+    N = [int] number of objects written
+    '''
+    if column not in ('objname','objid'):
+        print 'redshiftdb.writeExclusionList: error, column must be objname or objid, exiting'
+        sys.exit()
+    ids = [row[0] for row in db.execute(
+        'SELECT DISTINCT {0} FROM redshifts WHERE zquality >= ? AND {0} IS NOT NULL ORDER BY {0}'.format(column),
+        (min_quality,))]
+    F = open(exfile,'w')
+    F.write('#ttype1 = objID\n')
+    for objid in ids:
+        F.write('{0}\n'.format(objid))
+    F.close()
+    print 'redshiftdb: {0} objects with zquality >= {1} written to {2}'.format(len(ids),min_quality,exfile)
+    return len(ids)
@@ -0,0 +1,169 @@
+'''
+Batch quick-look rendering of every 1D spectrum (primary and serendip traces)
+of a reduced DEIMOS mask.
+
+The bintabs and zspec tables and all the spectra of the mask are read once
+(see bintabs and spec1d), each trace is then drawn as plot1Dspec.plot1D would
+to its own PNG or PDF file with the non-interactive Agg backend, spreading the
+traces over a process pool, and optionally all traces are drawn to a
+multi-page PDF contact sheet. Outputs that are newer than the spec1d, bintabs
+and zspec files they are drawn from are not rendered again.
+'''
+from __future__ import division
+import os
+import multiprocessing
+import numpy
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+import bintabs
+import spec1d
+import plot1Dspec
+
+###########################
+### USER INPUTS
+###########################
+datapath = '/sandbox/deimos/z1851a/2014jun22/'
+maskname = 'z1851a'
+# zspec file of the mask, the common spectral lines of each primary trace are
+# marked at its zspec redshift. None for no line markers.
+zspecfile = '/sandbox/deimos/z1851a/zspec.ngolovich.z1851a.2014-06-22.fits'
+# directory of the rendered spectra, one file per trace named after its spec1d
+# file, e.g. spec1d.z1851a.007.serendip1.png
+outdir = datapath+'quicklook/'
+# format of the per trace files ('png' or 'pdf'), None to only make the contact
+# sheet
+fmt = 'png'
+# multi-page pdf with all the traces of the mask, None for no contact sheet
+contactsheet = outdir+maskname+'_spec1d.pdf'
+# number of spectra per contact sheet page
+panels = 6
+pixbin = 10 # width of the boxcar smoothing (pixels)
+# Number of processes rendering the per trace files in parallel
+processes = 4
+
+###########################
+### PROGRAM
+###########################
+
+def _isCurrent(outfile,sources):
+    # True if outfile exists and is newer than all of its source files
+    if not os.path.exists(outfile):
+        return False
+    mtime = os.path.getmtime(outfile)
+    return all(os.path.getmtime(source) <= mtime for source in sources)
+
+def traceRedshift(bt,trace):
+    '''
+    Returns the zspec redshift of a (maskname, slit, trace) spec1d trace, None
+    for serendips and for slits without a zspec row in the joined table bt
+    (see bintabs).
+    '''
+    record = bintabs.slitRecord(bt,trace[1])
+    if not record['HAS_ZSPEC'] or trace[2] != record['OBJECT']:
+        return None
+    return float(record['Z'])
+
+def _renderWorker(task):
+    '''
+    Process pool worker of renderMask, draws one trace to its own file.
+    '''
+    outfile,spec,redshift,title,pixbin = task
+    fig = Figure(figsize=(20,5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    plot1Dspec.drawSpectrum(ax,*plot1Dspec.prepareSpectrum(spec,pixbin),redshift=redshift,title=title)
+    fig.savefig(outfile)
+    return outfile
+
+def renderContactSheet(filename,specs,redshifts,titles,panels=6,pixbin=10):
+    '''
+    Draws spectra to a multi-page pdf, panels spectra per page.
+    Input:
+    filename = ['string'] the pdf file
+    specs = [list of dictionaries] the spectra (see spec1d)
+    redshifts = [list of floats or None's] redshift of the line markers of
+        each spectrum
+    titles = [list of strings] title of each spectrum
+    '''
+    pdf = PdfPages(filename)
+    for start in range(0,len(specs),panels):
+        fig = Figure(figsize=(11,8.5))
+        FigureCanvasAgg(fig)
+        for k in range(start,min(start+panels,len(specs))):
+            ax = fig.add_subplot(panels,1,k-start+1)
+            plot1Dspec.drawSpectrum(ax,*plot1Dspec.prepareSpectrum(specs[k],pixbin),redshift=redshifts[k],title=titles[k])
+            ax.title.set_fontsize('small')
+            ax.set_xlabel('')
+            ax.set_ylabel('')
+        fig.tight_layout()
+        pdf.savefig(fig)
+    pdf.close()
+
+def renderMask(datapath,maskname,zspecfile=None,outdir=None,fmt='png',contactsheet=None,panels=6,pixbin=10,processes=1):
+    '''
+    Renders every trace of a mask, see the module documentation.
+    Input:
+    datapath = ['string'] directory of the bintabs and spec1d files
+    maskname = ['string'] name of the mask
+    zspecfile = ['string' or None] zspec file of the mask's redshifts
+    outdir = ['string' or None] directory of the per trace files, None for
+        datapath
+    fmt = ['string' or None] 'png' or 'pdf' format of the per trace files,
+        None for no per trace files
+    contactsheet = ['string' or None] the multi-page pdf of all traces
+    panels = [int] number of spectra per contact sheet page
+    pixbin = [int; units:pixels] width of the boxcar smoothing
+    processes = [int] number of worker processes
+    Output:
+    rendered = [list of strings] the files (re)rendered
+    '''
+    if outdir == None:
+        outdir = datapath
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    binfile = datapath+maskname+'.bintabs.fits'
+    tables = [binfile] if zspecfile == None else [binfile,zspecfile]
+    # find the outputs that are missing or older than their sources before
+    # reading any spectra
+    index = spec1d.spec1dIndex(datapath)
+    traces = sorted(trace for trace in index if trace[0] == maskname)
+    outfiles = {}
+    if fmt != None:
+        for trace in traces:
+            outfile = os.path.join(outdir,os.path.basename(index[trace])[:-len('fits')]+fmt)
+            if not _isCurrent(outfile,tables+[index[trace]]):
+                outfiles[trace] = outfile
+    sheet = contactsheet != None and not _isCurrent(contactsheet,tables+[index[trace] for trace in traces])
+    if len(outfiles) == 0 and not sheet:
+        print 'render1Dspec: all {0} traces of mask {1} are up to date'.format(len(traces),maskname)
+        return []
+
+    # read the tables and all the spectra of the mask once
+    bt = bintabs.readBintabs(binfile,zspecfile)
+    spectra = spec1d.readMaskSpectra(datapath,maskname)
+    specs = [spec1d.spectrumRow(spectra,i) for i in range(len(spectra['traces']))]
+    redshifts = [traceRedshift(bt,trace) for trace in spectra['traces']]
+    titles = [os.path.basename(filename) for filename in spectra['filenames']]
+
+    tasks = [(outfiles[trace],specs[i],redshifts[i],titles[i],pixbin)
+             for i,trace in enumerate(spectra['traces']) if trace in outfiles]
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes,len(tasks)))
+        try:
+            rendered = pool.map(_renderWorker,tasks,chunksize=max(1,len(tasks)//(4*processes)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rendered = [_renderWorker(task) for task in tasks]
+    if sheet:
+        renderContactSheet(contactsheet,specs,redshifts,titles,panels,pixbin)
+        rendered.append(contactsheet)
+    print 'render1Dspec: {0} of {1} traces of mask {2} rendered'.format(len(tasks),len(traces),maskname)
+    return rendered
+
+if __name__ == '__main__':
+    renderMask(datapath,maskname,zspecfile,outdir,fmt,contactsheet,panels,pixbin,processes)
@@ -0,0 +1,115 @@
+'''
+Sorted-declination index of a catalog's sky positions.
+
+The catalog is sorted by declination once, so that any query only has to look
+at the strip of objects within the query's declination range (two
+searchsorted calls) rather than at the whole catalog. Indexes are cached per
+(ra, dec) array pair, so that e.g. every mask footprint tested against the
+same catalog in a session reuses the same index.
+'''
+import numpy
+
+# Indexes built by getIndex, keyed by the id()'s of the ra and dec arrays
+_index_cache = {}
+
+def buildIndex(ra,dec,order=None):
+    '''
+    Input:
+    ra = [1D array of floats; units:degrees] RA of the catalog objects
+    dec = [1D array of floats; units:degrees] Dec of the catalog objects
+    order = [1D array of ints or None] a previously computed declination
+        argsort of the catalog (e.g. index['order'] of another process), if
+        None the catalog is sorted
+    Output:
+    index = [dictionary] 'order' the declination argsort of the catalog,
+        'ra' and 'dec' the coordinates in that order and 'N' the catalog length
+    '''
+    if order is None:
+        order = numpy.argsort(dec,kind='mergesort')
+    return {'order':order,'ra':numpy.asarray(ra)[order],
+            'dec':numpy.asarray(dec)[order],'N':numpy.size(dec)}
+
+def getIndex(ra,dec,order=None):
+    '''
+    Returns the index of the (ra, dec) arrays, building it only the first time
+    these arrays are indexed in the session. See buildIndex.
+    '''
+    cached = _index_cache.get((id(ra),id(dec)))
+    # the stored references keep the id()'s from being reused
+    if cached is not None and cached[0] is ra and cached[1] is dec and cached[2]['N'] == numpy.size(dec):
+        return cached[2]
+    index = buildIndex(ra,dec,order)
+    if len(_index_cache) >= 8:
+        _index_cache.clear()
+    _index_cache[(id(ra),id(dec))] = (ra,dec,index)
+    return index
+
+def boxCandidates(index,xc,yc,radius):
+    '''
+    Returns the catalog indices of the objects that can lie within radius of
+    (xc, yc) in the flat sky frame used by obsplan.boxMask, i.e.
+    |dec-yc| <= radius and |ra-xc|*cos(yc) <= radius.
+    Input:
+    index = [dictionary] index returned by buildIndex or getIndex
+    xc, yc = [floats; units:degrees] center of the query
+    radius = [float; units:degrees] half size of the query
+    Output:
+    candidates = [1D array of ints] sorted catalog indices of the candidates
+    '''
+    lo = numpy.searchsorted(index['dec'],yc-radius,side='left')
+    hi = numpy.searchsorted(index['dec'],yc+radius,side='right')
+    ra_strip = index['ra'][lo:hi]
+    keep = numpy.abs((ra_strip-xc)*numpy.cos(yc*numpy.pi/180.0)) <= radius
+    return numpy.sort(index['order'][lo:hi][keep])
+
+def angularSeparation(ra1,dec1,ra2,dec2):
+    '''
+    Returns the angular separation (degrees) between (ra1, dec1) and
+    (ra2, dec2), all in degrees, using the haversine formula. The inputs may
+    be arrays and are broadcast against each other.
+    '''
+    d2r = numpy.pi/180.
+    ra1 = numpy.asarray(ra1,dtype=float)*d2r
+    dec1 = numpy.asarray(dec1,dtype=float)*d2r
+    ra2 = numpy.asarray(ra2,dtype=float)*d2r
+    dec2 = numpy.asarray(dec2,dtype=float)*d2r
+    h = (numpy.sin((dec2-dec1)/2.)**2+
+         numpy.cos(dec1)*numpy.cos(dec2)*numpy.sin((ra2-ra1)/2.)**2)
+    return 2*numpy.arcsin(numpy.sqrt(numpy.minimum(h,1.)))/d2r
+
+def queryRadius(index,ra,dec,radius):
+    '''
+    Finds the catalog objects within radius of each of a set of query
+    positions, in a single batch: every query's declination strip is located
+    with searchsorted, the strips are concatenated and the separations of all
+    query-candidate pairs are computed at once.
+    Input:
+    index = [dictionary] index returned by buildIndex or getIndex
+    ra, dec = [1D arrays of floats; units:degrees] query positions
+    radius = [float or 1D array of floats; units:degrees] search radius of all
+        queries or of each query
+    Output:
+    query = [1D array of ints] query index of each match
+    match = [1D array of ints] catalog index of each match
+    separation = [1D array of floats; units:degrees] separation of each match
+    The matches are ordered by query and then by increasing separation, the
+    number of matches of each query is numpy.bincount(query,minlength=N_query)
+    '''
+    ra = numpy.atleast_1d(numpy.asarray(ra,dtype=float))
+    dec = numpy.atleast_1d(numpy.asarray(dec,dtype=float))
+    radius = numpy.asarray(radius,dtype=float)*numpy.ones(numpy.size(dec))
+    lo = numpy.searchsorted(index['dec'],dec-radius,side='left')
+    hi = numpy.searchsorted(index['dec'],dec+radius,side='right')
+    n = hi-lo
+    # the query and the position in the sorted catalog of every strip member
+    query = numpy.repeat(numpy.arange(numpy.size(dec)),n)
+    first = numpy.repeat(lo-(numpy.cumsum(n)-n),n)
+    sorted_pos = first+numpy.arange(numpy.sum(n))
+    separation = angularSeparation(ra[query],dec[query],index['ra'][sorted_pos],
+                                   index['dec'][sorted_pos])
+    keep = separation <= radius[query]
+    query = query[keep]
+    match = index['order'][sorted_pos[keep]]
+    separation = separation[keep]
+    order = numpy.lexsort((separation,query))
+    return query[order], match[order], separation[order]
@@ -3,10 +3,16 @@ The purpose of this program is to match the spectroscopic objects of a deimos sl
 mask with objects from an image catalog.
 '''
 from __future__ import division
+import os
+import re
+import multiprocessing
 import numpy
 import pyfits
 import tools
-import pyds9 # ds9 and pyds9 should be installed from http://ds9.si.edu/site/Home.html
+import catcache
+import skyindex
+import bintabs
+import spec1d
 
 ###########################
 ### USER INPUTS
@@ -21,6 +27,34 @@ objkey = 'NUMBER' #ttype name of the unique object id column
 imgcoord = ('X_WORLD','Y_WORLD') #ttype name of the ra and dec columns in the image catalog
 mag = 'MAG_AUTO'
 outputfile = '/sandbox/deimos/z1851a/matchcat_z1851a_gmos.txt'
+# Optionally the matches are also written to a binary table, a FITS binary
+# table if the name ends with .fits and a numpy structured array (.npy)
+# otherwise, e.g. '/sandbox/deimos/z1851a/matchcat_z1851a_gmos.fits'
+tablefile = None
+# To match several masks and/or nights into the one outputfile, a list of the
+# (path, maskname, zspecfile) of each mask, e.g.
+# [('/sandbox/deimos/z1851a/2014jun22/','z1851a','zspec.ngolovich.z1851a.2014-06-22.fits'),
+#  ('/sandbox/deimos/z1851b/2014jun23/','z1851b','zspec.ngolovich.z1851b.2014-06-23.fits')]
+# If None only the mask defined by path, maskname and zspecfile is matched.
+masks = None
+# Number of processes used to read the spec1d traces of the masks in parallel
+processes = 1
+
+# Run mode:
+# 'interactive' asks for the match of every ambiguous trace in ds9 as the mask
+#   is processed
+# 'batch' needs neither ds9 nor the keyboard, unique matches are resolved
+#   automatically and the ambiguous traces are written with their candidates
+#   to reviewfile (their outputfile entries have no match until reviewed)
+# 'review' steps through the traces of reviewfile in ds9 and fills in their
+#   matches in outputfile
+mode = 'interactive'
+reviewfile = outputfile+'.review'
+# Every manual selection is recorded in journalfile as soon as it is made. If
+# a run dies part-way (e.g. ds9 disconnects), rerunning replays the journaled
+# selections and only asks for the remaining ones. The journal is removed once
+# the run completes.
+journalfile = outputfile+'.journal'
 
 ### Fits image file input and mask region file
 
@@ -42,115 +76,140 @@ zoom_scale = 30
 ###########################
 ### PROGRAM
 ###########################
-## Setup the ds9 image
-# setup ds9
-# call ds9
-d = pyds9.DS9()
-# turn off colorbar
-d.set('colorbar no')
-
-# load the subaru image in the first frame
-cmd = 'file '+file_fits
-d.set(cmd)
-
-## correct the WCS issues (deleted PV1_ and PV2_ values)
-#d.set('wcs replace Subaru.wcs')
-
-# change the scale to log and apply set limits
-cmd = 'scale '+scale
-d.set(cmd)
-cmd = 'scale limits {0} {1}'.format(scale_limits[0],scale_limits[1])
-d.set(cmd)
-
-# Gather the basic slit info tables from the bintabs.fits file
-binfile = maskname+'.bintabs.fits'
-hdubin = pyfits.open(path+binfile)
-# Target table information, similar to dsim .lst information
-tb_targets = hdubin[1].data
-# Table of slitmask information
-tb_mask = hdubin[2].data
-# Table of each slit's physical properties
-tb_slits = hdubin[3].data
-# Table that maps the id's of the previous two tables
-tb_map = hdubin[4].data
-
-## Work with the zspec results files
-
-# Read in the zspec file contents
-hduzspec = pyfits.open(path+'../../'+zspecfile)
-tb_zspec = hduzspec[1].data
-
-# Create an array with all the slit numbers
-slitnumbers = tb_slits.field('SLITNAME')
-
-# Load the image catalog
-cat = tools.readcatalog(imgcat)
-key = tools.readheader(imgcat)
-
-#Create the ouput file and write header information
-fh = open(outputfile,'w')
-fh.write('#This catalog was created by slitcatmatch.py and matches deimos spectrographic\n')
-fh.write('#traces with a catalog of images.\n')
-fh.write('#ttype0 = target_objid\n')
-fh.write('#ttype1 = z\n')
-fh.write('#ttype2 = zerr\n')
-fh.write('#ttype3 = quality\n')
-fh.write('#ttype4 = mask\n')
-fh.write('#ttype5 = slit\n')
-fh.write('#ttype6 = which_trace\n')
-fh.write('#ttype7 = y_trace\n')
-fh.write('#ttype8 = ra_trace\n')
-fh.write('#ttype9 = dec_trace\n')
-fh.write('#ttype10 = objid\n')
-fh.write('#ttype11 = ra_obj\n')
-fh.write('#ttype12 = dec_obj\n')
-fh.write('#ttype13 = mag_obj\n')
-fh.write('#ttype14 = matchdelta\n')
-fh.write('#ttype15 = comment\n')
-fh.close()
-def match(slit_i,which_trace,cat,key,coord,objkey,mag,tolerance,outputfile):
-    #Filter the tables keeping only the current slit
-    tb_s = tb_slits[tb_slits.field('SLITNAME')==slit_i]
-    # slitid
-    dslitid = tb_s.field('DSLITID')
-    tb_m = tb_map[tb_map.field('DSLITID')==dslitid]
-    # objectid
-    objectid = tb_m.field('OBJECTID')
-    tb_t = tb_targets[tb_targets.field('OBJECTID')==objectid]
-    # object (e.g.: DLS photometric objid)
-    obj = tb_t.field('OBJECT')[0]
-    # zspec info
-    # converting '00#' to '#' notation
-    tb_zs = tb_zspec[tb_zspec.field('SLITNAME')==str(int(slit_i))]
+def setupDS9():
+    '''
+    Opens ds9 with the image file_fits displayed with the scale settings above
+    and returns the pyds9 connection.
+    '''
+    ## Setup the ds9 image
+    # setup ds9, pyds9 is only needed when matches are selected by hand
+    # ds9 and pyds9 should be installed from http://ds9.si.edu/site/Home.html
+    import pyds9
+    # call ds9
+    d = pyds9.DS9()
+    # turn off colorbar
+    d.set('colorbar no')
+
+    # load the subaru image in the first frame
+    cmd = 'file '+file_fits
+    d.set(cmd)
+
+    ## correct the WCS issues (deleted PV1_ and PV2_ values)
+    #d.set('wcs replace Subaru.wcs')
+
+    # change the scale to log and apply set limits
+    cmd = 'scale '+scale
+    d.set(cmd)
+    cmd = 'scale limits {0} {1}'.format(scale_limits[0],scale_limits[1])
+    d.set(cmd)
+    return d
+
+def readMask(path,maskname,zspecfile):
+    '''
+    Reads the joined bintabs and zspec tables of a mask (see bintabs) and
+    indexes its spec1d files.
+    Output:
+    maskdata = [dictionary] 'path', 'maskname', the joined slit tables
+        'bintabs' and the spec1d.spec1dIndex of path 'spec1d'
+    '''
+    # Gather the slit, target and redshift info of every slit from the
+    # bintabs.fits and zspec files, joined once per slit
+    binfile = maskname+'.bintabs.fits'
+    bt = bintabs.readBintabs(path+binfile,path+'../../'+zspecfile)
+    return {'path':path,'maskname':maskname,'bintabs':bt,
+            'spec1d':spec1d.spec1dIndex(path)}
+
+def slitObject(maskdata,slit_i):
+    '''
+    Returns the target object name of a slit (e.g.: DLS photometric objid).
+    '''
+    return bintabs.slitRecord(maskdata['bintabs'],slit_i)['OBJECT']
+
+def maskTraces(maskdata):
+    '''
+    Lists the traces of a mask from its spec1d index, in slit order with the
+    primary trace of each slit before its serendips.
+    Output:
+    traces = [list] (slit_i, which_trace, spec1d file name) of each trace
+    '''
+    slits = maskdata['bintabs']['slits']
+    maskname = maskdata['maskname']
+    # serendips of each slit in the index
+    serendips = {}
+    for mask_i,slit_i,trace in maskdata['spec1d']:
+        m = re.match(r'serendip(\d+)$',trace)
+        if mask_i == maskname and m != None:
+            serendips.setdefault(slit_i,[]).append((int(m.group(1)),trace))
+    traces = []
+    for slit_i,slittyp in zip(slits['SLITNAME'],slits['SLITTYP']):
+        #check if object is a science target or just an alignment star
+        if slittyp == 'A':
+            continue
+        elif slittyp != 'P':
+            print 'slitcatmatch: Error unexpected SLITTYP for slit {0}'.format(slit_i)
+            print 'SLITTYP = "P" expected but {0}. Will still try to match object.'.format(slittyp)
+        obj = slitObject(maskdata,slit_i)
+        # check if there is a 1d trace for this slit
+        filename = maskdata['spec1d'].get((maskname,slit_i,obj))
+        if filename == None:
+            print 'slitcatmatch: There is no spec1d trace file for slit number {}'.format(slit_i)
+            continue
+        traces.append((slit_i,'primary',filename))
+        # add the serendip traces of the slit
+        for n,trace in sorted(serendips.get(slit_i,[])):
+            traces.append((slit_i,trace,maskdata['spec1d'][(maskname,slit_i,trace)]))
+    return traces
+
+def traceInfo(maskdata,slit_i,which_trace,filename):
+    '''
+    Gathers the slit and redshift information of a trace and determines the
+    ra, dec of the trace from its position along the slit.
+    Input:
+    maskdata = [dictionary] the mask's tables, see readMask
+    slit_i = slit name as listed in the bintabs slit table
+    which_trace = ['string'] 'primary' or 'serendip#'
+    filename = ['string'] spec1d file of the trace
+    Output:
+    info = [dictionary] 'obj','z','zerr','quality','slitcomment' the target
+        and redshift info, 'mask','slit','which_trace','slitra','slitdec',
+        'slitlen' the slit info and 'y','ra_trace','dec_trace' the trace
+        position (arcsec along the slit and degrees)
+    '''
+    # slit, target and zspec info of the slit
+    record = bintabs.slitRecord(maskdata['bintabs'],slit_i)
+    obj = record['OBJECT']
 
     # Define the slit astrometric/geometric properties
-    slitra = tb_s.field('SLITRA')[0]
-    slitdec = tb_s.field('SLITDEC')[0]
-    slitlen = tb_s.field('SLITLEN')[0]
-    slitwid = tb_s.field('SLITWID')[0]
-    slitpa = tb_s.field('SLITLPA')[0] #pa for long axis of the slit +ccw from north
-    if which_trace == 'primary':
+    slitra = record['SLITRA']
+    slitdec = record['SLITDEC']
+    slitlen = record['SLITLEN']
+    slitwid = record['SLITWID']
+    slitpa = record['SLITLPA'] #pa for long axis of the slit +ccw from north
+    if which_trace == 'primary' and record['HAS_ZSPEC']:
         # then this is the primary trace and the values are recorded in the zspec file
-        z = tb_zs.field('Z')[0]
-        zerr = tb_zs.field('Z_ERR')[0]
-        quality = tb_zs.field('ZQUALITY')[0]
+        z = record['Z']
+        zerr = record['Z_ERR']
+        quality = record['ZQUALITY']
+    elif which_trace == 'primary':
+        # the slit has no row in the zspec file, there is no redshift
+        print 'slitcatmatch: there is no zspec redshift for slit {0} of mask {1}'.format(slit_i,maskdata['maskname'])
+        z = -99
+        zerr = -99
+        quality = -99
     else:
         # then this is a serendip and the user will have to edit the file later
         z = -88
         zerr = -99
         quality = -88
-    slitcomment = tb_zs.field('COMMENT')[0]
+    slitcomment = record['COMMENT']
 
     # Define the pa of the mask
-    maskpa = tb_mask.field('PA_PNT')[0]
+    maskpa = maskdata['bintabs']['mask']['PA_PNT']
     # Determine the minimum coterminal angle of the slit respect to the mask
     phi = tools.coterminal(slitpa-maskpa)
 
-    # read in the primary trace information
-    if which_trace == 'primary':
-        hdutrace = pyfits.open(path+'spec1d.{0}.{1}.{2}.fits'.format(maskname,slit_i,obj))
-    else:
-        hdutrace = pyfits.open(path+'spec1d.{0}.{1}.{2}.fits'.format(maskname,slit_i,which_trace))
+    # read in the trace information, only the first table is needed
+    hdutrace = pyfits.open(filename,memmap=True)
     tb_trace = hdutrace[1].data #Note using blue side info, redside typically redundent
     # Get the y-position of the trace in pixels from the bottom of the slit
     # and convert to arcsec using pixel scale of 0.1185 arcsec/pix
@@ -168,170 +227,498 @@ def match(slit_i,which_trace,cat,key,coord,objkey,mag,tolerance,outputfile):
     else:
         #then zspec treats the slit as righ side up and y is measured with respect to the bottom of the slit
         ra_trace,dec_trace = tools.angendpt(slitra,slitdec,dc/60.,slitpa)
+    hdutrace.close()
 
-    # Try to find a match within the image catalog
-
-    # Do a quick trim of the catalog to reduce calculation time
-    ramin = slitra-slitlen/(60.**2*2.*numpy.cos(slitdec*numpy.pi/180.))
-    ramax = slitra+slitlen/(60.**2*2.*numpy.cos(slitdec*numpy.pi/180.))
-    decmin = slitdec-slitlen/(60.**2*2.)
-    decmax = slitdec+slitlen/(60.**2*2.)
-    mask_cat_ra = numpy.logical_and(cat[:,key[coord[0]]]>ramin,
-                                    cat[:,key[coord[0]]]<ramax)
-    mask_cat_dec = numpy.logical_and(cat[:,key[coord[1]]]>decmin,
-                                     cat[:,key[coord[1]]]<decmax)
-    mask = numpy.logical_and(mask_cat_ra,mask_cat_dec)
-    cat_flt = cat[mask,:]
-    N = numpy.shape(cat_flt)[0]
-
-    # Calculate the angular separation between all objects and the trace object
-    j=0
-    delta = numpy.zeros(N)
-    for i in range(N):
-        ra = cat_flt[i,key[coord[0]]]
-        dec = cat_flt[i,key[coord[1]]]
-        delta[i] = numpy.abs(tools.angdist(ra,dec,ra_trace,dec_trace)*60**2)
-        if delta[i] < tolerance:
-            j+=1
-    if j==1:
-        #there was a single match satisfying the tolerence
-        cat_flt = cat_flt[delta<tolerance,:]
-        delta = delta[delta<tolerance]
-        match_id = cat_flt[0,key[objkey]]
-        match_ra = cat_flt[0,key[coord[0]]]
-        match_dec = cat_flt[0,key[coord[1]]]
-        match_delta = delta[0]
-        match_mag = cat_flt[0,key[mag]]
+    return {'obj':obj,'z':z,'zerr':zerr,'quality':quality,
+            'slitcomment':slitcomment,'mask':maskdata['maskname'],
+            'slit':slit_i,'which_trace':which_trace,
+            'slitra':slitra,'slitdec':slitdec,'slitlen':slitlen,'y':y,
+            'ra_trace':ra_trace,'dec_trace':dec_trace,'pixscale':pixscale}
+
+def _maskWorker(task):
+    '''
+    Process pool worker of readTraces, reads the tables and the spec1d traces
+    of one mask and returns the traceInfo of each trace.
+    '''
+    path_i,maskname_i,zspecfile_i = task
+    maskdata = readMask(path_i,maskname_i,zspecfile_i)
+    return [traceInfo(maskdata,slit_i,which_trace,filename)
+            for slit_i,which_trace,filename in maskTraces(maskdata)]
+
+def readTraces(masks,processes=1):
+    '''
+    Reads the traces of several masks, with processes > 1 spreading the masks
+    over a process pool.
+    Input:
+    masks = [list] (path, maskname, zspecfile) of each mask
+    processes = [int] number of worker processes
+    Output:
+    infos = [list of dictionaries] traceInfo of every trace, mask by mask in
+        the order of masks
+    '''
+    if processes > 1 and len(masks) > 1:
+        pool = multiprocessing.Pool(min(processes,len(masks)))
+        try:
+            results = pool.map(_maskWorker,masks,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        # load slitmask regions
-        cmd = 'regions load all '+region
-        d.set(cmd)
-        # pan to the current slit
-        cmd = 'pan to {0} {1} wcs fk5 degrees'.format(slitra,slitdec)
-        d.set(cmd)
-        # place the crosshair over the object of interest
-        cmd = 'crosshair {0} {1} wcs fk5 degrees'.format(ra_trace,dec_trace)
-        d.set(cmd)
-        # zoom in on the object
-        zoom = zoom_scale/slitlen
-        cmd = 'zoom to {0}'.format(zoom)
-        d.set(cmd)
-        if j == 0:
-            if numpy.size(delta) != 0:
-                # sort match_delta smallest to largest
-                index = numpy.argsort(delta)
-                delta=delta[index]
-                cat_flt = cat_flt[index,:]
-                print 'slitcatmatch: No catalog matches were found for this trace.'
-                print 'Slit {0} {1}'.format(slit_i,which_trace)
-                print 'The closest objects to the trace are:'
-                print 'Object\tRA\t\tdec\tSeparation (arcsec)\tMagnitude'
-                for k in range(numpy.size(delta)):
-                    print '{0}\t{1:0.5f}\t{2:0.4f}\t{3:0.3f}\t{4:0.1f}'.format(k,cat_flt[k,key[coord[0]]],cat_flt[k,key[coord[1]]],delta[k],cat_flt[k,key[mag]])
-                    #display a region at the object's location, with label
-                    cmd = 'fk5; circle point {0:0.6f} {1:0.5f}'.format(cat_flt[k,key[coord[0]]],cat_flt[k,key[coord[1]]])+' # color=red text={'+'{0}'.format(k)+'}'
-                    d.set('regions', cmd)
-
-                print '{0}\tSelect none.'.format(numpy.size(delta))
-                selection = raw_input('Enter the number of the correct object match: ')
-                if numpy.size(numpy.arange(k+1)==int(selection))==0:
-                    selection = rawinput("Input invalid. Please enter a valid number.: ")
-                if selection == str(numpy.size(delta)):
-                    # Don't associate the trace with an object
-                    match_id = match_ra = match_dec = match_delta = match_mag = -99
-                elif numpy.size(numpy.arange(k+1)==int(selection))!=0:
-                    selection=int(selection)
-                    match_id = cat_flt[selection,key[objkey]]
-                    match_ra = cat_flt[selection,key[coord[0]]]
-                    match_dec = cat_flt[selection,key[coord[1]]]
-                    match_delta = delta[selection]
-                    match_mag = cat_flt[selection,key[mag]]
-            else:
-                print 'slitcatmatch: No catalog matches were found for this trace.'
-                print 'Slit {0} {1}'.format(slit_i,which_trace)
-                match_id = match_ra = match_dec = match_delta = match_mag = -99
-        elif j > 1:
-            cat_flt = cat_flt[delta<tolerance,:]
-            delta = delta[delta<tolerance]
-            print 'slitcatmatch: More than one matches satisfy the separation tolerence.'
-            print 'Slit {0} {1}'.format(slit_i,which_trace)
-            print 'Match\tRA\t\tdec\tSeparation (arcsec)\tMagnitude'
-            for k in range(j):
-                print '{0}\t{1:0.5f}\t{2:0.4f}\t{3:0.3f}\t{4:0.1f}'.format(k,cat_flt[k,key[coord[0]]],cat_flt[k,key[coord[1]]],delta[k],cat_flt[k,key[mag]])
-                #display a region at the object's location, with label
-                cmd = 'fk5; circle point {0:0.6f} {1:0.5f}'.format(cat_flt[k,key[coord[0]]],cat_flt[k,key[coord[1]]])+' # color=red text={'+'{0}'.format(k)+'}'
-                d.set('regions', cmd)
-            print '{0}\tSelect none.'.format(j)
-            selection = raw_input('Enter the number of the correct match: ')
-            if numpy.size(numpy.arange(k+1)==int(selection))==0:
-                selection = rawinput("Input invalid. Please enter a valid number.: ")
-            if selection == str(j):
-                # Don't associate the trace with an object
-                match_id = match_ra = match_dec = match_delta = match_mag = -99
-            elif numpy.size(numpy.arange(k+1)==int(selection))!=0:
-                selection=int(selection)
-                match_id = cat_flt[selection,key[objkey]]
-                match_ra = cat_flt[selection,key[coord[0]]]
-                match_dec = cat_flt[selection,key[coord[1]]]
-                match_delta = delta[selection]
-                match_mag = cat_flt[selection,key[mag]]
-#    print maskname
-#    print slit_i
-#    print which_trace
-#   print y/pixscale
-#    print ra_trace
-#    print dec_trace
-#    print match_id
-#    print match_ra
-#    print match_dec
-#    print match_delta
+        results = [_maskWorker(task) for task in masks]
+    infos = []
+    for i in range(len(masks)):
+        print 'slitcatmatch: {0} traces read for mask {1}'.format(len(results[i]),masks[i][1])
+        infos.extend(results[i])
+    return infos
 
+def matchTraces(infos,cat,key,coord,tolerance):
+    '''
+    Matches every trace with the image catalog in a single batched query of
+    a declination sorted index of the catalog (see skyindex.queryRadius),
+    rather than trimming and searching the catalog trace by trace.
+    Input:
+    infos = [list of dictionaries] traceInfo of each trace
+    cat, key = the image catalog and its ttype key
+    coord = [('string','string')] ttype names of the catalog ra and dec
+    tolerance = [float; units:arcsec] matching tolerance
+    Output:
+    counts = [1D array of ints] number of catalog objects within tolerance of
+        each trace
+    candidates = [list of 1D arrays of ints] catalog rows of the objects
+        within the slitlen x slitlen box centered on the slit of each trace,
+        sorted by increasing separation from the trace
+    separations = [list of 1D arrays of floats; units:arcsec] separation of
+        each candidate from the trace
+    '''
+    N = len(infos)
+    ra_trace = numpy.array([info['ra_trace'] for info in infos],dtype=float)
+    dec_trace = numpy.array([info['dec_trace'] for info in infos],dtype=float)
+    slitra = numpy.array([info['slitra'] for info in infos],dtype=float)
+    slitdec = numpy.array([info['slitdec'] for info in infos],dtype=float)
+    slitlen = numpy.array([info['slitlen'] for info in infos],dtype=float)
+    ra = cat[:,key[coord[0]]]
+    dec = cat[:,key[coord[1]]]
+    index = skyindex.buildIndex(ra,dec)
+    # search a circle around each trace that encloses the box around its slit
+    offset = skyindex.angularSeparation(ra_trace,dec_trace,slitra,slitdec)
+    radius = 1.01*(offset+slitlen/2.*numpy.sqrt(2)/60.**2)
+    query, rows, separation = skyindex.queryRadius(index,ra_trace,dec_trace,radius)
+    # then keep the candidates within the box
+    halfwidth = slitlen[query]/(60.**2*2.)
+    inbox = numpy.logical_and(numpy.abs(ra[rows]-slitra[query]) < halfwidth/numpy.cos(slitdec[query]*numpy.pi/180.),
+                              numpy.abs(dec[rows]-slitdec[query]) < halfwidth)
+    query = query[inbox]
+    rows = rows[inbox]
+    separation = separation[inbox]*60.**2
+    counts = numpy.bincount(query[separation < tolerance],minlength=N)
+    bounds = numpy.searchsorted(query,numpy.arange(N+1))
+    candidates = [rows[bounds[i]:bounds[i+1]] for i in range(N)]
+    separations = [separation[bounds[i]:bounds[i+1]] for i in range(N)]
+    return counts, candidates, separations
+
+def selectCandidate(info,j,cand_ra,cand_dec,cand_mag,delta):
+    '''
+    Displays the candidate matches of a trace in ds9 and asks the user to
+    select the correct one.
+    Input:
+    info = [dictionary] traceInfo of the trace (only 'slit', 'which_trace',
+        'slitra', 'slitdec', 'slitlen', 'ra_trace' and 'dec_trace' are used)
+    j = [int] number of candidates within the matching tolerance
+    cand_ra, cand_dec, cand_mag, delta = [1D arrays] ra, dec, magnitude and
+        separation (arcsec) of each candidate
+    Output:
+    selection = [int or None] index of the selected candidate, None if the
+        trace is not associated with any of them
+    '''
+    slit_i = info['slit']
+    which_trace = info['which_trace']
+    # load slitmask regions
+    cmd = 'regions load all '+region
+    d.set(cmd)
+    # pan to the current slit
+    cmd = 'pan to {0} {1} wcs fk5 degrees'.format(info['slitra'],info['slitdec'])
+    d.set(cmd)
+    # place the crosshair over the object of interest
+    cmd = 'crosshair {0} {1} wcs fk5 degrees'.format(info['ra_trace'],info['dec_trace'])
+    d.set(cmd)
+    # zoom in on the object
+    zoom = zoom_scale/info['slitlen']
+    cmd = 'zoom to {0}'.format(zoom)
+    d.set(cmd)
+    if j == 0:
+        print 'slitcatmatch: No catalog matches were found for this trace.'
+        print 'Slit {0} {1}'.format(slit_i,which_trace)
+        print 'The closest objects to the trace are:'
+        print 'Object\tRA\t\tdec\tSeparation (arcsec)\tMagnitude'
+        prompt = 'Enter the number of the correct object match: '
+    else:
+        print 'slitcatmatch: More than one matches satisfy the separation tolerence.'
+        print 'Slit {0} {1}'.format(slit_i,which_trace)
+        print 'Match\tRA\t\tdec\tSeparation (arcsec)\tMagnitude'
+        prompt = 'Enter the number of the correct match: '
+    for k in range(numpy.size(delta)):
+        print '{0}\t{1:0.5f}\t{2:0.4f}\t{3:0.3f}\t{4:0.1f}'.format(k,cand_ra[k],cand_dec[k],delta[k],cand_mag[k])
+        #display a region at the object's location, with label
+        cmd = 'fk5; circle point {0:0.6f} {1:0.5f}'.format(cand_ra[k],cand_dec[k])+' # color=red text={'+'{0}'.format(k)+'}'
+        d.set('regions', cmd)
+    print '{0}\tSelect none.'.format(numpy.size(delta))
+    selection = raw_input(prompt).strip()
+    while not selection.isdigit() or int(selection) > numpy.size(delta):
+        selection = raw_input('Input invalid. Please enter a valid number.: ').strip()
     #delete all the regions
     cmd = 'regions delete all'
     d.set(cmd)
+    if int(selection) == numpy.size(delta):
+        # Don't associate the trace with an object
+        return None
+    return int(selection)
+
+def openJournal(journalfile):
+    '''
+    Opens the append-only journal of the manual selections of a run. Every
+    selection is appended (and flushed to disk) as soon as it is made, so
+    that a run that dies part-way can be restarted without repeating them:
+    the journal's selections are replayed (see replaySelection) and the
+    journal is removed once the run completes (see closeJournal).
+    Input:
+    journalfile = ['string'] the journal, e.g. outputfile+'.journal'
+    Output:
+    journal = [dictionary] 'decisions' maps the (mask, slit, which_trace) of
+        each journaled trace to the objid of its selected match (None if no
+        match was selected), 'filename' and 'fh' the journal opened for
+        appending
+    '''
+    decisions = {}
+    ends_line = True
+    if os.path.exists(journalfile):
+        for line in open(journalfile):
+            ends_line = line.endswith('\n')
+            fields = line.rstrip('\n').split('\t')
+            # skip the header and a last line cut short by the interruption
+            if line.startswith('#') or not ends_line or len(fields) != 4:
+                continue
+            decisions[tuple(fields[:3])] = None if fields[3] == 'none' else float(fields[3])
+        if len(decisions) > 0:
+            print 'slitcatmatch: resuming, {0} selections of {1} are replayed'.format(len(decisions),journalfile)
+    new = not os.path.exists(journalfile)
+    fh = open(journalfile,'a')
+    if new:
+        fh.write('#mask\tslit\twhich_trace\tobjid of the selected match (none if no match)\n')
+    elif not ends_line:
+        fh.write('\n')
+    return {'filename':journalfile,'decisions':decisions,'fh':fh}
+
+def journalDecision(journal,info,cand_id,selection):
+    '''
+    Appends the manual selection of a trace (index into cand_id, None for no
+    match) to the journal.
+    '''
+    trace = (info['mask'],info['slit'],info['which_trace'])
+    if selection is None:
+        objid = None
+        entry = 'none'
+    else:
+        objid = float(cand_id[selection])
+        entry = repr(objid)
+    journal['fh'].write('{0}\t{1}\t{2}\t{3}\n'.format(trace[0],trace[1],trace[2],entry))
+    journal['fh'].flush()
+    os.fsync(journal['fh'].fileno())
+    journal['decisions'][trace] = objid
 
-    fh = open(outputfile,'a')
-    fh.write('{0}\t{1:0.6f}\t{2}\t{3:0.0f}\t{4}\t{5}\t{6}\t{7:0.1f}\t{8:0.6f}\t{9:0.5f}\t{10:0.0f}\t{11:0.6f}\t{12:0.5f}\t{13:0.2f}\t"{14}"\n'.format(obj,z,zerr,quality,maskname,slit_i,which_trace,y/pixscale,ra_trace,dec_trace,match_id,match_ra,match_dec,match_delta,slitcomment))
+def replaySelection(journal,info,cand_id):
+    '''
+    Returns the journaled selection of a trace as an index into cand_id (None
+    for no match), or -1 if the trace has no usable journal entry.
+    '''
+    trace = (info['mask'],info['slit'],info['which_trace'])
+    if journal is None or trace not in journal['decisions']:
+        return -1
+    objid = journal['decisions'][trace]
+    if objid is None:
+        return None
+    k = numpy.flatnonzero(numpy.asarray(cand_id) == objid)
+    if numpy.size(k) == 0:
+        print 'slitcatmatch: the journaled match {0:0.0f} of slit {1} {2} is no longer a candidate, it has to be selected again'.format(objid,info['slit'],info['which_trace'])
+        return -1
+    return int(k[0])
+
+def closeJournal(journal):
+    '''
+    Closes and removes the journal of a completed run.
+    '''
+    journal['fh'].close()
+    os.remove(journal['filename'])
+
+def formatMatch(info,match_id,match_ra,match_dec,match_delta):
+    '''
+    Returns the outputfile line of a trace and its match.
+    '''
+    return '{0}\t{1:0.6f}\t{2}\t{3:0.0f}\t{4}\t{5}\t{6}\t{7:0.1f}\t{8:0.6f}\t{9:0.5f}\t{10:0.0f}\t{11:0.6f}\t{12:0.5f}\t{13:0.2f}\t"{14}"\n'.format(info['obj'],info['z'],info['zerr'],info['quality'],info['mask'],info['slit'],info['which_trace'],info['y']/info['pixscale'],info['ra_trace'],info['dec_trace'],match_id,match_ra,match_dec,match_delta,info['slitcomment'])
+
+def queueReview(reviewfile,info,j,cand_id,cand_ra,cand_dec,cand_mag,delta):
+    '''
+    Appends an ambiguous trace and its candidates (one line per candidate) to
+    the review queue, see readReviewQueue.
+    '''
+    fh = open(reviewfile,'a')
+    for k in range(numpy.size(delta)):
+        # the candidates are written at full precision, so that reviewed
+        # matches are formatted exactly as interactive ones
+        fh.write('{0}\t{1}\t{2}\t{3}\t{4:0.6f}\t{5:0.6f}\t{6:0.2f}\t{7:0.6f}\t{8:0.6f}\t{9}\t{10:0.0f}\t{11!r}\t{12!r}\t{13:0.2f}\t{14!r}\n'.format(info['mask'],info['slit'],info['which_trace'],j,info['slitra'],info['slitdec'],info['slitlen'],info['ra_trace'],info['dec_trace'],k,cand_id[k],float(cand_ra[k]),float(cand_dec[k]),cand_mag[k],float(delta[k])))
+    fh.close()
+
+def writeReviewHeader(reviewfile):
+    fh = open(reviewfile,'w')
+    fh.write('#This catalog was created by slitcatmatch.py in batch mode and lists the\n')
+    fh.write('#candidate matches of each trace that needs review.\n')
+    for i,name in enumerate(['mask','slit','which_trace','matches','slitra',
+                             'slitdec','slitlen','ra_trace','dec_trace',
+                             'candidate','objid','ra_obj','dec_obj','mag_obj',
+                             'matchdelta']):
+        fh.write('#ttype{0} = {1}\n'.format(i,name))
     fh.close()
 
-# Analyze each trace for all slits and associate with photometric object
-for slit_i in slitnumbers:
-    #check if object is a science target or just an alignment star
-    slittyp = tb_slits.field('SLITTYP')[tb_slits.field('SLITNAME')==slit_i]
-    if slittyp == 'A':
-        continue
-    elif slittyp != 'P':
-        print 'slitcatmatch: Error unexpected SLITTYP for slit {0}'.format(slit_i)
-        print 'SLITTYP = "P" expected but {0}. Will still try to match object.'.format(slittyp)
-
-    #Filter the tables keeping only the current slit
-    tb_s = tb_slits[tb_slits.field('SLITNAME')==slit_i]
-    # slitid
-    dslitid = tb_s.field('DSLITID')
-    tb_m = tb_map[tb_map.field('DSLITID')==dslitid]
-    # objectid
-    objectid = tb_m.field('OBJECTID')
-    tb_t = tb_targets[tb_targets.field('OBJECTID')==objectid]
-    # object (e.g.: DLS photometric objid)
-    obj = tb_t.field('OBJECT')[0]
-
-    # check if there is a 1d trace for this slit
-    try:
-        hdutrace = pyfits.open(path+'spec1d.{0}.{1}.{2}.fits'.format(maskname,slit_i,obj))
-    except IOError:
-        print 'slitcatmatch: There is no spec1d trace file for slit number {}'.format(slit_i)
-        continue
+# name and type of each outputfile column, see formatMatch
+result_columns = [('target_objid',str),('z',float),('zerr',float),
+                  ('quality',int),('mask',str),('slit',str),
+                  ('which_trace',str),('y_trace',float),('ra_trace',float),
+                  ('dec_trace',float),('objid',numpy.int64),('ra_obj',float),
+                  ('dec_obj',float),('matchdelta',float),('comment',str)]
+
+def openResults(outputfile,tablefile=None,buffering=2**20):
+    '''
+    Opens the result sink of a run. The results are written through a single
+    buffered file handle to outputfile+'.tmp', which replaces outputfile only
+    once the run is complete (see closeResults), so that an interrupted run
+    never leaves a partial outputfile.
+    Input:
+    outputfile = ['string'] the text catalog of the matches
+    tablefile = ['string' or None] optional binary table of the matches, see
+        writeResultTable
+    buffering = [int; units:bytes] size of the write buffer
+    Output:
+    sink = [dictionary] the state of the sink, to pass to writeResult and
+        closeResults
+    '''
+    fh = open(outputfile+'.tmp','w',buffering)
+    fh.write('#This catalog was created by slitcatmatch.py and matches deimos spectrographic\n')
+    fh.write('#traces with a catalog of images.\n')
+    for i,(name,kind) in enumerate(result_columns):
+        fh.write('#ttype{0} = {1}\n'.format(i,name))
+    return {'outputfile':outputfile,'tablefile':tablefile,'fh':fh,'rows':[]}
+
+def _resultFields(line):
+    # the column values (strings) of an outputfile line
+    fields = line.rstrip('\n').split('\t')
+    fields[-1] = fields[-1].strip('"')
+    return fields
+
+def writeResult(sink,info,match_id,match_ra,match_dec,match_delta):
+    '''
+    Writes the result of a trace to the sink, see formatMatch.
+    '''
+    line = formatMatch(info,match_id,match_ra,match_dec,match_delta)
+    sink['fh'].write(line)
+    if sink['tablefile'] is not None:
+        sink['rows'].append(_resultFields(line))
+
+def closeResults(sink):
+    '''
+    Flushes the sink and moves the complete catalog to outputfile, and writes
+    the binary table if requested.
+    '''
+    sink['fh'].close()
+    os.rename(sink['outputfile']+'.tmp',sink['outputfile'])
+    if sink['tablefile'] is not None:
+        writeResultTable(sink['tablefile'],sink['rows'])
+
+def resultTable(rows):
+    '''
+    Returns the structured array of outputfile rows (lists of the column
+    values as strings), with the columns of result_columns.
+    '''
+    columns = []
+    for i,(name,kind) in enumerate(result_columns):
+        values = [row[i] for row in rows]
+        if kind == str:
+            columns.append(numpy.array(values,dtype=str))
+        else:
+            # integers are written as e.g. '-99' or '4'
+            columns.append(numpy.array(values,dtype=float).astype(kind))
+    table = numpy.zeros(len(rows),dtype=[(name,column.dtype) for (name,kind),column in zip(result_columns,columns)])
+    for (name,kind),column in zip(result_columns,columns):
+        table[name] = column
+    return table
+
+def writeResultTable(tablefile,rows):
+    '''
+    Writes the outputfile rows as a FITS binary table if tablefile ends with
+    .fits and as a numpy structured array (numpy.load) otherwise. The table is
+    written to tablefile+'.tmp' then renamed.
+    '''
+    table = resultTable(rows)
+    tmp = tablefile+'.tmp'
+    if tablefile.endswith('.fits'):
+        pyfits.BinTableHDU(table).writeto(tmp,clobber=True)
     else:
-        match(slit_i,'primary',cat,key,imgcoord,objkey,mag,tolerance,outputfile)
+        F = open(tmp,'wb')
+        numpy.save(F,table)
+        F.close()
+    os.rename(tmp,tablefile)
 
-    # check if there is a serendip trace and if so then attempt to match with catalog
-    # works for up to 5 serendips
-    for i in range(1,6):
-        try:
-            hdutrace = pyfits.open(path+'spec1d.{0}.{1}.serendip{2}.fits'.format(maskname,slit_i,i))
-        except IOError:
+def match(info,j,cat_flt,delta,key,coord,objkey,mag,tolerance,sink,reviewfile=None,journal=None):
+    '''
+    Associates a trace with a catalog object and writes the result to the
+    result sink (see openResults). A unique match within tolerance is accepted as is, otherwise
+    the user selects the match from the candidates in ds9, or in batch mode
+    (reviewfile given) the candidates are queued for review. Selections in the
+    journal are replayed rather than asked for again.
+    Input:
+    info = [dictionary] traceInfo of the trace
+    j = [int] number of catalog objects within tolerance of the trace
+    cat_flt = [2D array] catalog rows of the candidates, sorted by separation
+    delta = [1D array; units:arcsec] separation of each candidate
+    sink = [dictionary] the result sink returned by openResults
+    reviewfile = ['string' or None] review queue of batch mode
+    journal = [dictionary or None] the journal of manual selections, see
+        openJournal
+    '''
+    match_id = match_ra = match_dec = match_delta = match_mag = -99
+    if j > 0:
+        # only the matches satisfying the tolerance are candidates
+        cat_flt = cat_flt[delta<tolerance,:]
+        delta = delta[delta<tolerance]
+    if j==1:
+        #there was a single match satisfying the tolerence
+        selection = 0
+    elif numpy.size(delta) == 0:
+        print 'slitcatmatch: No catalog matches were found for this trace.'
+        print 'Slit {0} {1}'.format(info['slit'],info['which_trace'])
+        selection = None
+    else:
+        # a selection made before an interruption of the run is replayed
+        selection = replaySelection(journal,info,cat_flt[:,key[objkey]])
+        if selection == -1 and reviewfile is not None:
+            queueReview(reviewfile,info,j,cat_flt[:,key[objkey]],cat_flt[:,key[coord[0]]],
+                        cat_flt[:,key[coord[1]]],cat_flt[:,key[mag]],delta)
+            selection = None
+        elif selection == -1:
+            selection = selectCandidate(info,j,cat_flt[:,key[coord[0]]],
+                                        cat_flt[:,key[coord[1]]],cat_flt[:,key[mag]],delta)
+            if journal is not None:
+                journalDecision(journal,info,cat_flt[:,key[objkey]],selection)
+    if selection is not None:
+        match_id = cat_flt[selection,key[objkey]]
+        match_ra = cat_flt[selection,key[coord[0]]]
+        match_dec = cat_flt[selection,key[coord[1]]]
+        match_delta = delta[selection]
+        match_mag = cat_flt[selection,key[mag]]
+
+    writeResult(sink,info,match_id,match_ra,match_dec,match_delta)
+
+def readReviewQueue(reviewfile):
+    '''
+    Reads the review queue written in batch mode.
+    Output:
+    queue = [list] (info, j, candidates) of each queued trace in the order of
+        the queue, with info a dictionary of the trace's 'mask', 'slit',
+        'which_trace', 'slitra', 'slitdec', 'slitlen', 'ra_trace' and
+        'dec_trace', j the number of candidates within tolerance and
+        candidates a 2D array with columns objid, ra, dec, mag, separation
+    '''
+    queue = []
+    current = None
+    for line in open(reviewfile):
+        if line.startswith('#') or line.strip() == '':
             continue
-        else:
-            # the file exists, try to match the object
-            match(slit_i,'serendip{}'.format(i),cat,key,imgcoord,objkey,mag,tolerance,outputfile)
-print 'slitcatmatch complete'
+        fields = line.rstrip('\n').split('\t')
+        if current is None or tuple(fields[:3]) != (current[0]['mask'],current[0]['slit'],current[0]['which_trace']):
+            info = {'mask':fields[0],'slit':fields[1],'which_trace':fields[2],
+                    'slitra':float(fields[4]),'slitdec':float(fields[5]),
+                    'slitlen':float(fields[6]),'ra_trace':float(fields[7]),
+                    'dec_trace':float(fields[8])}
+            current = (info,int(fields[3]),[])
+            queue.append(current)
+        current[2].append([float(x) for x in fields[10:15]])
+    return [(info,j,numpy.array(candidates)) for info,j,candidates in queue]
+
+def review(reviewfile,outputfile,tablefile=None,journalfile=None):
+    '''
+    Steps through the traces queued in batch mode, asks for their matches in
+    ds9 and fills them in to outputfile (and tablefile if not None). With a
+    journalfile the selections are journaled, see openJournal.
+    '''
+    queue = readReviewQueue(reviewfile)
+    print 'slitcatmatch: {0} traces to review'.format(len(queue))
+    journal = None
+    if journalfile is not None:
+        journal = openJournal(journalfile)
+    selected = {}
+    for info,j,candidates in queue:
+        selection = replaySelection(journal,info,candidates[:,0])
+        if selection == -1:
+            selection = selectCandidate(info,j,candidates[:,1],candidates[:,2],
+                                        candidates[:,3],candidates[:,4])
+            if journal is not None:
+                journalDecision(journal,info,candidates[:,0],selection)
+        if selection is not None:
+            selected[(info['mask'],info['slit'],info['which_trace'])] = candidates[selection]
+    # replace the match columns of the reviewed traces
+    lines = open(outputfile).readlines()
+    for i,line in enumerate(lines):
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if tuple(fields[4:7]) in selected:
+            objid_i, ra_i, dec_i, mag_i, delta_i = selected[tuple(fields[4:7])]
+            fields[10:14] = ['{0:0.0f}'.format(objid_i),'{0:0.6f}'.format(ra_i),
+                             '{0:0.5f}'.format(dec_i),'{0:0.2f}'.format(delta_i)]
+            lines[i] = '\t'.join(fields)
+    fh = open(outputfile+'.tmp','w')
+    fh.writelines(lines)
+    fh.close()
+    os.rename(outputfile+'.tmp',outputfile)
+    if tablefile is not None:
+        writeResultTable(tablefile,[_resultFields(line) for line in lines if not line.startswith('#')])
+    os.remove(reviewfile)
+    if journal is not None:
+        closeJournal(journal)
+    print 'slitcatmatch: review complete, {0} of {1} traces matched'.format(len(selected),len(queue))
+
+if __name__ == '__main__' and mode == 'review':
+    d = setupDS9()
+    review(reviewfile,outputfile,tablefile,journalfile)
+elif __name__ == '__main__':
+    if mode == 'batch':
+        # ambiguous traces are queued for review instead of asked for
+        writeReviewHeader(reviewfile)
+        queuefile = reviewfile
+    else:
+        d = setupDS9()
+        queuefile = None
+
+    # Load the image catalog
+    cat, key = catcache.loadcatalog(imgcat)
+
+    #Create the ouput file and write header information
+    sink = openResults(outputfile,tablefile)
+    # the manual selections of an interrupted run are replayed
+    journal = openJournal(journalfile)
+
+    # Locate every trace of every mask on the sky and match them all with the
+    # image catalog at once
+    if masks == None:
+        masks = [(path,maskname,zspecfile)]
+    infos = readTraces(masks,processes)
+    counts, candidates, separations = matchTraces(infos,cat,key,imgcoord,tolerance)
+
+    # Associate each trace with a photometric object
+    for i in range(len(infos)):
+        match(infos[i],counts[i],cat[candidates[i],:],separations[i],key,imgcoord,
+              objkey,mag,tolerance,sink,queuefile,journal)
+    closeResults(sink)
+    closeJournal(journal)
+    if mode == 'batch':
+        N_review = len(readReviewQueue(reviewfile))
+        print 'slitcatmatch: {0} of {1} traces need review, run with mode = \'review\' to select their matches'.format(N_review,len(infos))
+    print 'slitcatmatch complete'
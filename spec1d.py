@@ -0,0 +1,133 @@
+'''
+Reader of the spec1d files of a reduced DEIMOS mask.
+
+The Horne extractions of a trace are the single row tables in HDU 3 (blue side)
+and HDU 4 (red side) of its spec1d.<mask>.<slit>.<object or serendip#>.fits
+file. The files are opened memory-mapped and only the SPEC, LAMBDA and IVAR
+columns are copied out, so a spectrum is three small arrays rather than an
+open HDUList. A spectrum is a dictionary with the blue and red sides
+concatenated:
+    spec['lambda'], spec['flux'], spec['ivar'] = [1D arrays] blue then red
+    spec['nblue'] = [int] number of blue side pixels
+    spec['filename'] = ['string'] the spec1d file
+and readMaskSpectra loads every spectrum of a mask into padded 2D arrays.
+
+Usage:
+    spec = spec1d.readSpec1d(datapath+spec1d.spec1dFilename(maskname,slit,obj))
+    (lambda_b,flux_b,ivar_b),(lambda_r,flux_r,ivar_r) = spec1d.sides(spec)
+'''
+import os
+import re
+import glob
+import numpy
+import pyfits
+
+_spec1d_regex = re.compile(r'spec1d\.(.+?)\.([^.]+)\.(.+)\.fits$')
+
+def spec1dIndex(path):
+    '''
+    Lists the spec1d files of a directory once.
+    Output:
+    index = [dictionary] maps (maskname, slit, trace) to the spec1d file name,
+        with trace the object name of the primary trace or serendip#
+    '''
+    index = {}
+    for filename in glob.glob(os.path.join(path,'spec1d.*.fits')):
+        m = _spec1d_regex.match(os.path.basename(filename))
+        if m != None:
+            index[m.groups()] = filename
+    return index
+
+def spec1dFilename(maskname,slit,obj,which_trace=0):
+    '''
+    Returns the spec1d file name of a trace.
+    Input:
+    maskname = ['string'] name of the mask
+    slit = ['string'] three digit slit name, e.g. '007'
+    obj = ['string'] target object name of the slit
+    which_trace = [int or 'string'] 0 or 'primary' for the primary trace, n or
+        'serendip#' for the n'th serendip
+    '''
+    if which_trace == 0 or which_trace == 'primary':
+        trace = obj
+    elif isinstance(which_trace,basestring):
+        trace = which_trace
+    else:
+        trace = 'serendip{0}'.format(which_trace)
+    return 'spec1d.{0}.{1}.{2}.fits'.format(maskname,slit,trace)
+
+def readSpec1d(filename,hdus=(3,4)):
+    '''
+    Reads the flux, wavelength and inverse variance of both sides of a trace.
+    Input:
+    filename = ['string'] the spec1d file
+    hdus = [tuple of ints] the blue and red side HDUs, (3,4) for the Horne
+        extraction and (1,2) for the boxcar extraction
+    Output:
+    spec = [dictionary] see the module documentation. Raises IOError if the
+        file does not exist.
+    '''
+    hdutrace = pyfits.open(filename,memmap=True)
+    columns = {'lambda':[],'flux':[],'ivar':[]}
+    for hdu in hdus:
+        tb = hdutrace[hdu].data
+        # copy the columns out of the memory map, so that the file can be closed
+        columns['flux'].append(numpy.array(tb.field('SPEC')[0]))
+        columns['lambda'].append(numpy.array(tb.field('LAMBDA')[0]))
+        columns['ivar'].append(numpy.array(tb.field('IVAR')[0]))
+    hdutrace.close()
+    spec = dict((name,numpy.concatenate(arrays)) for name,arrays in columns.items())
+    spec['nblue'] = numpy.size(columns['flux'][0])
+    spec['filename'] = filename
+    return spec
+
+def sides(spec):
+    '''
+    Returns the ((lambda, flux, ivar) of the blue side, (lambda, flux, ivar) of
+    the red side) of a spectrum, as views of its arrays.
+    '''
+    n = spec['nblue']
+    return ((spec['lambda'][:n],spec['flux'][:n],spec['ivar'][:n]),
+            (spec['lambda'][n:],spec['flux'][n:],spec['ivar'][n:]))
+
+def readMaskSpectra(path,maskname=None,hdus=(3,4)):
+    '''
+    Reads every spectrum of a mask into padded 2D arrays, one row per trace.
+    Input:
+    path = ['string'] the directory of the spec1d files
+    maskname = ['string' or None] only read the spectra of this mask, None for
+        every spec1d file in path
+    hdus = [tuple of ints] see readSpec1d
+    Output:
+    spectra = [dictionary] 'traces' the (maskname, slit, trace) of each row
+        (sorted) and 'filenames' their spec1d files, 'lambda', 'flux' and
+        'ivar' the [2D arrays] of the spectra (blue then red) padded with NaN
+        (ivar with 0), 'npix' and 'nblue' the [1D arrays of ints] total and
+        blue side number of pixels of each row
+    '''
+    index = spec1dIndex(path)
+    traces = sorted(trace for trace in index if maskname == None or trace[0] == maskname)
+    specs = [readSpec1d(index[trace],hdus) for trace in traces]
+    N = len(specs)
+    npix = numpy.array([numpy.size(spec['flux']) for spec in specs],dtype=int)
+    width = numpy.max(npix) if N > 0 else 0
+    spectra = {'traces':traces,'filenames':[index[trace] for trace in traces],
+               'npix':npix,
+               'nblue':numpy.array([spec['nblue'] for spec in specs],dtype=int)}
+    for name,fill in (('lambda',numpy.nan),('flux',numpy.nan),('ivar',0)):
+        dtype = specs[0][name].dtype if N > 0 else float
+        spectra[name] = numpy.empty((N,width),dtype=dtype)
+        spectra[name].fill(fill)
+        for i,spec in enumerate(specs):
+            spectra[name][i,:npix[i]] = spec[name]
+    return spectra
+
+def spectrumRow(spectra,i):
+    '''
+    Returns row i of the spectra read by readMaskSpectra as a spectrum (see
+    readSpec1d), without the padding.
+    '''
+    n = spectra['npix'][i]
+    return {'lambda':spectra['lambda'][i,:n],'flux':spectra['flux'][i,:n],
+            'ivar':spectra['ivar'][i,:n],'nblue':spectra['nblue'][i],
+            'filename':spectra['filenames'][i]}
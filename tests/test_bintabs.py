@@ -0,0 +1,92 @@
+'''
+Tests of the bintabs join on tables whose string columns are blank padded, as
+in the bintabs and zspec files of the DEEP2 pipeline.
+
+Usage:
+    python -m unittest discover tests
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+import pyfits
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import bintabs
+
+def _table(columns):
+    # binary table HDU of (name, format, values) columns
+    return pyfits.new_table([pyfits.Column(name=name,format=format,array=numpy.array(values))
+                             for name,format,values in columns])
+
+def _padBlanks(filename,values):
+    # pyfits pads the strings it writes with nulls, the pipeline files are
+    # padded with blanks
+    F = open(filename,'rb')
+    data = F.read()
+    F.close()
+    for value in values:
+        stripped = value.rstrip()
+        data = data.replace(stripped+'\0'*(len(value)-len(stripped)),value)
+    F = open(filename,'wb')
+    F.write(data)
+    F.close()
+
+def writeMask(dirname):
+    '''
+    Writes a two slit bintabs file and a zspec file with a row for slit 1
+    only, every string value padded with blanks.
+    Output:
+    binfile, zspecfile = ['strings'] the bintabs and zspec files
+    '''
+    targets = _table([('OBJECTID','J',[11,12]),
+                      ('OBJECT','10A',['1001      ','1002      '])])
+    mask = _table([('GUINAME','8A',['m1      ']),('PA_PNT','D',[30.0])])
+    slits = _table([('DSLITID','J',[1,2]),('SLITNAME','6A',['000   ','001   '])])
+    slitmap = _table([('DSLITID','J',[1,2]),('OBJECTID','J',[11,12])])
+    binfile = os.path.join(dirname,'m1.bintabs.fits')
+    pyfits.HDUList([pyfits.PrimaryHDU(),targets,mask,slits,slitmap]).writeto(binfile)
+    _padBlanks(binfile,['1001      ','1002      ','m1      ','000   ','001   '])
+    zspec = _table([('SLITNAME','6A',['1     ']),('Z','D',[0.5]),
+                    ('COMMENT','12A',['good        '])])
+    zspecfile = os.path.join(dirname,'zspec.m1.fits')
+    pyfits.HDUList([pyfits.PrimaryHDU(),zspec]).writeto(zspecfile)
+    _padBlanks(zspecfile,['1     ','good        '])
+    return binfile,zspecfile
+
+class TestPadding(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.binfile,self.zspecfile = writeMask(self.dirname)
+        bintabs._bintabs_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_strings_are_stripped(self):
+        bt = bintabs.readBintabs(self.binfile,self.zspecfile)
+        record = bintabs.slitRecord(bt,1)
+        self.assertEqual(record['OBJECT'],'1002')
+        self.assertEqual(record['COMMENT'],'good')
+        self.assertEqual(record['Z'],0.5)
+        self.assertEqual(bt['mask']['GUINAME'],'m1')
+        self.assertEqual(bt['object_index']['1001'],[0])
+
+    def test_missing_zspec_row(self):
+        bt = bintabs.readBintabs(self.binfile,self.zspecfile)
+        record = bintabs.slitRecord(bt,0)
+        self.assertFalse(record['HAS_ZSPEC'])
+        self.assertEqual(record['Z'],-99)
+        self.assertEqual(record['COMMENT'],'')
+
+    def test_cached_join(self):
+        bintabs.readBintabs(self.binfile,self.zspecfile)
+        bintabs._bintabs_cache.clear()
+        bt = bintabs.readBintabs(self.binfile,self.zspecfile)
+        self.assertEqual(bintabs.slitRecord(bt,1)['OBJECT'],'1002')
+        self.assertEqual(bt['mask']['GUINAME'],'m1')
+
+if __name__ == '__main__':
+    unittest.main()
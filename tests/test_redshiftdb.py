@@ -0,0 +1,65 @@
+'''
+Tests of the redshift store on a zspec file whose string columns are blank
+padded, as in the zspec outputs of the DEEP2 pipeline.
+
+Usage:
+    python -m unittest discover tests
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+import pyfits
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import redshiftdb
+from test_bintabs import _padBlanks
+
+def writeZspec(filename):
+    '''
+    Writes a two row zspec file of mask 'm', every string value padded with
+    blanks.
+    '''
+    columns = [('OBJNAME','12A',['1001','1002']),('SLITNAME','3A',['0','1']),
+               ('MASKNAME','8A',['m','m']),('Z','D',[0.5,1.0]),
+               ('Z_ERR','D',[1e-4,-99.0]),('ZQUALITY','J',[4,2]),
+               ('COMMENT','20A',['ok','weak'])]
+    table = pyfits.new_table([pyfits.Column(name=name,format=format,array=numpy.array(values))
+                              for name,format,values in columns])
+    pyfits.HDUList([pyfits.PrimaryHDU(),table]).writeto(filename)
+    _padBlanks(filename,['1001'+' '*8,'1002'+' '*8,'m'+' '*7,'ok'+' '*18,'weak'+' '*16])
+
+class TestZspec(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.zspecfile = os.path.join(self.dirname,'zspec.x.m.fits')
+        writeZspec(self.zspecfile)
+        self.dbfile = os.path.join(self.dirname,'redshifts.db')
+        self.db = redshiftdb.openStore(self.dbfile)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dirname)
+
+    def test_exact_match(self):
+        redshiftdb.addZspec(self.db,self.zspecfile)
+        self.assertEqual(numpy.size(redshiftdb.selectRedshifts(self.db,maskname='m')['z']),2)
+        good = redshiftdb.selectRedshifts(self.db,objname='1001')
+        self.assertEqual(good['z'].tolist(),[0.5])
+        self.assertEqual(good['comment'].tolist(),['ok'])
+        self.assertEqual(redshiftdb.selectRedshifts(self.db,slitname='1')['objname'].tolist(),['1002'])
+
+    def test_padded_store(self):
+        # a store loaded with padded names is stripped when it is reopened
+        redshiftdb.addZspec(self.db,self.zspecfile)
+        self.db.execute("UPDATE redshifts SET objname = objname || '  '")
+        self.db.execute('PRAGMA user_version = 0')
+        self.db.commit()
+        self.db.close()
+        self.db = redshiftdb.openStore(self.dbfile)
+        self.assertEqual(redshiftdb.selectRedshifts(self.db,objname='1002')['z'].tolist(),[1.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,35 +1,198 @@
-import pyfits
+'''
+Consolidates the zspec outputs of many masks into one master redshift catalog.
+
+The directory tree zspecdir is scanned for zspec FITS files and the objid,
+slit, mask, z, zerr, quality and comment columns of each file are extracted
+(whole columns at once) into a binary chunk kept in <outputfile>.npcache. A
+manifest in the same directory records the size, mtime and md5 hash of each
+file, so that a rerun only extracts the files that are new or have changed
+(files that were only touched are recognized by their hash) and drops the
+files that were removed. The master catalog is then assembled from the chunks
+as a ttype text catalog (outputfile) and optionally as a columnar binary file
+(binaryfile, a .npz with one array per column, see numpy.load).
+
+A single zspec file can still be converted on its own with reformatZspec.
+'''
+import os
+import json
+import fnmatch
+import hashlib
 import numpy
+import pyfits
+import catcache
 
 #user input
-fitsfile = '/sandbox/deimos/zspec.dawson.ciza4A.2013-09-05.fits'
-outputfile = '/sandbox/deimos/ciza4A/zspec.dawson.ciza4A.2013-09-05.txt'
-
-hdulist = pyfits.open(fitsfile)
-
-tbdata = hdulist[1].data
-
-#extract desired columns
-objid = tbdata.field('OBJNAME')
-slit = tbdata.field('SLITNAME')
-mask = tbdata.field('MASKNAME')
-z = tbdata.field('Z')
-zerr = tbdata.field('Z_ERR')
-qual = tbdata.field('ZQUALITY')
-comm = tbdata.field('COMMENT')
-
-#print the selected columns to a text file
-f = open(outputfile,'w')
-f.write('#This data is extracted from the following zspec output:\n')
-f.write('#'+fitsfile+'\n')
-f.write('#ttype0=objid\n')
-f.write('#ttype1=slit\n')
-f.write('#ttype2=mask\n')
-f.write('#ttype3=z\n')
-f.write('#ttype4=zerr\n')
-f.write('#ttype5=quality\n')
-f.write('#ttype6=comment\n')
-for i in numpy.arange(numpy.size(objid)):
-    f.write('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n'.format(objid[i],slit[i],mask[i],z[i],zerr[i],qual[i],comm[i]))
-    i+=1
-f.close()
\ No newline at end of file
+# directory tree searched for zspec outputs
+zspecdir = '/sandbox/deimos/'
+# file name pattern of the zspec outputs
+pattern = 'zspec.*.fits'
+# master redshift catalog (text)
+outputfile = '/sandbox/deimos/zspec_master.txt'
+# columnar binary copy of the master catalog, None for no binary copy
+binaryfile = '/sandbox/deimos/zspec_master.npz'
+
+# output column name and zspec column of each catalog column
+zspec_columns = [('objid','OBJNAME'),('slit','SLITNAME'),('mask','MASKNAME'),
+                 ('z','Z'),('zerr','Z_ERR'),('quality','ZQUALITY'),
+                 ('comment','COMMENT')]
+# version of the extracted chunks, chunks of another version are re-extracted
+_chunk_version = 2
+
+def readZspec(fitsfile):
+    '''
+    Extracts the catalog columns of a zspec file.
+    Output:
+    columns = [dictionary] maps the names of zspec_columns to [1D arrays],
+        the string columns stripped of their fits blank padding
+    '''
+    hdulist = pyfits.open(fitsfile)
+    tbdata = hdulist[1].data
+    columns = {}
+    for name,field in zspec_columns:
+        column = numpy.array(tbdata.field(field))
+        if column.dtype.kind == 'S':
+            column = numpy.char.rstrip(column)
+        columns[name] = column
+    hdulist.close()
+    return columns
+
+def _floatText(values):
+    # formats floats as python's str(float) does, i.e. 12 significant digits
+    # with a trailing .0 on integral values (0.0, -99.0), which is how the
+    # zspec values were always written
+    text = numpy.char.mod('%.12g',numpy.asarray(values,dtype=float))
+    integral = numpy.ones(numpy.shape(text),dtype=bool)
+    for char in '.en':
+        integral &= numpy.char.find(text,char) < 0
+    return numpy.where(integral,numpy.char.add(text,'.0'),text)
+
+def writeZspecText(outputfile,columns,sources):
+    '''
+    Writes catalog columns (see readZspec) as a ttype text catalog, with the
+    zspec files they were extracted from listed in the header. The file is
+    written to outputfile+'.tmp' then renamed.
+    '''
+    names = [name for name,field in zspec_columns]
+    F = open(outputfile+'.tmp','w')
+    F.write('#This data is extracted from the following zspec output:\n')
+    for source in sources:
+        F.write('#'+source+'\n')
+    for i,name in enumerate(names):
+        F.write('#ttype{0}={1}\n'.format(i,name))
+    if numpy.size(columns[names[0]]) > 0:
+        # join the columns element wise rather than formatting row by row
+        text = []
+        for name in names:
+            if columns[name].dtype.kind == 'f':
+                text.append(_floatText(columns[name]))
+            else:
+                text.append(columns[name].astype(str))
+        lines = text[0]
+        for column in text[1:]:
+            lines = numpy.char.add(numpy.char.add(lines,'\t'),column)
+        F.write('\n'.join(lines)+'\n')
+    F.close()
+    os.rename(outputfile+'.tmp',outputfile)
+
+def reformatZspec(fitsfile,outputfile):
+    '''
+    Converts a single zspec file to a ttype text catalog.
+    '''
+    writeZspecText(outputfile,readZspec(fitsfile),[fitsfile])
+
+def findZspec(zspecdir,pattern='zspec.*.fits'):
+    '''
+    Returns the sorted paths of the files matching pattern in the directory
+    tree zspecdir.
+    '''
+    found = []
+    for root,dirs,files in os.walk(zspecdir):
+        found.extend(os.path.join(root,name) for name in fnmatch.filter(files,pattern))
+    return sorted(os.path.abspath(path) for path in found)
+
+def _readManifest(cdir):
+    try:
+        F = open(os.path.join(cdir,'manifest.json'))
+        manifest = json.load(F)
+        F.close()
+    except (IOError,ValueError):
+        return {}
+    return manifest
+
+def _writeManifest(cdir,manifest):
+    tmp = os.path.join(cdir,'manifest.json.tmp')
+    F = open(tmp,'w')
+    json.dump(manifest,F,indent=1,sort_keys=True)
+    F.close()
+    os.rename(tmp,os.path.join(cdir,'manifest.json'))
+
+def _saveColumns(filename,columns):
+    # write to a temporary file then rename, so that an interrupted save never
+    # leaves a truncated file
+    F = open(filename+'.tmp','wb')
+    numpy.savez(F,**columns)
+    F.close()
+    os.rename(filename+'.tmp',filename)
+
+def consolidate(zspecdir,outputfile,binaryfile=None,pattern='zspec.*.fits'):
+    '''
+    Updates the master redshift catalog with the new and changed zspec files of
+    a directory tree, see the module documentation.
+    Input:
+    zspecdir = ['string'] directory tree searched for zspec files
+    outputfile = ['string'] the master text catalog
+    binaryfile = ['string' or None] the master columnar binary catalog (.npz)
+    pattern = ['string'] file name pattern of the zspec files
+    Output:
+    updated = [list of strings] the zspec files (re)extracted
+    '''
+    cdir = outputfile+'.npcache'
+    if not os.path.isdir(cdir):
+        os.makedirs(cdir)
+    manifest = _readManifest(cdir)
+    files = findZspec(zspecdir,pattern)
+    updated = []
+    for path in files:
+        st = os.stat(path)
+        entry = manifest.get(path)
+        if entry != None and entry.get('version') == _chunk_version and entry['size'] == st.st_size:
+            if entry['mtime'] == st.st_mtime:
+                continue
+            # the file was touched, it is unchanged if its contents are
+            md5 = catcache.fileHash(path)
+            if md5 == entry['md5']:
+                entry['mtime'] = st.st_mtime
+                continue
+        chunk = hashlib.md5(path).hexdigest()+'.npz'
+        columns = readZspec(path)
+        _saveColumns(os.path.join(cdir,chunk),columns)
+        manifest[path] = {'size':st.st_size,'mtime':st.st_mtime,
+                          'md5':catcache.fileHash(path),'chunk':chunk,
+                          'rows':numpy.size(columns['z']),'version':_chunk_version}
+        updated.append(path)
+    removed = [path for path in manifest if path not in files]
+    for path in removed:
+        chunkfile = os.path.join(cdir,manifest[path]['chunk'])
+        if os.path.exists(chunkfile):
+            os.remove(chunkfile)
+        del manifest[path]
+    _writeManifest(cdir,manifest)
+
+    current = os.path.exists(outputfile) and (binaryfile == None or os.path.exists(binaryfile))
+    if len(updated) == 0 and len(removed) == 0 and current:
+        print 'zspecReformat: the master catalog of {0} zspec files is up to date'.format(len(files))
+        return updated
+    # assemble the master catalog from the chunks, in file order
+    names = [name for name,field in zspec_columns]
+    chunks = [numpy.load(os.path.join(cdir,manifest[path]['chunk'])) for path in files]
+    columns = {}
+    for name in names:
+        columns[name] = numpy.concatenate([chunk[name] for chunk in chunks]) if len(chunks) > 0 else numpy.array([])
+    writeZspecText(outputfile,columns,files)
+    if binaryfile != None:
+        _saveColumns(binaryfile,columns)
+    print 'zspecReformat: {0} new or changed and {1} removed zspec files, {2} redshifts from {3} files in {4}'.format(len(updated),len(removed),numpy.size(columns['z']),len(files),outputfile)
+    return updated
+
+if __name__ == '__main__':
+    consolidate(zspecdir,outputfile,binaryfile,pattern)